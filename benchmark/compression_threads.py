@@ -0,0 +1,88 @@
+"""
+Scaling of the per-layer compression kernels with the number of pool threads on a CPU worker.
+
+    python benchmark/compression_threads.py --models AlexNet,ResNet18 --threads 1,2,4,8
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+WORKPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(WORKPATH)
+
+import pandas as pd
+import torch
+
+from benchmark.compressors import MODELS, synthetic_gradients, set_gradients
+from core.utils.serialization import ravel_model_params, compression_executor, worker_gradient_executor, DGC, \
+    Aji, server_gradient_filter
+
+
+def run_kernel(kernel, net, gradient, state, executor, rate):
+    if kernel == 'server_gradient_filter':
+        server_gradient_filter(state['size_list'], gradient.clone(), rate=rate, executor=executor)
+        return
+    set_gradients(net, gradient)
+    if kernel == 'worker_gradient_executor':
+        worker_gradient_executor(net, state['payload'], state['u_kt'], state['v_kt'], rate=rate, lr=0.1,
+                                 momentum=0.9, executor=executor)
+    elif kernel == 'dgc':
+        DGC(net, state['payload'], state['u_kt'], state['v_kt'], rate=rate, lr=0.1, momentum=0.9, weight_decay=0,
+            executor=executor)
+    elif kernel == 'aji':
+        Aji(net, state['payload'], state['u_kt'], state['v_kt'], rate=rate, lr=0.1, executor=executor)
+
+
+def main(args):
+    cores = multiprocessing.cpu_count()
+    thread_list = [int(t) for t in args.threads.split(',')] if args.threads else \
+        sorted(set([1] + [2 ** i for i in range(1, cores.bit_length()) if 2 ** i <= cores] + [cores]))
+    rows = []
+    for name in args.models.split(','):
+        net = MODELS[name]()
+        torch.manual_seed(args.seed)
+        gradients = synthetic_gradients(net, args.repeat + 1)
+        numel = ravel_model_params(net).numel()
+        state = {
+            'size_list': [p.data.numel() for p in net.parameters()],
+            'payload': torch.zeros(numel),
+            'u_kt': torch.zeros(numel),
+            'v_kt': torch.zeros(numel),
+        }
+        for kernel in args.kernels.split(','):
+            baseline = None
+            for threads in thread_list:
+                torch.set_num_threads(cores)
+                executor = compression_executor(threads)
+                # first run warms up the pool and the allocator
+                run_kernel(kernel, net, gradients[0], state, executor, args.rate)
+                start = time.time()
+                for gradient in gradients[1:]:
+                    run_kernel(kernel, net, gradient, state, executor, args.rate)
+                elapsed = (time.time() - start) / args.repeat
+                if executor is not None:
+                    executor.shutdown()
+                baseline = baseline or elapsed
+                rows.append({'model': name, 'kernel': kernel, 'threads': threads,
+                             'intra_op_threads': torch.get_num_threads(), 'ms': elapsed * 1000,
+                             'speedup': baseline / elapsed})
+                print('{model} {kernel} threads {threads}: {ms:.1f} ms, speedup {speedup:.2f}'.format(**rows[-1]))
+    df = pd.DataFrame(rows)
+    if args.output:
+        df.to_csv(args.output, index_label='index')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compression thread scaling benchmark')
+    parser.add_argument('--models', type=str, default='AlexNet,ResNet18', help='comma separated, from ModelSize')
+    parser.add_argument('--kernels', type=str, default='worker_gradient_executor,dgc,aji,server_gradient_filter',
+                        help='comma separated kernels to time')
+    parser.add_argument('--threads', type=str, default='',
+                        help='comma separated pool sizes (default: powers of two up to the core count)')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per point')
+    parser.add_argument('--rate', type=float, default=0.01, help='compression rate')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default='', help='write the curve to this csv')
+    main(parser.parse_args())
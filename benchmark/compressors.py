@@ -0,0 +1,147 @@
+"""
+Benchmark every registered gradient compressor on recorded or synthetic gradients.
+
+    python benchmark/compressors.py --models AlexNet,ResNet18 --steps 20
+    python benchmark/compressors.py --models ResNet18 --gradients resnet18_grads.pt --cuda
+
+A recorded gradient file holds a flat gradient tensor, or a list of them, as produced by
+torch.save(ravel_model_params(net, grads=True), path).
+"""
+import argparse
+import os
+import sys
+import time
+
+WORKPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(WORKPATH)
+
+import pandas as pd
+import torch
+
+from core.utils import constant
+from core.utils.compressor import COMPRESSORS, get_compressor
+from core.utils.messaging import ModelSize, message_bytes
+from core.utils.serialization import ravel_model_params
+from example.models import AlexNet, ResNet18
+
+MODELS = {'AlexNet': AlexNet, 'ResNet18': ResNet18}
+
+
+def synthetic_gradients(net, steps):
+    """gaussian gradients with one random scale per layer, layer scales span two orders of magnitude"""
+    gradients = []
+    for _ in range(steps):
+        layers = [torch.randn(p.data.numel()).mul_(10 ** (-3 + 2 * torch.rand(1).item())) for p in net.parameters()]
+        gradients.append(torch.cat(layers))
+    return gradients
+
+
+def load_gradients(path, numel):
+    gradients = torch.load(path, map_location='cpu')
+    if torch.is_tensor(gradients):
+        gradients = [gradients]
+    for gradient in gradients:
+        if gradient.numel() != numel:
+            raise ValueError('recorded gradient has %d elements, model has %d' % (gradient.numel(), numel))
+    return gradients
+
+
+def set_gradients(net, gradient):
+    current_index = 0
+    for param in net.parameters():
+        numel = param.data.numel()
+        if param.grad is None:
+            param.grad = torch.zeros_like(param.data)
+        param.grad.data.copy_(gradient[current_index:current_index + numel].view(param.data.size()))
+        current_index += numel
+
+
+def synchronize(cuda):
+    if cuda:
+        torch.cuda.synchronize()
+
+
+def benchmark(name, compressor_name, net, gradients, args):
+    compressor = get_compressor(compressor_name)([p.data.size() for p in net.parameters()], momentum=args.momentum,
+                                                 rate=args.rate, args=args)
+    compressor.init_state(net)
+    model_size = compressor.model_size
+    rows = []
+    for step, gradient in enumerate(gradients):
+        set_gradients(net, gradient.cuda() if args.cuda else gradient)
+        if hasattr(compressor, 'local_step'):
+            # the model delta is sent, the worker makes a local step first
+            compressor.local_step(net, args.lr)
+        synchronize(args.cuda)
+        start = time.time()
+        dense, message = compressor.compress(net, args.lr)
+        synchronize(args.cuda)
+        compress_time = time.time() - start
+        start = time.time()
+        decoded = compressor.decompress(message)
+        if decoded.is_sparse:
+            decoded = decoded.to_dense()
+        synchronize(args.cuda)
+        decompress_time = time.time() - start
+        # the header goes even with an empty message
+        wire_bytes = message_bytes(message)
+        rows.append({
+            'model': name,
+            'compressor': compressor_name,
+            'step': step,
+            'compress_ms': compress_time * 1000,
+            'decompress_ms': decompress_time * 1000,
+            'bytes': wire_bytes,
+            'ratio': model_size * 4.0 / wire_bytes,
+            'density': float(decoded.ne(0).sum()) / model_size,
+            'decode_error': float((decoded.to(dense.device) - dense).norm()),
+            'residual_norm': float(compressor.residual().norm()),
+            'gradient_norm': float(gradient.norm()),
+        })
+    return rows
+
+
+def main(args):
+    names = args.compressors.split(',') if args.compressors else sorted(COMPRESSORS)
+    rows = []
+    for name in args.models.split(','):
+        net = MODELS[name]()
+        if args.cuda:
+            net = net.cuda()
+        numel = ravel_model_params(net).numel()
+        if numel != ModelSize[name].value:
+            print('warning: %s has %d parameters, ModelSize says %d' % (name, numel, ModelSize[name].value))
+        constant.MODEL_SIZE = numel
+        if args.gradients:
+            gradients = load_gradients(args.gradients, numel)
+        else:
+            torch.manual_seed(args.seed)
+            gradients = synthetic_gradients(net, args.steps)
+        for compressor_name in names:
+            print('benchmarking %s on %s' % (compressor_name, name))
+            rows.extend(benchmark(name, compressor_name, net, gradients, args))
+    df = pd.DataFrame(rows)
+    summary = df[df['step'] >= args.warmup].groupby(['model', 'compressor']).mean().drop(columns=['step'])
+    pd.set_option('display.width', 200)
+    pd.set_option('display.max_columns', None)
+    print(summary)
+    if args.output:
+        df.to_csv(args.output, index_label='index')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Gradient compressor benchmark')
+    parser.add_argument('--models', type=str, default='AlexNet,ResNet18', help='comma separated, from ModelSize')
+    parser.add_argument('--compressors', type=str, default='',
+                        help='comma separated registered compressors (default: all of them)')
+    parser.add_argument('--gradients', type=str, default='', help='recorded gradients, synthetic if empty')
+    parser.add_argument('--steps', type=int, default=10, help='number of synthetic gradients')
+    parser.add_argument('--warmup', type=int, default=1, help='steps left out of the summary')
+    parser.add_argument('--rate', type=float, default=0.01, help='compression rate of the top-k compressors')
+    parser.add_argument('--lr', type=float, default=0.1, metavar='LR', help='learning rate (default: 0.1)')
+    parser.add_argument('--momentum', type=float, default=0.9, metavar='momentum', help='momentum (default: 0.9')
+    parser.add_argument('--powersgd-rank', type=int, default=4, help='rank of the P/Q factors in powersgd mode')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cuda', action='store_true', default=False, help='run the compressors on the GPU')
+    parser.add_argument('--output', type=str, default='', help='write every step to this csv')
+    main(parser.parse_args())
@@ -0,0 +1,116 @@
+"""
+Time to accuracy of delay compensated ASGD against plain ASGD on a simulated asynchronous run.
+
+Every simulated worker computes its gradient on the model it received last, the updates reach the ServerState in
+round robin, so every update is workers - 1 versions stale, as with equally fast workers. The students learn the
+labels of a random teacher network: one worker reaches 0.55 accuracy in about 140 updates, 16 workers in 160, 64
+workers only after about 2000, where the staleness shows. Every setting is run --repeats times from different seeds, the median time to the target and
+the mean final accuracy are reported.
+
+    python benchmark/dc_asgd.py --workers 1,64 --dc-lambda 0,8 --target 0.55 --repeats 3
+"""
+import argparse
+import os
+import sys
+import time
+
+WORKPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(WORKPATH)
+
+import pandas as pd
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from core.server import ServerState
+from core.utils.serialization import ravel_model_params, unravel_model_params
+
+
+def make_net(args):
+    return nn.Sequential(nn.Linear(args.features, args.hidden), nn.ReLU(), nn.Linear(args.hidden, args.classes))
+
+
+def make_data(args):
+    """labels of a random teacher network"""
+    teacher = make_net(args)
+    x = torch.randn(args.samples, args.features)
+    with torch.no_grad():
+        y = teacher(x).argmax(1)
+    return x, y
+
+
+def accuracy(net, x, y):
+    with torch.no_grad():
+        return float(net(x).argmax(1).eq(y).float().mean())
+
+
+def gradient(net, params, x, y):
+    unravel_model_params(net, params)
+    net.zero_grad()
+    F.cross_entropy(net(x), y).backward()
+    return ravel_model_params(net, grads=True).clone()
+
+
+def run(workers, dc_lambda, x, y, seed, args):
+    # not the seed of the teacher, which would be the starting model
+    torch.manual_seed(seed + 1)
+    net = make_net(args)
+    size_list = [p.data.numel() for p in net.parameters()]
+    state = ServerState(ravel_model_params(net).clone(), size_list, workers + 1, stripes=1, downlink=None,
+                        backups=bool(dc_lambda))
+    held = {worker: state.sync_worker(worker) for worker in range(1, workers + 1)}
+    start = time.time()
+    steps_to_target = None
+    seconds_to_target = None
+    acc = 0.0
+    for step in range(args.steps):
+        worker = step % workers + 1
+        batch = torch.randint(0, x.size(0), (args.batch_size,))
+        update = gradient(net, held[worker], x[batch], y[batch]).mul_(args.lr)
+        state.apply(update, worker=worker, compensation=dc_lambda / args.lr)
+        held[worker] = state.sync_worker(worker)
+        if step % args.eval_interval == 0:
+            unravel_model_params(net, state.global_model)
+            acc = accuracy(net, x, y)
+            if steps_to_target is None and acc >= args.target:
+                steps_to_target = step
+                seconds_to_target = time.time() - start
+    return {'workers': workers, 'dc_lambda': dc_lambda, 'seed': seed, 'steps_to_target': steps_to_target,
+            'seconds_to_target': seconds_to_target, 'final_accuracy': acc, 'seconds': time.time() - start}
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    x, y = make_data(args)
+    rows = []
+    for workers in [int(w) for w in args.workers.split(',')]:
+        for dc_lambda in [float(l) for l in args.dc_lambda.split(',')]:
+            runs = [run(workers, dc_lambda, x, y, args.seed + repeat, args) for repeat in range(args.repeats)]
+            rows.extend(runs)
+            runs = pd.DataFrame(runs)
+            print('workers {} lambda {}: target reached {}/{}, median {} steps ({:.2f} s), final accuracy {:.3f}'
+                  .format(workers, dc_lambda, int(runs['steps_to_target'].notnull().sum()), args.repeats,
+                          runs['steps_to_target'].median(), runs['seconds_to_target'].median(),
+                          runs['final_accuracy'].mean()))
+    df = pd.DataFrame(rows)
+    if args.output:
+        df.to_csv(args.output, index_label='index')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='DC-ASGD time to accuracy benchmark')
+    parser.add_argument('--workers', type=str, default='1,64', help='comma separated numbers of simulated workers')
+    parser.add_argument('--dc-lambda', type=str, default='0,8', help='comma separated lambdas, 0 is plain ASGD')
+    parser.add_argument('--lr', type=float, default=0.1, help='learning rate')
+    parser.add_argument('--steps', type=int, default=6000, help='updates applied to the server model')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--target', type=float, default=0.55, help='accuracy to reach')
+    parser.add_argument('--repeats', type=int, default=3, help='runs of every setting, from different seeds')
+    parser.add_argument('--eval-interval', type=int, default=20, help='updates between two evaluations')
+    parser.add_argument('--samples', type=int, default=20000)
+    parser.add_argument('--features', type=int, default=32)
+    parser.add_argument('--hidden', type=int, default=64)
+    parser.add_argument('--classes', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default='', help='write the results to this csv')
+    main(parser.parse_args())
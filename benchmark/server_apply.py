@@ -0,0 +1,146 @@
+"""
+Throughput of the server update path (apply the worker update, global - synced, top-k reply) with simulated
+workers hammering one ServerState from their own threads, as the GradientServer threads do.
+
+    python benchmark/server_apply.py --model AlexNet --workers 4,16,32 --stripes 1,16 --paths downlink,dense
+    python benchmark/server_apply.py --model ResNet18 --workers 32 --storage dense,sparse --half
+    python benchmark/server_apply.py --workers 16,32 --stripes 16 --paths downlink,shared --shared-window 8
+    python benchmark/server_apply.py --workers 4,16 --stripes 16 --paths model,half
+
+stripes 1 is a single lock around the whole model. The downlink path picks the reply among the indices touched
+since the last reply, the dense path is the former full-model global - synced - sent and top-k per message, the
+shared path reuses the top-k indices of the recent global change for --shared-window versions across workers.
+The model and half paths are the replies of asgd to dense updates: the whole fp32 model (--dense-wire float) or
+the fp16 change of the model against the fp16 backup of the worker model (--dense-wire half).
+bytes_per_worker is the server memory held for every worker after the run.
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+WORKPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(WORKPATH)
+
+import pandas as pd
+import torch
+
+from benchmark.compressors import MODELS
+from core.server import ServerState
+from core.utils.serialization import ravel_model_params, server_gradient_filter
+
+
+# downlink storage of the paths that have no choice of it, none for no downlink
+STORAGES = {'dense': 'none', 'model': 'none', 'half': 'none'}
+
+
+def sparse_update(numel, rate):
+    k = max(1, int(numel * rate))
+    # a copy, the slice would keep the whole permutation alive
+    indices = torch.randperm(numel)[:k].clone()
+    return torch.sparse_coo_tensor(indices.view(1, -1), torch.randn(k).mul_(1e-3), torch.Size([numel]))
+
+
+def simulate_worker(state, worker, size_list, updates, path, reply_times, args):
+    synced_model = state.global_model.clone()
+    if path == 'half':
+        # the backup taken when the worker gets the model
+        state.sync_worker(worker)
+    acc_send_grad = state.global_model.clone().zero_()
+    for step, update in enumerate(updates):
+        state.apply(update)
+        state.staleness.record(worker, step, 0)
+        if not args.filter:
+            continue
+        start = time.time()
+        if path == 'model':
+            state.sync_worker(worker)
+            reply_times.append(time.time() - start)
+        elif path == 'half':
+            state.take_dense(worker)
+            reply_times.append(time.time() - start)
+        elif path != 'dense':
+            state.take_downlink(worker, rate=args.rate)
+            reply_times.append(time.time() - start)
+        else:
+            send_grad = state.snapshot().add_(-1, synced_model).add_(-1, acc_send_grad)
+            server_gradient_filter(size_list, send_grad, rate=args.rate)
+            acc_send_grad.add_(send_grad)
+            reply_times.append(time.time() - start)
+
+
+def run(net, workers, stripes, path, storage, args):
+    size_list = [p.data.numel() for p in net.parameters()]
+    state = ServerState(ravel_model_params(net).clone(), size_list, workers + 1, stripes=stripes,
+                        downlink=storage if storage != 'none' else None, half=args.half,
+                        shared_window=args.shared_window if path == 'shared' else 0, personal_rate=args.personal_rate,
+                        reply_dtype=torch.half if path == 'half' else None)
+    numel = state.global_model.numel()
+    if path in ('model', 'half'):
+        # one dense update per worker, sent every step
+        updates = [[torch.randn(numel).mul_(1e-3)] * args.messages for _ in range(workers)]
+    else:
+        updates = [[sparse_update(numel, args.rate) for _ in range(args.messages)] for _ in range(workers)]
+    reply_times = []
+    threads = [threading.Thread(target=simulate_worker,
+                                args=(state, i + 1, size_list, updates[i], path, reply_times, args))
+               for i in range(workers)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    if path not in ('dense', 'model'):
+        bytes_per_worker = state.memory_report()['bytes_per_worker']
+    elif path == 'model':
+        # the copy of the model sent
+        bytes_per_worker = numel * 4
+    else:
+        # acc_send_grad, send_grad and agg_gradient, synced_model is shared
+        bytes_per_worker = 3 * numel * 4
+    return {'path': path, 'storage': STORAGES.get(path, storage), 'workers': workers,
+            'bytes_per_worker': bytes_per_worker, 'stripes': len(state.stripes), 'messages': workers * args.messages,
+            'seconds': elapsed, 'updates_per_s': workers * args.messages / elapsed,
+            'reply_ms': 1000.0 * sum(reply_times) / max(len(reply_times), 1)}
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    net = MODELS[args.model]()
+    rows = []
+    for workers in [int(w) for w in args.workers.split(',')]:
+        for stripes in [int(s) for s in args.stripes.split(',')]:
+            for path in args.paths.split(','):
+                for storage in (args.storage.split(',') if path not in STORAGES else [STORAGES[path]]):
+                    rows.append(run(net, workers, stripes, path, storage, args))
+                    rows[-1]['model'] = args.model
+                    print('{model} {path} {storage} workers {workers} stripes {stripes}: {updates_per_s:.1f} '
+                          'updates/s, {reply_ms:.2f} ms per reply, {bytes_per_worker:.0f} bytes per worker'
+                          .format(**rows[-1]))
+    df = pd.DataFrame(rows)
+    if args.output:
+        df.to_csv(args.output, index_label='index')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Server update throughput benchmark')
+    parser.add_argument('--model', type=str, default='AlexNet', help='AlexNet or ResNet18')
+    parser.add_argument('--workers', type=str, default='4,16,32', help='comma separated numbers of simulated workers')
+    parser.add_argument('--stripes', type=str, default='1,4,16,64', help='comma separated numbers of lock stripes')
+    parser.add_argument('--paths', type=str, default='downlink,dense',
+                        help='comma separated reply paths (downlink, shared, dense, model, half)')
+    parser.add_argument('--storage', type=str, default='sparse',
+                        help='comma separated downlink storages (dense, sparse) of the downlink path')
+    parser.add_argument('--shared-window', type=int, default=8, help='versions a shared reply is reused')
+    parser.add_argument('--personal-rate', type=float, default=0,
+                        help='fraction of the reply rate chosen per worker on the shared path')
+    parser.add_argument('--half', action='store_true', default=False, help='fp16 downlink values')
+    parser.add_argument('--messages', type=int, default=20, help='updates sent by every worker')
+    parser.add_argument('--rate', type=float, default=0.01, help='density of the updates and of the replies')
+    parser.add_argument('--no-filter', dest='filter', action='store_false', default=True,
+                        help='only apply the updates, skip the top-k reply')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default='', help='write the results to this csv')
+    main(parser.parse_args())
@@ -0,0 +1,217 @@
+"""
+Thread per worker against one event loop with a small pool on the server, over gloo between processes.
+
+One server process runs a GradientServer per worker, as example/main.py does: in the threads design every
+GradientServer receives its worker's messages on its own thread, in the event design a MessageLoop starts an irecv
+for every message announced on the arrival queue and hands it to a pool of --pool threads. Every worker process
+gets the model, then sends sparse top-k messages with send_message and waits for each reply, the top-k of its
+downlink. The message sizes go through the queues of a QueueManager like in training. With --coalesce-windows the
+updates arriving together are summed and applied in one pass, mean_batch is the number of updates per pass.
+
+    python benchmark/server_loop.py --model AlexNet --workers 4,16 --pool 4
+    python benchmark/server_loop.py --designs threads --workers 16 --coalesce-windows 0,1,2
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+WORKPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(WORKPATH)
+
+import pandas as pd
+import torch
+import torch.distributed as dist
+
+from benchmark.compressors import MODELS
+from benchmark.server_apply import sparse_update
+from core.server import GradientServer, ServerState
+from core.utils.messaging import GSMessageCode, MessageLoop, QueueManager, send_message, _get_queue, queue_name, \
+    arrival_name
+from core.utils.serialization import ravel_model_params, ravel_sparse_values
+
+AUTHKEY = b'abc'
+
+
+def start_queues(workers, port):
+    """manager of the size queues between the server (rank 0) and the workers"""
+    for worker in range(1, workers + 1):
+        for name in (queue_name(0, worker), queue_name(worker, 0)):
+            QueueManager.register(name, callable=partial(_get_queue, name))
+    QueueManager.register(arrival_name(0), callable=partial(_get_queue, arrival_name(0)))
+    manager = QueueManager(address=('127.0.0.1', port), authkey=AUTHKEY)
+    manager.start()
+    return manager
+
+
+def connect_queues(rank, workers, design, port):
+    """the queues of rank as GradientMessageListener connects them"""
+    manager = QueueManager(address=('127.0.0.1', port), authkey=AUTHKEY)
+    manager.connect()
+    QueueManager.manager = manager
+    peers = range(1, workers + 1) if rank == 0 else [0]
+    for peer in peers:
+        QueueManager.send_queue_list[peer] = getattr(manager, queue_name(rank, peer))()
+        QueueManager.recv_queue_list[peer] = getattr(manager, queue_name(peer, rank))()
+    if design == 'event':
+        if rank == 0:
+            QueueManager.arrival_queue = getattr(manager, arrival_name(0))()
+        else:
+            QueueManager.send_queue_list[0] = getattr(manager, arrival_name(0))()
+            QueueManager.arrivals.add(0)
+
+
+def init_process(rank, workers, path):
+    torch.set_num_threads(1)
+    dist.init_process_group('gloo', init_method='file://%s' % os.path.join(path, 'sharedfile'), world_size=workers + 1,
+                            rank=rank)
+
+
+def receive_reply():
+    """next message of the server, received like GradientMessageListener.run does"""
+    size, wire_type = QueueManager.get_size(0)
+    if wire_type is not None:
+        header = torch.zeros(4).double()
+        payload = torch.zeros(size, dtype=wire_type)
+        dist.recv(tensor=header, src=0)
+        dist.recv(tensor=payload, src=0)
+        return payload
+    message = torch.zeros(size + 4).double()
+    dist.recv(tensor=message, src=0)
+    return message[4:]
+
+
+def serve(net, workers, design, window, path, results, args):
+    init_process(0, workers, path)
+    connect_queues(0, workers, design, args.port)
+    # the float64 replies are printed by send_message
+    sys.stdout = open(os.devnull, 'w')
+    size_list = [p.data.numel() for p in net.parameters()]
+    shape_list = [p.data.size() for p in net.parameters()]
+    state = ServerState(ravel_model_params(net).clone(), size_list, workers + 1, stripes=args.stripes,
+                        sync_interval=0, coalesce_window=window / 1000.0, coalesce_max=args.coalesce_max)
+    server_args = argparse.Namespace(mode='gradient_sgd', lr=0.1, dense_wire='float', dc_lambda=0,
+                                     snapshot_interval=0, staleness_log='', server_loop=design,
+                                     world_size=workers + 1)
+    servers = []
+    for worker in range(1, workers + 1):
+        server = GradientServer(model=net, rank=worker, worker_num=workers + 1, state=state, size_list=size_list,
+                                shape_list=shape_list, args=server_args)
+        # the process ends with the run, the receiving threads are left blocked
+        server.daemon = True
+        servers.append(server)
+    if design == 'threads':
+        for server in servers:
+            server.start()
+    else:
+        pool = args.pool if not window else max(args.pool, min(args.coalesce_max, workers))
+        loop = MessageLoop({server.source: server for server in servers}, ThreadPoolExecutor(pool))
+        loop.daemon = True
+        loop.start()
+    # the workers leave once done
+    while state.members:
+        time.sleep(0.05)
+    results.put(('server', state.coalescer.report()['mean_batch'] if state.coalescer is not None else 1.0))
+
+
+def simulate_worker(worker, workers, design, messages, path, start, results, args):
+    init_process(worker, workers, path)
+    connect_queues(worker, workers, design, args.port)
+    # the model sent when the GradientServer starts, to one worker after the other
+    receive_reply()
+    start.wait()
+    latencies = []
+    begin = time.time()
+    for step in range(args.messages):
+        if args.compute_ms:
+            time.sleep(args.compute_ms / 1000.0)
+        sent = time.time()
+        send_message(GSMessageCode.SparseGradientUpdate, messages[step % len(messages)], dst=0,
+                     gradient_version=step + 1, lr=0.1)
+        receive_reply()
+        latencies.append(time.time() - sent)
+    elapsed = time.time() - begin
+    send_message(GSMessageCode.WorkerLeave, torch.zeros(1), dst=0, gradient_version=args.messages + 1)
+    results.put(('worker', latencies, elapsed))
+
+
+def run(net, workers, design, window, args):
+    numel = sum(p.data.numel() for p in net.parameters())
+    # a few distinct messages of every worker sent in turn, built before the fork, one at a time
+    messages = {}
+    for worker in range(1, workers + 1):
+        updates = [sparse_update(numel, args.rate) for _ in range(min(args.messages, args.distinct))]
+        messages[worker] = [ravel_sparse_values(update._indices(), update._values()) for update in updates]
+    path = tempfile.mkdtemp(prefix='server_loop')
+    manager = start_queues(workers, args.port)
+    context = multiprocessing.get_context('fork')
+    start = context.Barrier(workers)
+    results = context.Queue()
+    processes = [context.Process(target=serve, args=(net, workers, design, window, path, results, args))]
+    processes += [context.Process(target=simulate_worker,
+                                   args=(worker, workers, design, messages[worker], path, start, results, args))
+                  for worker in range(1, workers + 1)]
+    for process in processes:
+        process.start()
+    latencies = []
+    elapsed = 0
+    mean_batch = 1.0
+    for _ in processes:
+        result = results.get()
+        if result[0] == 'server':
+            mean_batch = result[1]
+        else:
+            latencies += result[1]
+            elapsed = max(elapsed, result[2])
+    for process in processes:
+        process.join()
+    manager.shutdown()
+    shutil.rmtree(path)
+    latency = torch.tensor(latencies).mul_(1000)
+    return {'design': design, 'workers': workers, 'coalesce_window_ms': window, 'mean_batch': mean_batch,
+            'messages_per_s': workers * args.messages / elapsed,
+            'latency_p50_ms': float(latency.median()), 'latency_p99_ms': float(latency.kthvalue(
+                max(1, int(latency.numel() * 0.99))).values), 'server_threads': workers if design == 'threads'
+            else args.pool + 1}
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    net = MODELS[args.model]()
+    rows = []
+    for workers in [int(w) for w in args.workers.split(',')]:
+        for design in args.designs.split(','):
+            for window in [float(w) for w in args.coalesce_windows.split(',')]:
+                rows.append(run(net, workers, design, window, args))
+                rows[-1]['model'] = args.model
+                print('{model} {design} workers {workers} window {coalesce_window_ms} ms: {messages_per_s:.1f} '
+                      'messages/s, latency p50 {latency_p50_ms:.1f} ms p99 {latency_p99_ms:.1f} ms, mean batch '
+                      '{mean_batch:.2f}'.format(**rows[-1]))
+    df = pd.DataFrame(rows)
+    if args.output:
+        df.to_csv(args.output, index_label='index')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Server receive loop benchmark')
+    parser.add_argument('--model', type=str, default='AlexNet', help='AlexNet or ResNet18')
+    parser.add_argument('--workers', type=str, default='4,16', help='comma separated numbers of worker processes')
+    parser.add_argument('--designs', type=str, default='threads,event', help='comma separated server designs')
+    parser.add_argument('--pool', type=int, default=4, help='pool threads of the event design')
+    parser.add_argument('--stripes', type=int, default=16, help='lock stripes of the server model')
+    parser.add_argument('--coalesce-windows', type=str, default='0',
+                        help='comma separated ms an update waits for others to be applied with, 0 for none')
+    parser.add_argument('--coalesce-max', type=int, default=8, help='largest number of updates applied together')
+    parser.add_argument('--messages', type=int, default=20, help='messages sent by every worker')
+    parser.add_argument('--distinct', type=int, default=4, help='distinct messages of every worker, sent in turn')
+    parser.add_argument('--compute-ms', type=float, default=0, help='simulated compute time of a worker step')
+    parser.add_argument('--rate', type=float, default=0.01, help='density of the updates')
+    parser.add_argument('--port', type=int, default=5100, help='port of the queue manager')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default='', help='write the results to this csv')
+    main(parser.parse_args())
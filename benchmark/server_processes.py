@@ -0,0 +1,126 @@
+"""
+Throughput of one shard served by several processes on a shared memory-mapped model.
+
+Every process serves its part of the simulated workers from its own threads: apply the sparse update of the
+worker, then take its top-k reply from the downlink, which follows the changes of the other processes through the
+shared update ring. messages_per_s is the total over all processes, lost counts the workers that fell behind the
+ring and would get the full model. The processes only scale with cores to run on, the cores available are reported
+with every result.
+
+    python benchmark/server_processes.py --model AlexNet --workers 32 --procs 1,2,4
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+WORKPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(WORKPATH)
+
+import pandas as pd
+import torch
+
+from benchmark.compressors import MODELS
+from benchmark.server_apply import sparse_update
+from core.server import ServerState
+from core.utils.serialization import ravel_model_params
+
+
+def serve(process, procs, workers, size_list, path, start, results, args):
+    torch.set_num_threads(1)
+    torch.manual_seed(args.seed + process)
+    served = [worker for worker in range(1, workers + 1) if (worker - 1) % procs == process]
+    state = ServerState(torch.zeros(sum(size_list)), size_list, workers + 1, stripes=args.stripes, workers=served,
+                        shared_path=path, leader=False, ring_capacity=args.ring_capacity)
+    numel = state.global_model.numel()
+    updates = {worker: [sparse_update(numel, args.rate) for _ in range(args.messages)] for worker in served}
+    lost = []
+
+    def simulate_worker(worker):
+        for update in updates[worker]:
+            state.apply(update, worker=worker)
+            if state.take_lost(worker):
+                lost.append(worker)
+                state.sync_worker(worker)
+            else:
+                state.take_downlink(worker, rate=args.rate)
+
+    threads = [threading.Thread(target=simulate_worker, args=(worker,)) for worker in served]
+    start.wait()
+    begin = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put((len(served) * args.messages, time.time() - begin, len(lost)))
+
+
+def run(net, workers, procs, args):
+    size_list = [p.data.numel() for p in net.parameters()]
+    path = tempfile.mkdtemp(prefix='server_shard')
+    # the leader creates the shared files, the processes open them
+    ServerState(ravel_model_params(net).clone(), size_list, workers + 1, stripes=args.stripes, workers=[1],
+                shared_path=path, leader=True, ring_capacity=args.ring_capacity)
+    context = multiprocessing.get_context('fork')
+    start = context.Event()
+    results = context.Queue()
+    processes = [context.Process(target=serve, args=(process, procs, workers, size_list, path, start, results, args))
+                 for process in range(procs)]
+    for process in processes:
+        process.start()
+    # let the processes build their updates
+    time.sleep(args.warmup)
+    start.set()
+    counts = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    shutil.rmtree(path)
+    messages = sum(count[0] for count in counts)
+    elapsed = max(count[1] for count in counts)
+    return {'workers': workers, 'procs': procs, 'messages_per_s': messages / elapsed,
+            'lost': sum(count[2] for count in counts)}
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    net = MODELS[args.model]()
+    cores = available_cores()
+    procs_list = [int(p) for p in args.procs.split(',')]
+    if max(procs_list) > cores:
+        print('only %d cores available, the processes above it share them and do not measure the scaling' % cores)
+    rows = []
+    for workers in [int(w) for w in args.workers.split(',')]:
+        for procs in procs_list:
+            rows.append(run(net, workers, procs, args))
+            rows[-1]['model'] = args.model
+            rows[-1]['cores'] = cores
+            print('{model} workers {workers} processes {procs} cores {cores}: {messages_per_s:.1f} messages/s, '
+                  '{lost} lost'.format(**rows[-1]))
+    df = pd.DataFrame(rows)
+    if args.output:
+        df.to_csv(args.output, index_label='index')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Server processes per shard benchmark')
+    parser.add_argument('--model', type=str, default='AlexNet', help='AlexNet or ResNet18')
+    parser.add_argument('--workers', type=str, default='32', help='comma separated numbers of simulated workers')
+    parser.add_argument('--procs', type=str, default='1,2,4', help='comma separated numbers of server processes')
+    parser.add_argument('--stripes', type=int, default=16, help='lock stripes of the server model')
+    parser.add_argument('--ring-capacity', type=int, default=2 ** 18, help='entries per stripe of the update ring')
+    parser.add_argument('--messages', type=int, default=20, help='messages sent by every worker')
+    parser.add_argument('--rate', type=float, default=0.01, help='density of the updates and replies')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds given to the processes to start')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default='', help='write the results to this csv')
+    main(parser.parse_args())
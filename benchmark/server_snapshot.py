@@ -0,0 +1,92 @@
+"""
+Cost of the background snapshots for the threads applying updates to a ServerState.
+
+Simulated workers apply sparse updates from their own threads while a snapshot of the model is requested every
+--interval seconds. The latency of every apply is recorded, with and without snapshots, so the pause the writer
+causes shows in the tail.
+
+    python benchmark/server_snapshot.py --model AlexNet --workers 16 --stripes 1,16
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+WORKPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(WORKPATH)
+
+import pandas as pd
+import torch
+
+from benchmark.compressors import MODELS
+from benchmark.server_apply import sparse_update
+from core.server import ServerState
+from core.utils.snapshot import ModelSnapshot
+from core.utils.serialization import ravel_model_params
+
+
+def simulate_worker(state, updates, latencies):
+    for update in updates:
+        start = time.time()
+        state.apply(update)
+        latencies.append(time.time() - start)
+
+
+def run(net, workers, stripes, snapshot, args):
+    size_list = [p.data.numel() for p in net.parameters()]
+    path = tempfile.mkdtemp(prefix='server_snapshot')
+    global_model = ravel_model_params(net).clone()
+    snapshots = ModelSnapshot(path, global_model.numel()) if snapshot else None
+    state = ServerState(global_model, size_list, workers + 1, stripes=stripes, downlink=None, snapshots=snapshots)
+    numel = state.global_model.numel()
+    updates = [[sparse_update(numel, args.rate) for _ in range(args.messages)] for _ in range(workers)]
+    latencies = [[] for _ in range(workers)]
+    threads = [threading.Thread(target=simulate_worker, args=(state, updates[i], latencies[i]))
+               for i in range(workers)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        if snapshots is not None:
+            state.save_snapshot()
+        time.sleep(args.interval)
+    elapsed = time.time() - start
+    shutil.rmtree(path)
+    latency = torch.tensor([l for worker_latencies in latencies for l in worker_latencies]).mul_(1000)
+    return {'workers': workers, 'stripes': len(state.stripes), 'snapshots': snapshots.written if snapshot else 0,
+            'snapshot_s': snapshots.seconds / max(snapshots.written, 1) if snapshot else 0.0,
+            'updates_per_s': workers * args.messages / elapsed, 'apply_p50_ms': float(latency.median()),
+            'apply_max_ms': float(latency.max())}
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    net = MODELS[args.model]()
+    rows = []
+    for workers in [int(w) for w in args.workers.split(',')]:
+        for stripes in [int(s) for s in args.stripes.split(',')]:
+            for snapshot in (False, True):
+                rows.append(run(net, workers, stripes, snapshot, args))
+                rows[-1]['model'] = args.model
+                print('{model} workers {workers} stripes {stripes} snapshots {snapshots}: {updates_per_s:.1f} '
+                      'updates/s, apply p50 {apply_p50_ms:.2f} ms max {apply_max_ms:.2f} ms, {snapshot_s:.3f} s '
+                      'per snapshot'.format(**rows[-1]))
+    df = pd.DataFrame(rows)
+    if args.output:
+        df.to_csv(args.output, index_label='index')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Server snapshot benchmark')
+    parser.add_argument('--model', type=str, default='AlexNet', help='AlexNet or ResNet18')
+    parser.add_argument('--workers', type=str, default='16', help='comma separated numbers of simulated workers')
+    parser.add_argument('--stripes', type=str, default='1,16', help='comma separated numbers of lock stripes')
+    parser.add_argument('--messages', type=int, default=50, help='updates sent by every worker')
+    parser.add_argument('--rate', type=float, default=0.01, help='density of the updates')
+    parser.add_argument('--interval', type=float, default=0.05, help='seconds between two snapshot requests')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default='', help='write the results to this csv')
+    main(parser.parse_args())
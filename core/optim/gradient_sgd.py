@@ -3,62 +3,134 @@ import os
 import sys
 import threading
 import time
-from queue import Queue
+from collections import deque
+from queue import Empty, Queue
 
+import torch
 import torch.distributed as dist
 from torch.optim.optimizer import Optimizer, required
 
-from core.utils.messaging import send_message, GSMessageCode, GradientMessageListener
+from core.utils.messaging import send_message, GSMessageCode, GradientMessageListener, WIRE_TYPES
+from core.utils.compressor import COMPRESSORS, get_compressor
+from core.utils.density import RateController, LayerDensityAllocator
+from core.utils.membership import Heartbeat
 from core.utils.serialization import ravel_model_params, update_model_params, unravel_model_params, \
-    ravel_sparse_gradient, unravel_sparse_gradient, worker_gradient_executor, DGC, Aji
+    unravel_sparse_gradient, compression_executor, momentum_step
+from core.utils.sharding import worker_servers, process_group_size, shard_ranges, split_sparse_gradient
 
 WORKPATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 sys.path.append(WORKPATH)
 print(WORKPATH)
 _LOGGER = logging.getLogger(__name__)
-lock = threading.Lock()
 
 
 class GradientListener(GradientMessageListener):
-    """DownpourListener"""
+    """DownpourListener
 
-    def __init__(self, model, queue, args=None):
-        super(GradientListener, self).__init__(ravel_model_params(model).numel(), source=0, args=args)
+    listens to one server, the server owns the slice [offset, offset + size) of the flat model. The replies are
+    decoded into a staging buffer on the listener thread and only reach the model when the optimizer takes them
+    between two steps, so a reply never changes the model during a forward or backward pass.
+    """
+
+    def __init__(self, model, queue, source=0, offset=0, size=None, args=None):
+        if size is None:
+            size = ravel_model_params(model).numel()
+        super(GradientListener, self).__init__(size, source=source, args=args)
+        self.offset = offset
+        self.size = size
         self.lr = 0.05
         self.queue = queue
         self.version = 0
         self.model = model
         self.flag = False
+        device = next(model.parameters()).device
+        # the listener adds the deltas to staging[active] while the optimizer applies the other buffer
+        self.lock = threading.Lock()
+        self.staging = [torch.zeros(size, device=device), torch.zeros(size, device=device)]
+        self.active = 0
+        self.staged = False
+        # model slice of the last ModelUpdate, it replaces the slice before the deltas after it are added
+        self.synced = None
+        # asgd with a half or bf16 dense wire: the server replies with the change against its backup of the slice
+        # in that type, the slice is kept in the same type and the changes are added like on the server
+        self.mirror_dtype = None
+        if args is not None and args.mode == 'asgd' and args.dense_wire != 'float':
+            self.mirror_dtype = WIRE_TYPES[args.dense_wire]
+        self.mirror = None
+
+    def stage(self, delta):
+        with self.lock:
+            self.staging[self.active].add_(delta.to(self.staging[self.active].device))
+            self.staged = True
+
+    def replace(self, synced):
+        """the model slice becomes synced, the deltas staged before it are dropped"""
+        with self.lock:
+            # the model of the server already holds the deltas staged before it
+            self.synced = synced
+            self.staging[self.active].zero_()
+            self.staged = False
+
+    def take(self):
+        """
+        Swap the staging buffers.
+        :return: model slice to copy or None, summed delta or None
+        """
+        with self.lock:
+            synced, self.synced = self.synced, None
+            if not self.staged:
+                return synced, None
+            delta = self.staging[self.active]
+            self.active = 1 - self.active
+            self.staged = False
+            return synced, delta
+
+    def apply_staged(self):
+        """apply the replies staged since the last call to the model, called by the optimizer between two steps"""
+        synced, delta = self.take()
+        if synced is not None:
+            unravel_model_params(self.model, synced, offset=self.offset)
+        if delta is not None:
+            update_model_params(self.model, delta, -1, offset=self.offset)
+            delta.zero_()
 
     def receive(self, sender, message_code, gradient_version, lr, parameter):
-        """receive parameter updates from the server and reflect them into the client's model."""
+        """receive parameter updates from the server and stage them for the client's model."""
         _LOGGER.info("Processing message: {}, version: {}, lr: {}".format(message_code.name, gradient_version, self.lr))
         # print("Processing message: {}, version: {}, lr: {}".format(message_code.name, gradient_version, lr))
         self.lr = lr
         if message_code == GSMessageCode.GradientUpdate:
-            update_model_params(self.model, parameter, -1)
+            if self.mirror is not None:
+                # the same rounding as the backup of the server
+                self.mirror.copy_(self.mirror.float().add_(parameter.float().to(self.mirror.device)))
+                self.replace(self.mirror.float())
+            else:
+                # dense delta, fp16 on the wire for catch-ups
+                self.stage(parameter.float())
             self.version = gradient_version
-            self.queue.put(gradient_version)
+            self.queue.put((gradient_version, time.time()))
         elif message_code == GSMessageCode.SparseGradientUpdate:
-            parameter = unravel_sparse_gradient(parameter).cuda().to_dense()
-            update_model_params(self.model, parameter, -1)
+            self.stage(unravel_sparse_gradient(parameter, self.size))
             # print('4',parameter.sum())
 
             self.version = gradient_version
-            self.queue.put(gradient_version)
+            self.queue.put((gradient_version, time.time()))
         elif message_code == GSMessageCode.ModelRequest:
-            model = ravel_model_params(self.model, grads=False)
-            send_message(GSMessageCode.ModelUpdate, model, dst=0, gradient_version=0)
+            model = ravel_model_params(self.model, grads=False)[self.offset:self.offset + self.size]
+            send_message(GSMessageCode.ModelUpdate, model, dst=self.source, gradient_version=0)
             print('send model to server')
         elif message_code == GSMessageCode.ModelUpdate:
             # print('sync model!', gradient_version, ' ', datetime.now(), ' synced model :', parameter.sum())
-            unravel_model_params(self.model, parameter)
+            synced = parameter.float().to(self.staging[0].device)
+            if self.mirror_dtype is not None:
+                # sent rounded to the type of the backup
+                self.mirror = synced.to(self.mirror_dtype)
+            self.replace(synced)
             self.version = gradient_version
             self.flag = True
             # TODO change back
             if self.version > 1:
-                self.queue.put(gradient_version)
-            # lock.release()
+                self.queue.put((gradient_version, time.time()))
 
 
 class GradientSGD(Optimizer):
@@ -79,20 +151,66 @@ class GradientSGD(Optimizer):
         self.model = model
         self.filter_gradient = ravel_model_params(model)
         self.momentum = momentum
-        self.v_kt = self.filter_gradient.clone().zero_()
-        self.u_kt = self.filter_gradient.clone().zero_()
+        self.compressor = None
+        if args.mode in COMPRESSORS:
+            self.compressor = get_compressor(args.mode)([p.data.size() for p in model.parameters()],
+                                                        momentum=momentum, weight_decay=weight_decay, args=args,
+                                                        executor=compression_executor(args.compress_threads))
+            self.compressor.init_state(model)
+            self.filter_gradient = self.compressor.payload
+            self.u_kt = self.compressor.u_kt
+            self.v_kt = self.compressor.v_kt
+        else:
+            self.v_kt = self.filter_gradient.clone().zero_()
+            self.u_kt = self.filter_gradient.clone().zero_()
         self.idx = 0
         self.version = 0
-        self.queue = Queue(maxsize=1)
+        # the process serving this worker in every shard
+        self.servers = worker_servers(args, args.rank)
+        self.shards = shard_ranges([p.data.numel() for p in model.parameters()], args.num_servers)
+        if args.num_servers > 1 and args.mode != 'asgd' and (
+                self.compressor is None or self.compressor.message_code != GSMessageCode.SparseGradientUpdate):
+            raise Exception('mode %s can not be sharded, use asgd or a top-k mode with --num-servers' % args.mode)
+        if args.mode == 'local_sgd' and args.outstanding > 1:
+            raise Exception('local_sgd waits for the merged delta before the next local steps, use --outstanding 1')
+        # one reply per server and step, up to --outstanding steps in flight
+        self.queue = Queue(maxsize=len(self.servers) * args.outstanding)
+        # send times of the steps not answered by every server yet
+        self.outstanding = deque()
+        self.replies = 0
+        self.pipeline_stats = {'wait_seconds': 0.0, 'round_trip_seconds': 0.0, 'wait_saved_seconds': 0.0}
+        self.apply_seconds = 0.0
+        self.listeners = []
         if args.rank > 0:
             time.sleep(0.1 * int(args.rank))
             dist.init_process_group('gloo', init_method='file://%s/sharedfile' % WORKPATH, group_name='mygroup',
-                                    world_size=args.world_size, rank=args.rank)
+                                    world_size=process_group_size(args), rank=args.rank)
             print('I am node rank:%d' % dist.get_rank())
-            self.listener = GradientListener(model, self.queue, args=args)
-            self.listener.start()
+            for server, (start, end) in zip(self.servers, self.shards):
+                listener = GradientListener(model, self.queue, source=server, offset=start, size=end - start,
+                                            args=args)
+                listener.start()
+                self.listeners.append(listener)
+            self.listener = self.listeners[0]
+            if args.join_delay:
+                self.join(args.join_delay)
+            if args.heartbeat_timeout:
+                Heartbeat(args.rank, args.heartbeat_timeout / 4.0).start()
         self.tmp = 0
+        # per epoch rate schedule set by the training script, the ceiling of the adaptive rate, or with
+        # --rate-schedule the rate of the compressor
         self.compress_ratio = None
+        self.rate = None
+        self.rate_controller = None
+        if args.adaptive_rate and self.compressor is not None:
+            self.rate_controller = RateController(rate=self.compressor.rate, min_rate=args.min_rate,
+                                                  max_rate=args.max_rate, bound=args.overlap_bound)
+        self.density_allocator = None
+        if args.layer_density and (self.compressor is None or not self.compressor.layer_rates):
+            raise Exception('--layer-density needs a top-k mode (gradient_sgd, dgc, aji), not %s' % args.mode)
+        if args.layer_density:
+            self.density_allocator = LayerDensityAllocator(self.compressor.size_list, min_rate=args.min_rate)
+        self.step_end = time.time()
         self.weight_decay = weight_decay
         print('weight_decay', self.weight_decay, 'lr', lr, 'momentum', self.momentum)
         self.args = args
@@ -108,10 +226,11 @@ class GradientSGD(Optimizer):
         loss = None
         if closure is not None:
             loss = closure()
-        if not self.listener.flag:
-            while not self.args.no_distributed and not self.listener.flag:
+        if not all(listener.flag for listener in self.listeners):
+            while not self.args.no_distributed and not all(listener.flag for listener in self.listeners):
                 print('wait for server')
                 time.sleep(1)
+            self.apply_replies()
             return loss
 
         # get the lr
@@ -128,54 +247,39 @@ class GradientSGD(Optimizer):
         # lr = self.param_groups[0]['lr']
         # keep track of accumulated gradients so that we can send
         # ASYNC
+        message_code = GSMessageCode.SparseGradientUpdate
         if self.args.mode == 'asgd':
             # print('Running asgd')
             for param in self.model.parameters():
                 if self.weight_decay != 0:
                     param.grad.data.add_(self.weight_decay, param.data)
             self.filter_gradient = ravel_model_params(self.model, grads=True, cuda=True).mul_(lr)
-
-            send_message(GSMessageCode.GradientUpdate, self.filter_gradient, dst=0,
-                         gradient_version=self.listener.version + 1)
-            self.version = self.queue.get()
+            self.send_dense(self.filter_gradient, lr=lr)
+            self.collect_replies()
             self.idx += 1
             return loss
-        elif self.args.mode == 'gradient_sgd':
-            # if self.version < 5:
-            #     print('Running gradient_sgd')
-
-            raveled_gradients = worker_gradient_executor(self.model, self.filter_gradient, self.u_kt, self.v_kt,
-                                                         rate=0.01 * (lr / self.args.lr),
-                                                         lr=lr, momentum=self.momentum, weight_decay=self.weight_decay)
-            # print(1,raveled_gradients.sum())
-            sparse_gradient = ravel_sparse_gradient(raveled_gradients)
-
-        elif self.args.mode == 'dgc':
-            # if self.version < 5:
-            #     print('Running dgc')
-            raveled_gradients = DGC(self.model, self.filter_gradient, self.u_kt, self.v_kt,
-                                    rate=0.01,
-                                    # rate=self.compress_ratio,
-                                    lr=lr, momentum=self.momentum, weight_decay=self.weight_decay)
-            sparse_gradient = ravel_sparse_gradient(raveled_gradients)
-        elif self.args.mode == 'aji':
-            # if self.version < 5:
-            #     print('Running aji ', self.version)
-            raveled_gradients = Aji(self.model, self.filter_gradient, self.u_kt, self.v_kt,
-                                    rate=0.01,
-                                    lr=lr, weight_decay=self.weight_decay)
-            sparse_gradient = ravel_sparse_gradient(raveled_gradients)
+        elif self.args.mode == 'local_sgd':
+            self.compressor.local_step(self.model, lr)
+            if (self.idx + 1) % self.args.local_steps != 0:
+                self.idx += 1
+                return loss
+            self.rate = self.get_rate(lr)
+            raveled_gradients, sparse_gradient = self.compressor.compress(self.model, lr, rate=self.rate)
+            message_code = self.compressor.message_code
+        elif self.compressor is not None:
+            self.rate = self.get_rate(lr)
+            rate = self.rate
+            if self.density_allocator is not None:
+                rate = self.density_allocator.allocate(self.rate, self.model, lr)
+            raveled_gradients, sparse_gradient = self.compressor.compress(self.model, lr, rate=rate)
+            if self.density_allocator is not None:
+                self.density_allocator.observe(raveled_gradients, self.compressor.residual(),
+                                               self.compressor.residual_scale(lr))
+            message_code = self.compressor.message_code
         elif self.args.mode == 'sgd':
             # if self.version < 5:
             #     print('Running sgd')
-            weight_decay = self.weight_decay
-            momentum = self.momentum
-            dampening = 0
-            nesterov = 0
-            g = ravel_model_params(self.model, grads=True)
-            p = ravel_model_params(self.model, grads=False)
-            g.add_(weight_decay, p)
-            self.u_kt.mul_(momentum).add_(g)
+            momentum_step(self.model, self.u_kt, momentum=self.momentum, weight_decay=self.weight_decay)
             raveled_gradients = self.u_kt.mul(lr)
         else:
             raise Exception('no optimizer')
@@ -184,10 +288,131 @@ class GradientSGD(Optimizer):
             # parameter = unravel_sparse_gradient(sparse_gradient).cuda()
             update_model_params(self.model, raveled_gradients, 1)
             # self.version = gradient_version
-            self.queue.put(self.idx)
+            self.queue.put((self.idx, time.time()))
         else:
-            send_message(GSMessageCode.SparseGradientUpdate, sparse_gradient, dst=0,
-                         gradient_version=self.listener.version + 1, lr=lr)
-        self.version = self.queue.get()
+            send_start = time.time()
+            if len(self.servers) > 1:
+                sparse_gradient = split_sparse_gradient(sparse_gradient, self.shards)
+            else:
+                sparse_gradient = [sparse_gradient]
+            self.send_to_servers(message_code, sparse_gradient, lr=lr)
+        self.collect_replies()
+        if self.args.mode == 'local_sgd':
+            self.compressor.rebase(self.model)
+        if self.rate_controller is not None and not self.args.no_distributed:
+            now = time.time()
+            self.rate_controller.update(send_start - self.step_end, now - send_start)
+        self.step_end = time.time()
         self.idx += 1
-        return loss
\ No newline at end of file
+        return loss
+
+    def join(self, delay):
+        """stay out of the training for delay seconds, then ask every server for the current model"""
+        while not all(listener.flag for listener in self.listeners):
+            time.sleep(1)
+        # the servers count the worker as a member from the start, the others must not wait for it meanwhile
+        for server in self.servers:
+            send_message(GSMessageCode.WorkerLeave, torch.zeros(1), dst=server, gradient_version=0)
+        print('joining the training in %.0f s' % delay)
+        time.sleep(delay)
+        for server in self.servers:
+            send_message(GSMessageCode.ModelRequest, torch.zeros(1), dst=server, gradient_version=0)
+        for _ in self.servers:
+            self.version, _ = self.queue.get()
+        self.apply_replies()
+        print('joined at step %d' % self.version)
+
+    def send_to_servers(self, message_code, pieces, lr=0.1):
+        """send one piece of the update to every server, the sends run in parallel"""
+        # the steps still in flight come before this one
+        ahead = len(self.outstanding) + 1
+        self.outstanding.append(time.time())
+        if len(pieces) == 1:
+            send_message(message_code, pieces[0], dst=self.servers[0],
+                         gradient_version=self.listener.version + ahead, lr=lr)
+            return
+        works = [send_message(message_code, piece, dst=listener.source, gradient_version=listener.version + ahead,
+                              lr=lr, async_op=True) for listener, piece in zip(self.listeners, pieces)]
+        for work in works:
+            work.wait()
+
+    def send_dense(self, update, lr=0.1):
+        """
+        Send the dense update to every server in buckets of --bucket-mb in the --dense-wire type. A bucket is on
+        the wire while the next one is converted, the server adds the buckets up in fp32 and applies the update
+        once they all arrived. The fp16 rounding of a bucket is kept in v_kt and sent with the next update.
+        """
+        dtype = WIRE_TYPES[self.args.dense_wire]
+        bucket = int(self.args.bucket_mb * 2 ** 20) // torch.zeros(0, dtype=dtype).element_size()
+        ahead = len(self.outstanding) + 1
+        self.outstanding.append(time.time())
+        works = []
+        for listener, (start, end) in zip(self.listeners, self.shards):
+            step = bucket or end - start
+            for begin in range(start, end, step):
+                stop = min(begin + step, end)
+                wire = update[begin:stop]
+                if dtype != torch.float:
+                    wire.add_(self.v_kt[begin:stop])
+                    self.v_kt[begin:stop].copy_(wire)
+                    wire = wire.to(dtype)
+                    self.v_kt[begin:stop].sub_(wire.float())
+                works.append(send_message(GSMessageCode.GradientUpdate, wire, dst=listener.source,
+                                          gradient_version=listener.version + ahead, lr=lr, async_op=True))
+        for work in works:
+            work.wait()
+
+    def collect_replies(self):
+        """
+        Take the replies that arrived and wait only while --outstanding steps are unanswered, then apply every
+        reply staged by the listeners. wait_saved_seconds is the round trip of the steps answered minus the time
+        waited for them.
+        """
+        servers = 1 if self.args.no_distributed else len(self.servers)
+        if self.args.no_distributed:
+            self.outstanding.append(time.time())
+        waited = 0.0
+        round_trip = 0.0
+        answered = 0
+        while self.outstanding:
+            block = len(self.outstanding) >= self.args.outstanding
+            start = time.time()
+            try:
+                self.version, arrival = self.queue.get(block=block)
+            except Empty:
+                break
+            waited += time.time() - start
+            self.replies += 1
+            if self.replies == servers:
+                self.replies = 0
+                round_trip += arrival - self.outstanding.popleft()
+                answered += 1
+        self.pipeline_stats = {'wait_seconds': waited, 'round_trip_seconds': round_trip / max(answered, 1),
+                               'wait_saved_seconds': max(round_trip - waited, 0.0)}
+        self.apply_replies()
+
+    def apply_replies(self):
+        """apply the staged replies of every listener, the model is not in use between two steps"""
+        start = time.time()
+        for listener in self.listeners:
+            listener.apply_staged()
+        self.apply_seconds = time.time() - start
+
+    def compression_stats(self):
+        """compression rate and, with --layer-density, bytes and captured energy of the last step"""
+        stats = {'compress_rate': self.rate, 'apply_seconds': self.apply_seconds}
+        if self.args.outstanding > 1:
+            stats.update(self.pipeline_stats)
+        if self.density_allocator is not None:
+            stats.update(self.density_allocator.stats)
+        return stats
+
+    def get_rate(self, lr):
+        """compression rate of this step"""
+        if self.rate_controller is not None:
+            if self.compress_ratio is not None:
+                self.rate_controller.max_rate = self.compress_ratio
+            return min(self.rate_controller.rate, self.rate_controller.max_rate)
+        if self.compress_ratio is not None and self.args.rate_schedule:
+            self.compressor.rate = self.compress_ratio
+        return self.compressor.get_rate(lr)
\ No newline at end of file
@@ -4,14 +4,21 @@ Parameter server for DGS
 """
 import logging
 import threading
+import time
 
 import torch
 import torch.optim
 
 from core.utils.messaging import MessageCode, MessageListener, send_message, GSMessageCode, \
     GradientMessageListener
-from core.utils.serialization import ravel_model_params, ravel_sparse_gradient, unravel_sparse_gradient, \
-    server_gradient_filter
+from core.utils.coalescer import UpdateCoalescer
+from core.utils.compressor import COMPRESSORS, get_compressor
+from core.utils.downlink import DOWNLINKS, ModelBackup, sum_entries
+from core.utils.metrics import ServerMetrics
+from core.utils.serialization import ravel_model_params, ravel_sparse_values, model_layers, run_layers
+from core.utils.shared import SharedServer
+from core.utils.sharding import shard_ranges
+from core.utils.staleness import StalenessTracker
 
 _LOGGER = logging.getLogger(__name__)
 cond = threading.Condition()
@@ -42,16 +49,488 @@ class ParameterServer(MessageListener):
             self.parameter_shard.add_(parameter)
 
 
+class ServerState(object):
+    """ServerState
 
-un_synced_worker = set()
+    model and bookkeeping shared by the GradientServer threads of one server. The flat model is cut at layer
+    boundaries into stripes, each guarded by its own lock, so two workers only wait for each other while they
+    write the same stripe. Locks are always taken in increasing stripe order.
 
-global_lr = 0.001
+    With shared_path several server processes serve the same model, each one a subset of the workers: the model
+    is a memory-mapped file, the stripe locks also exclude the other processes and the changes of every stripe go
+    through an UpdateRing, from which every process updates the downlinks of its own workers.
+    """
+
+    def __init__(self, global_model, size_list, worker_num, stripes=16, downlink='sparse', half=False,
+                 memory_budget=0, staleness=None, sync_interval=150, workers=None, shared_path=None, leader=True,
+                 ring_capacity=2 ** 18, coalesce_window=0, coalesce_max=8, shared_window=0, personal_rate=0,
+                 update_log=None, snapshots=None, backups=False, reply_dtype=None):
+        """
+        :param global_model: flat model (or shard) owned by this server
+        :param size_list: numel of every layer of global_model
+        :param worker_num: world size, workers are 1 .. worker_num - 1
+        :param stripes: number of lock stripes, 1 is a single global lock
+        :param downlink: storage of the pending update of every worker for sparse replies (dense or sparse),
+            None when the replies are full models
+        :param half: keep the pending values in fp16
+        :param memory_budget: bytes of downlink state of this server, 0 for no limit. A worker above its share
+            gets a catch-up, which clears its pending update
+        :param staleness: StalenessTracker of the updates, one without scaling and bound if None
+        :param sync_interval: steps between two catch-ups of a worker, 0 for none. The catch-ups of the workers are
+            staggered over the interval
+        :param workers: workers served by this process, all of them if None
+        :param shared_path: directory of the files of the model shared by several server processes, None for a
+            model in this process only
+        :param leader: the process creating the shared files, the others open them
+        :param ring_capacity: entries of the update ring of every stripe
+        :param coalesce_window: seconds a sparse update waits for others to be applied with, 0 for none
+        :param coalesce_max: largest number of sparse updates applied together
+        :param shared_window: versions during which the top-k indices of the recent global change are reused for
+            the replies of every worker, 0 for a top-k per reply
+        :param personal_rate: fraction of the reply rate chosen per worker next to the shared indices, 0 for none:
+            the top-k of the pending update of the worker costs about as much as a reply without shared indices
+        :param update_log: UpdateLog of the changes applied to the model, None for none
+        :param snapshots: ModelSnapshot the model is saved to, None for none
+        :param backups: keep the model of the last reply of every worker, the drift of delay compensation without
+            downlinks. It is stored in fp16 with half
+        :param reply_dtype: type of the dense replies of take_dense, None for none. The model of every worker is
+            backed up in it, the replies are the change of the global model against the backup and the synced
+            model is sent rounded to it, so a worker holds exactly its backup
+        """
+        self.worker_num = worker_num
+        self.workers = list(workers) if workers is not None else list(range(1, worker_num))
+        # the reports and snapshots of this process follow this worker
+        self.lead = self.workers[0]
+        self.stripes = shard_ranges(size_list, max(1, min(stripes, len(size_list))))
+        self.shared = None
+        if shared_path is not None and update_log is not None:
+            raise Exception('the update log is not supported with several server processes')
+        if shared_path is not None:
+            self.shared = SharedServer(shared_path, global_model, self.stripes, worker_num, capacity=ring_capacity,
+                                       create=leader)
+            self.global_model = self.shared.model
+            self.locks = self.shared.locks
+        else:
+            self.global_model = global_model
+            self.global_model.share_memory_()
+            self.locks = [threading.Lock() for _ in self.stripes]
+        # (offset, numel) of the layers of every stripe
+        self.stripe_layers = [[(offset, numel) for _, offset, numel in model_layers(size_list)
+                               if start <= offset < end] for start, end in self.stripes]
+        self.memory_budget = memory_budget
+        self.downlinks = {}
+        self.recent = None
+        self.downlink = downlink
+        self.downlink_dtype = torch.half if half else torch.float
+        # workers taking part in the training, see join and leave
+        self.members = set(self.workers)
+        if downlink is not None:
+            for worker in self.workers:
+                self.downlinks[worker] = self.new_downlink()
+            # the recent change of the global model, the shared replies are chosen from it
+            self.recent = DOWNLINKS['sparse'](self.global_model.numel(), self.stripes,
+                                              device=self.global_model.device) if shared_window else None
+            if downlink == 'dense' and self.over_budget(self.lead):
+                raise Exception('dense downlinks take %d bytes per worker, over the budget of %d bytes, use sparse '
+                                'downlinks' % (self.downlinks[self.lead].nbytes(), self.worker_budget()))
+        # worker -> log positions and downlink of a worker that left, see rejoin
+        self.parked = {}
+        # worker -> ModelBackup of its last reply, see sync_worker
+        self.backups = {} if backups or reply_dtype is not None else None
+        self.reply_dtype = reply_dtype
+        self.backup_dtype = reply_dtype if reply_dtype is not None else self.downlink_dtype
+        self.sync_interval = sync_interval
+        # lr of worker 1, forwarded to the other workers, in the SharedClock of the shard when shared
+        self._lr = 0.001
+        self.staleness = staleness or StalenessTracker(worker_num, workers=self.workers)
+        if self.shared is not None:
+            self.staleness.share(self.shared.clock)
+        # guards lost
+        self.lock = threading.Lock()
+        # workers whose downlink missed changes of the other processes
+        self.lost = set()
+        self.shared_window = shared_window
+        self.personal_rate = personal_rate
+        # (version, indices) of the shared reply of every stripe
+        self.shared_replies = [(None, None) for _ in self.stripes]
+        self.update_log = update_log
+        self.snapshots = snapshots
+        # updates applied, the version tag of the logged changes
+        self.version = 0
+        self.metrics = ServerMetrics()
+        self.coalescer = None
+        if coalesce_window:
+            self.coalescer = UpdateCoalescer(self.apply, window=coalesce_window, max_batch=coalesce_max)
+
+    @property
+    def lr(self):
+        return self.shared.clock.lr() if self.shared is not None else self._lr
+
+    @lr.setter
+    def lr(self, lr):
+        if self.shared is not None:
+            self.shared.clock.set_lr(lr)
+        else:
+            self._lr = lr
+
+    def publish(self, stripe, indices, change):
+        """
+        Push a change of the stripe to the downlinks, through the ring when the model is shared. Called under the
+        stripe lock.
+        :param indices: indices of the change, None for the whole stripe
+        """
+        if not self.downlinks:
+            return
+        if self.shared is None:
+            for downlink in self.sinks():
+                if indices is None:
+                    downlink.push_dense(stripe, change)
+                else:
+                    downlink.push(stripe, indices, change)
+            return
+        if indices is None:
+            start, end = self.stripes[stripe]
+            indices = torch.arange(start, end, device=change.device)
+        self.shared.ring.append(stripe, indices, change)
+        self.follow(stripe)
+
+    def follow(self, stripe):
+        """push the changes appended to the ring of the stripe to the downlinks, called under the stripe lock"""
+        if self.shared is None or not self.downlinks:
+            return
+        indices, values = self.shared.ring.read(stripe)
+        if indices is None:
+            with self.lock:
+                self.lost.update(self.downlinks)
+            return
+        if indices.numel() == 0:
+            return
+        # several changes may touch the same index
+        indices, values = sum_entries(indices, values, *self.stripes[stripe])
+        indices = indices.long()
+        for downlink in self.sinks():
+            downlink.push(stripe, indices, values)
+
+    def new_downlink(self):
+        return DOWNLINKS[self.downlink](self.global_model.numel(), self.stripes, device=self.global_model.device,
+                                        dtype=self.downlink_dtype)
+
+    def join(self, worker):
+        """a worker (re)joins the training, it has to get the full model next, see rejoin"""
+        with self.lock:
+            self.parked.pop(worker, None)
+            self.members.add(worker)
+            if self.downlink is not None:
+                # replaced, not changed, the dict may be iterated by the update threads
+                downlinks = dict(self.downlinks)
+                downlinks[worker] = self.new_downlink()
+                self.downlinks = downlinks
+        self.staleness.join(worker)
+
+    def leave(self, worker):
+        """
+        A worker left or failed, its downlink no longer follows the model and the others no longer wait for it.
+        With an update log the downlink is kept with the log position of every stripe, see rejoin, else freed.
+        """
+        locks = self.locks if self.update_log is not None and worker in self.downlinks else []
+        # no change is applied between the last one pushed to the downlink and the positions
+        for lock in locks:
+            lock.acquire()
+        try:
+            with self.lock:
+                self.members.discard(worker)
+                self.lost.discard(worker)
+                if worker in self.downlinks:
+                    downlinks = dict(self.downlinks)
+                    if locks:
+                        positions = [self.update_log.position(stripe) for stripe in range(len(self.stripes))]
+                        self.parked[worker] = (positions, downlinks[worker])
+                    del downlinks[worker]
+                    self.downlinks = downlinks
+                if self.backups is not None:
+                    self.backups.pop(worker, None)
+        finally:
+            for lock in locks:
+                lock.release()
+        self.staleness.leave(worker)
+
+    def rejoin(self, worker):
+        """
+        A worker left by leave is back and holds the model it had then. It is caught up from the update log: what
+        was pending for it at the positions of its leave plus the changes logged since.
+        :return: indices, values of the catch-up, None, None if the log was truncated past the positions or there
+            is no log, the worker then needs the full model
+        """
+        with self.lock:
+            parked = self.parked.pop(worker, None)
+        self.join(worker)
+        if parked is None:
+            return None, None
+        positions, pending = parked
+        downlink = self.downlinks[worker]
+        pieces = []
+        for stripe, (lock, (start, end)) in enumerate(zip(self.locks, self.stripes)):
+            with lock:
+                indices, values = self.update_log.since(stripe, positions[stripe])
+                if indices is None:
+                    return None, None
+                # the new downlink follows the changes after the log read
+                downlink.reset(stripe)
+            pending_indices, pending_values = pending.take(stripe, self.stripe_layers[stripe], 1.0)
+            pieces.append(sum_entries(torch.cat((indices.to(pending_indices.device), pending_indices.long())),
+                                      torch.cat((values.to(pending_values.device), pending_values.float())),
+                                      start, end))
+        return torch.cat([piece[0] for piece in pieces]).long(), torch.cat([piece[1] for piece in pieces])
+
+    def sinks(self):
+        """downlinks following every change of the global model"""
+        sinks = list(self.downlinks.values())
+        if self.recent is not None:
+            sinks.append(self.recent)
+        return sinks
+
+    def take_lost(self, worker):
+        """True once for a worker whose downlink missed changes, it has to get the full model"""
+        with self.lock:
+            if worker in self.lost:
+                self.lost.remove(worker)
+                return True
+            return False
+
+    def apply(self, gradient_update, worker=None, compensation=0, parts=None):
+        """
+        global_model -= gradient_update, one stripe at a time, the pending update of every worker follows.
+        :param gradient_update: dense or sparse tensor of the size of global_model
+        :param worker: sender of the update
+        :param compensation: lambda / lr of delay compensation (DC-ASGD), 0 for none. The pending update of the
+            worker is the drift W_now - W_bak of the model since the worker received it, every entry u carried by
+            the update becomes u + compensation * u * u * drift
+        :param parts: (sparse update, worker) summed in gradient_update by the coalescer, logged one by one
+        """
+        drift = None
+        if compensation:
+            drift = self.backups.get(worker) if self.backups is not None else self.downlinks.get(worker)
+        if self.update_log is not None:
+            with self.lock:
+                self.version += 1
+                version = self.version
+        if self.update_log is not None and parts is not None and len(parts) > 1:
+            # [update, worker, begin] of every part in the log
+            parts = [[part.coalesce(), part_worker or 0, 0] for part, part_worker in parts]
+        else:
+            parts = None
+        indices = values = None
+        if gradient_update.is_sparse:
+            gradient_update = gradient_update.coalesce()
+            indices = gradient_update._indices()[0]
+            values = gradient_update._values().neg()
+        begin = 0
+        for stripe, (lock, (start, end)) in enumerate(zip(self.locks, self.stripes)):
+            if indices is not None:
+                stop = int(indices.lt(end).sum())
+            with lock:
+                self.follow(stripe)
+                if indices is None:
+                    change = gradient_update[start:end].neg()
+                    if drift is not None:
+                        change.sub_(change.mul(change).mul_(drift.gather(stripe)).mul_(compensation))
+                    self.global_model[start:end].add_(change)
+                    self.publish(stripe, None, change)
+                    if self.update_log is not None:
+                        self.update_log.append(stripe, version, worker or 0, torch.arange(start, end), change)
+                elif stop > begin:
+                    change = values[begin:stop]
+                    if drift is not None:
+                        change = change.sub(change.mul(change).mul_(drift.gather(stripe, indices[begin:stop]))
+                                            .mul_(compensation))
+                    self.global_model.index_add_(0, indices[begin:stop], change)
+                    self.publish(stripe, indices[begin:stop], change)
+                    if self.update_log is not None and parts is not None:
+                        self.log_parts(stripe, version, parts, end)
+                    elif self.update_log is not None:
+                        self.update_log.append(stripe, version, worker or 0, indices[begin:stop], change)
+            if indices is not None:
+                begin = stop
+
+    def log_parts(self, stripe, version, parts, end):
+        """log the part of every worker in the stripe ending at end"""
+        for part in parts:
+            update, part_worker, begin = part
+            stop = int(update._indices()[0].lt(end).sum())
+            if stop > begin:
+                self.update_log.append(stripe, version, part_worker, update._indices()[0][begin:stop],
+                                       update._values()[begin:stop].neg())
+            part[2] = stop
+
+    def submit(self, gradient_update, worker=None, compensation=0):
+        """apply the update, sparse updates without delay compensation go through the coalescer"""
+        if self.coalescer is not None and gradient_update.is_sparse and not compensation:
+            self.coalescer.apply(gradient_update, worker=worker)
+        else:
+            self.apply(gradient_update, worker=worker, compensation=compensation)
+
+    def snapshot(self):
+        """consistent copy of every stripe of the global model"""
+        copy = torch.empty_like(self.global_model)
+        for lock, (start, end) in zip(self.locks, self.stripes):
+            with lock:
+                copy[start:end].copy_(self.global_model[start:end])
+        return copy
+
+    def counters(self):
+        """versions and per worker progress, saved with the snapshots"""
+        with self.staleness.progress:
+            return {'version': self.version, 'lr': self.lr, 'staleness_version': self.staleness.version,
+                    'seen': dict(self.staleness.seen), 'steps': dict(self.staleness.steps)}
+
+    def save_snapshot(self):
+        """start writing a snapshot in the background, False if the previous one is not written yet"""
+        return self.snapshots.request(self)
+
+    def recover(self):
+        """
+        Rebuild the global model from the last snapshot and, with an update log, the changes logged after it. A
+        model on the cpu is used mapped on the snapshot, which is only read where it is touched.
+        :return: position of the log reached by every stripe, None without log
+        """
+        model, meta = self.snapshots.load()
+        if self.global_model.is_cuda or self.shared is not None:
+            self.global_model.copy_(model)
+        else:
+            self.global_model = model
+        self.version = meta['version']
+        self.lr = meta['lr']
+        with self.staleness.progress:
+            self.staleness.version = meta['staleness_version']
+            for worker in self.staleness.seen:
+                self.staleness.seen[worker] = meta['seen'].get(str(worker), 0)
+                self.staleness.steps[worker] = meta['steps'].get(str(worker), 0)
+        if self.update_log is None:
+            return None
+        return [self.update_log.replay(self.global_model, stripe, position)
+                for stripe, position in enumerate(meta['positions'])]
+
+    def sync_worker(self, worker):
+        """copy of the global model for the worker, which then has nothing pending"""
+        downlink = self.downlinks.get(worker)
+        copy = torch.empty_like(self.global_model)
+        backup = None
+        if self.backups is not None:
+            backup = torch.empty(copy.numel(), dtype=self.backup_dtype, device=copy.device)
+        for stripe, (lock, (start, end)) in enumerate(zip(self.locks, self.stripes)):
+            with lock:
+                self.follow(stripe)
+                copy[start:end].copy_(self.global_model[start:end])
+                if downlink is not None:
+                    downlink.reset(stripe)
+                if backup is not None:
+                    backup[start:end].copy_(copy[start:end])
+                    if self.reply_dtype is not None:
+                        copy[start:end].copy_(backup[start:end])
+        if backup is not None:
+            self.backups[worker] = ModelBackup(self.global_model, self.stripes, backup)
+        return copy
+
+    def take_dense(self, worker):
+        """
+        Change of the global model against the backup of the worker in reply_dtype, the backup moves by it. The
+        rounding of the change stays in the difference and goes with the next reply.
+        """
+        backup = self.backups[worker]
+        delta = torch.empty(self.global_model.numel(), dtype=self.reply_dtype, device=self.global_model.device)
+        for stripe, (lock, (start, end)) in enumerate(zip(self.locks, self.stripes)):
+            with lock:
+                backup.take(stripe, delta[start:end])
+        return delta
+
+    def restore(self, worker, indices, values):
+        """put values the worker did not get back into its pending update, e.g. the rounding of an fp16 reply"""
+        downlink = self.downlinks.get(worker)
+        if downlink is None or indices.numel() == 0:
+            return
+        indices, order = indices.sort()
+        values = values[order]
+        begin = 0
+        for stripe, (lock, (start, end)) in enumerate(zip(self.locks, self.stripes)):
+            stop = int(indices.lt(end).sum())
+            if stop > begin:
+                with lock:
+                    downlink.push(stripe, indices[begin:stop], values[begin:stop])
+            begin = stop
+
+    def take_downlink(self, worker, rate=0.01, executor=None):
+        """
+        Top rate of every layer of the pending update of the worker, removed from it.
+        :return: indices, values
+        """
+        downlink = self.downlinks[worker]
+        pieces = [None] * len(self.stripes)
+
+        def take_stripe(stripe, start, numel):
+            with self.locks[stripe]:
+                self.follow(stripe)
+                if self.shared_window and rate < 1.0:
+                    pieces[stripe] = self.take_shared(downlink, stripe, rate)
+                else:
+                    pieces[stripe] = downlink.take(stripe, self.stripe_layers[stripe], rate)
+
+        run_layers(take_stripe, [(stripe, start, end - start) for stripe, (start, end) in enumerate(self.stripes)],
+                   executor)
+        return torch.cat([piece[0] for piece in pieces]), torch.cat([piece[1] for piece in pieces])
+
+    def take_shared(self, downlink, stripe, rate):
+        """
+        Reply of one stripe: what the worker has pending at the top (1 - personal_rate) * rate indices of the recent
+        global change, chosen once per shared_window versions for all workers, plus its own top personal_rate * rate.
+        Called under the stripe lock.
+        :return: indices, values
+        """
+        version, shared = self.shared_replies[stripe]
+        if version is None or self.staleness.version - version >= self.shared_window:
+            shared, _ = self.recent.take(stripe, self.stripe_layers[stripe], rate * (1 - self.personal_rate))
+            self.recent.reset(stripe)
+            self.shared_replies[stripe] = (self.staleness.version, shared)
+        values = downlink.pop(stripe, shared)
+        sent = values.ne(0)
+        if not self.personal_rate:
+            return shared[sent], values[sent]
+        indices, personal = downlink.take(stripe, self.stripe_layers[stripe], rate * self.personal_rate)
+        return torch.cat((shared[sent], indices)), torch.cat((values[sent], personal))
+
+    def worker_budget(self):
+        return self.memory_budget / max(len(self.downlinks), 1)
+
+    def over_budget(self, worker):
+        """the downlink of the worker takes more than its share of the memory budget"""
+        if not self.memory_budget or worker not in self.downlinks:
+            return False
+        return self.downlinks[worker].nbytes() > self.worker_budget()
+
+    def memory_report(self):
+        """server bytes held for the model and for the downlink of every worker"""
+        per_worker = [downlink.nbytes() for downlink in self.downlinks.values()]
+        if self.backups is not None:
+            per_worker = [backup.nbytes() for backup in list(self.backups.values())]
+        return {
+            'model_bytes': self.global_model.numel() * self.global_model.element_size(),
+            'downlink_bytes': sum(per_worker),
+            'bytes_per_worker': sum(per_worker) / max(len(per_worker), 1),
+            'max_worker_bytes': max(per_worker) if per_worker else 0,
+        }
+
+    def catch_up_due(self, worker, step):
+        """the worker gets everything pending at this step, every worker at its own offset of the interval"""
+        if not self.sync_interval or step <= self.sync_interval:
+            return False
+        offset = (worker - 1) * self.sync_interval // max(self.worker_num - 1, 1)
+        return (step + offset) % self.sync_interval == 0
 
 
 class GradientServer(GradientMessageListener):
     """GradientServer"""
 
-    def __init__(self, model, rank=0, worker_num=None, global_model=None, synced_model=None, size_list=None, args=None):
+    def __init__(self, model, rank=0, worker_num=None, state=None, size_list=None, shape_list=None, executor=None,
+                 args=None):
         _LOGGER.info("Creating GradientServer")
         print("Creating GradientServer")
         # self.gradient_warehouse = gradient_warehouse
@@ -59,86 +538,193 @@ class GradientServer(GradientMessageListener):
         self.max_version = 0
         self.worker_count = 0
         self.worker_num = worker_num
-        self.global_model = global_model
-        self.global_model.share_memory_()
-        super(GradientServer, self).__init__(model_size=global_model.numel(), source=rank, args=args)
-        self.synced_model = synced_model
-        self.synced_model.share_memory_()
+        self.state = state
+        self.global_model = state.global_model
+        super(GradientServer, self).__init__(model_size=self.global_model.numel(), source=rank, args=args)
         self.synced_version = 0
-        self.acc_send_grad = synced_model.clone().zero_()
-        self.acc_send_grad.share_memory_()
-        self.agg_gradient = None
         self.size_list = size_list
-        self.send_grad = self.acc_send_grad.clone()
-        self.cuda = self.synced_model.is_cuda
-        if rank == 1:
-            for i in range(1, self.worker_num):
+        self.shape_list = shape_list
+        self.executor = executor
+        self.compressor = None
+        if args.mode in COMPRESSORS:
+            self.compressor = get_compressor(args.mode)(shape_list, args=args)
+        self.cuda = self.global_model.is_cuda
+        # fp32 buffer the buckets of a dense update are copied to, filled up to bucket_end
+        self.bucket_buffer = None
+        self.bucket_end = 0
+        self.bucket_version = None
+        # version of the update of a worker dropped and synced again, its remaining buckets are ignored
+        self.skip_version = None
+        if rank == state.lead:
+            for i in state.workers:
                 self.sync_worker_model(i, 1)
         self.node_gradient = {}
 
+    def send(self, message_code, payload, dst, gradient_version, lr=0.1):
+        self.state.metrics.add(dst, bytes_out=payload.numel() * payload.element_size())
+        try:
+            send_message(message_code, payload, dst=dst, gradient_version=gradient_version, lr=lr)
+        except RuntimeError as e:
+            # the worker failed, it gets the model if it comes back, see handle
+            _LOGGER.warning("send to %d failed: %s", dst, e)
+            self.state.leave(dst)
+
     def sync_worker_model(self, sender, version):
-        send_message(GSMessageCode.ModelUpdate, self.synced_model, dst=sender, gradient_version=version, lr=global_lr)
+        self.send(GSMessageCode.ModelUpdate, self.state.sync_worker(sender), sender, version, lr=self.state.lr)
 
-    def sync_model(self):
-        self.synced_model.copy_(self.global_model)
-        # self.synced_version = self
-        return self.synced_model
+    def catch_up_worker(self, sender, version):
+        """
+        Send everything pending for the worker: the sparse delta against what it holds, or the dense delta in fp16
+        when that is smaller. The fp16 rounding of the dense delta stays pending and goes with a later reply.
+        """
+        start = time.time()
+        indices, values = self.state.take_downlink(sender, rate=1.0, executor=self.executor)
+        self.state.metrics.add(sender, filter_seconds=time.time() - start)
+        self.send_delta(sender, version, indices, values)
+
+    def rejoin_worker(self, sender, version):
+        """catch a worker back after leave up from the update log, the full model if the log cannot"""
+        indices, values = self.state.rejoin(sender)
+        if indices is None:
+            self.sync_worker_model(sender, version)
+        else:
+            self.send_delta(sender, version, indices, values)
+
+    def send_delta(self, sender, version, indices, values):
+        """send a change of the model, sparse or as a dense fp16 delta whichever is smaller"""
+        # float64 index and value per entry against two bytes per element
+        if indices.numel() * 16 <= self.global_model.numel() * 2:
+            self.send(GSMessageCode.SparseGradientUpdate, ravel_sparse_values(indices, values), sender, version,
+                      lr=self.state.lr)
+        else:
+            delta = torch.zeros(self.global_model.numel(), device=values.device)
+            delta[indices] = values
+            delta = delta.half()
+            self.state.restore(sender, indices, values - delta[indices].float())
+            self.send(GSMessageCode.GradientUpdate, delta, sender, version, lr=self.state.lr)
+
+    def add_bucket(self, version, parameter):
+        """
+        Copy a bucket of a dense update into the fp32 buffer, the buckets of an update carry its version and arrive
+        in order.
+        :return: the update once all its buckets arrived, else None
+        """
+        if self.bucket_buffer is None:
+            self.bucket_buffer = torch.zeros(self.global_model.numel(), device=self.global_model.device)
+        if self.bucket_end and version != self.bucket_version:
+            print('dropping the incomplete dense update %d of worker %d' % (self.bucket_version, self.source))
+            self.bucket_end = 0
+        self.bucket_version = version
+        end = self.bucket_end + parameter.numel()
+        self.bucket_buffer[self.bucket_end:end].copy_(parameter)
+        if end < self.bucket_buffer.numel():
+            self.bucket_end = end
+            return None
+        self.bucket_end = 0
+        return self.bucket_buffer
 
-    def update(self, rank, version, gradient_update):
+    def update(self, rank, version, gradient_update, lr=None):
         """
         :param rank: rank of worker node
         :param version: version of gradient
         :param gradient_update: tensor, gradient update tensor
+        :param lr: learning rate the update was scaled with, needed by delay compensation
         :return:
         """
         # print("update gradient from rank%d,version%d" % (rank, version))
-        self.global_model.add_(-1, gradient_update)
-
-        self.agg_gradient = self.global_model.add(-1, self.synced_model)
-
-        return self.agg_gradient, version
+        staleness = self.state.staleness.get(rank)
+        factor = self.state.staleness.scale(staleness)
+        if factor != 1.0:
+            gradient_update = gradient_update * factor
+        compensation = 0
+        if self.args.dc_lambda and lr:
+            # the update is lr * g, the compensation term lambda * g * g * drift is scaled accordingly
+            compensation = self.args.dc_lambda / lr
+        start = time.time()
+        self.state.submit(gradient_update, worker=rank, compensation=compensation)
+        self.state.metrics.add(rank, apply_seconds=time.time() - start)
+        self.state.metrics.observe_staleness(rank, staleness)
+        self.state.staleness.record(rank, version, staleness)
+        return version
 
     def receive(self, sender, message_code, gradient_version, lr, parameter):
-        global un_synced_worker, global_lr
+        start = time.time()
+        self.handle(sender, message_code, gradient_version, lr, parameter)
+        self.state.metrics.add(sender, messages=1, bytes_in=parameter.numel() * parameter.element_size(),
+                               reply_seconds=time.time() - start)
+
+    def handle(self, sender, message_code, gradient_version, lr, parameter):
         # print("rank {} Processing message: {} from sender {} gradient version {}".format(self.source, message_code.name,
         #                                                                                  sender,
         #                                                                                  gradient_version))
         self.max_version = max(self.max_version, gradient_version)
+        if message_code == GSMessageCode.WorkerLeave:
+            # a worker staying out of the training until its ModelRequest
+            print('worker %d leaves the training' % sender)
+            self.state.leave(sender)
+            return
+        if message_code == GSMessageCode.ModelRequest:
+            # a worker joining, it continues from the step of the slowest member
+            self.state.join(sender)
+            self.sync_worker_model(sender, max(2, self.state.staleness.floor()))
+            return
+        if sender not in self.state.members:
+            # dropped after missing its heartbeats, its update is too old to apply
+            print('worker %d is back, catching it up' % sender)
+            self.bucket_end = 0
+            self.skip_version = gradient_version
+            self.rejoin_worker(sender, gradient_version)
+            return
+        if message_code == GSMessageCode.GradientUpdate:
+            # a dense update may come in several buckets, it is applied once complete
+            if gradient_version == self.skip_version:
+                return
+            parameter = self.add_bucket(gradient_version, parameter)
+            if parameter is None:
+                return
         if sender == 1:
-            global_lr = lr
+            # worker 1 runs the lr schedule, the other workers take it from the replies
+            self.state.lr = lr
+        if sender == self.state.lead and self.state.snapshots is not None and self.args.snapshot_interval \
+                and gradient_version % self.args.snapshot_interval == 0:
+            self.state.save_snapshot()
 
         if message_code == GSMessageCode.GradientUpdate:
-            if self.cuda:
-                self.update(sender, gradient_version, parameter.cuda().float())
+            self.update(sender, gradient_version, parameter, lr)
+            self.state.staleness.hold(sender)
+            if self.state.take_lost(sender) or self.state.reply_dtype is None or sender not in self.state.backups:
+                # the model, which takes the backup of the worker when the dense wire is half or bf16
+                self.sync_worker_model(sender, gradient_version)
             else:
-                self.update(sender, gradient_version, parameter.float())
-
-            send_message(GSMessageCode.ModelUpdate, self.global_model, dst=sender,
-                         gradient_version=gradient_version)
-        elif message_code == GSMessageCode.SparseGradientUpdate:
+                # the change of the model against the backup of the worker, in the type of the dense wire
+                self.send(GSMessageCode.GradientUpdate, self.state.take_dense(sender), sender, gradient_version,
+                          lr=self.state.lr)
+        elif message_code in (GSMessageCode.SparseGradientUpdate, GSMessageCode.PowerSGDUpdate,
+                              GSMessageCode.SignGradientUpdate):
+            gradient = self.compressor.decompress(parameter)
             if self.cuda:
-                send_grad = self.update(sender, gradient_version, unravel_sparse_gradient(parameter).cuda())
+                self.update(sender, gradient_version, gradient.cuda(), lr)
             else:
-                send_grad = self.update(sender, gradient_version, unravel_sparse_gradient(parameter))
+                self.update(sender, gradient_version, gradient, lr)
 
-            if sender == 1 and self.max_version % 150 is 1 and gradient_version > 20:
-                self.sync_model()
-                un_synced_worker = set(range(1, self.worker_num))
-            if sender in un_synced_worker:
-                self.acc_send_grad.zero_()
+            self.state.staleness.hold(sender)
+            if self.state.take_lost(sender):
                 self.sync_worker_model(sender, gradient_version)
-                un_synced_worker.remove(sender)
+            elif self.state.catch_up_due(sender, gradient_version) or self.state.over_budget(sender):
+                if sender == self.state.lead:
+                    print('server memory: %s' % self.state.memory_report())
+                    print('staleness: %s' % self.state.staleness.report())
+                    if self.state.coalescer is not None:
+                        print('coalescing: %s' % self.state.coalescer.report())
+                    if self.args.staleness_log:
+                        self.state.staleness.export(self.args.staleness_log)
+                self.catch_up_worker(sender, gradient_version)
             else:
-                self.send_grad = self.agg_gradient.add(-1, self.acc_send_grad)
-                server_gradient_filter(self.size_list, self.send_grad, rate=0.01)
-                # end = time.time()
-
-                # print(abs(self.send_grad).sum())
-                # print('server cal cost time : %f' % (end - start))
-                send_message(GSMessageCode.SparseGradientUpdate, ravel_sparse_gradient(self.send_grad), sender,
-                             gradient_version, lr=global_lr)
-
-                self.acc_send_grad.add_(self.send_grad)
+                start = time.time()
+                indices, values = self.state.take_downlink(sender, rate=0.01, executor=self.executor)
+                self.state.metrics.add(sender, filter_seconds=time.time() - start)
+                self.send(GSMessageCode.SparseGradientUpdate, ravel_sparse_values(indices, values), sender,
+                          gradient_version, lr=self.state.lr)
 
         else:
             raise Exception('GSMessageCode not implemented')
@@ -0,0 +1,97 @@
+"""
+Coalescing of the sparse updates arriving together at the server
+"""
+import threading
+import time
+
+import torch
+
+
+def merge_sparse(updates):
+    """sum of sparse updates of the same size, on the union of their indices"""
+    if len(updates) == 1:
+        return updates[0]
+    updates = [update.coalesce() for update in updates]
+    indices = torch.cat([update._indices() for update in updates], 1)
+    values = torch.cat([update._values() for update in updates])
+    return torch.sparse_coo_tensor(indices, values, updates[0].size()).coalesce()
+
+
+class UpdateCoalescer(object):
+    """UpdateCoalescer
+
+    the first update to arrive waits up to window seconds for others, or until max_batch updates are there, then
+    the batch is summed on the union of its indices and applied in one pass, with the update and worker of every
+    caller for the update log. Every caller returns once its update is in the model, so the replies still follow
+    the updates they answer.
+    """
+
+    def __init__(self, apply, window=0.002, max_batch=8):
+        """
+        :param apply: applies one sparse update to the model, given the (update, worker) parts it sums
+        :param window: seconds the first update of a batch waits for others
+        :param max_batch: updates after which the batch is applied without waiting longer
+        """
+        self.apply_batch = apply
+        self.window = window
+        self.max_batch = max_batch
+        self.condition = threading.Condition()
+        # [update, worker, done, error] of the batch being collected
+        self.pending = []
+        self.collecting = False
+        # batch size -> number of batches
+        self.batches = {}
+        self.waited = 0.0
+
+    def apply(self, gradient_update, worker=None):
+        """apply the sparse update of the worker with those arriving in the same window, returns once it is applied"""
+        entry = [gradient_update, worker, False, None]
+        with self.condition:
+            self.pending.append(entry)
+            if self.collecting:
+                self.condition.notify_all()
+                while not entry[2]:
+                    self.condition.wait()
+                if entry[3] is not None:
+                    raise entry[3]
+                return
+            self.collecting = True
+            start = time.time()
+            deadline = start + self.window
+            while len(self.pending) < self.max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            batch = self.pending
+            self.pending = []
+            self.collecting = False
+            self.waited += time.time() - start
+        error = None
+        try:
+            self.apply_batch(merge_sparse([update for update, _, _, _ in batch]),
+                             parts=[(update, worker) for update, worker, _, _ in batch])
+        except Exception as e:
+            error = e
+        with self.condition:
+            for batch_entry in batch:
+                batch_entry[2] = True
+                batch_entry[3] = error
+            self.batches[len(batch)] = self.batches.get(len(batch), 0) + 1
+            self.condition.notify_all()
+        if error is not None:
+            raise error
+
+    def report(self):
+        with self.condition:
+            batches = dict(self.batches)
+            waited = self.waited
+        count = sum(batches.values())
+        updates = sum(size * n for size, n in batches.items())
+        return {
+            'batches': count,
+            'updates': updates,
+            'mean_batch': updates / max(count, 1),
+            'max_batch': max(batches) if batches else 0,
+            'waited_seconds': waited,
+        }
@@ -0,0 +1,227 @@
+"""
+Gradient compressors shared by GradientSGD (compress) and GradientServer (decompress)
+"""
+import logging
+
+import torch
+
+from core.utils.messaging import GSMessageCode
+from core.utils.serialization import worker_gradient_executor, DGC, Aji, PowerSGD, EFSignSGD, powersgd_memory, \
+    ravel_sparse_gradient, unravel_sparse_gradient, unravel_powersgd_gradient, unravel_sign_gradient, \
+    ravel_model_params, unravel_model_params, update_model_params, server_gradient_filter, momentum_step
+
+_LOGGER = logging.getLogger(__name__)
+
+COMPRESSORS = {}
+
+
+def register_compressor(name):
+    """register a Compressor subclass under the --mode name that selects it"""
+
+    def wrapper(cls):
+        cls.name = name
+        COMPRESSORS[name] = cls
+        return cls
+
+    return wrapper
+
+
+def get_compressor(name):
+    if name not in COMPRESSORS:
+        raise Exception('no compressor %s, registered: %s' % (name, ', '.join(sorted(COMPRESSORS))))
+    return COMPRESSORS[name]
+
+
+class Compressor(object):
+    """Compressor
+
+    base class of gradient compressors. The residual state (momentum u_kt, compression error v_kt) is owned by
+    the compressor, it is only allocated by init_state so the server side can decompress without it.
+    """
+    name = None
+    message_code = GSMessageCode.SparseGradientUpdate
+    # compress takes one rate per layer, see LayerDensityAllocator
+    layer_rates = False
+
+    def __init__(self, shape_list, momentum=0, weight_decay=0, rate=0.01, args=None, executor=None):
+        """
+        :param shape_list: list of parameter sizes of the model
+        :param momentum:
+        :param weight_decay:
+        :param rate: default compression rate
+        :param args: command line arguments
+        :param executor: thread pool for the per-layer kernels, see compression_executor
+        """
+        self.shape_list = list(shape_list)
+        self.size_list = [int(torch.Size(size).numel()) for size in self.shape_list]
+        self.model_size = sum(self.size_list)
+        self.momentum = momentum
+        self.weight_decay = weight_decay
+        self.rate = rate
+        self.args = args
+        self.executor = executor
+        self.payload = None
+        self.u_kt = None
+        self.v_kt = None
+
+    def init_state(self, net):
+        device = next(net.parameters()).device
+        self.payload = torch.zeros(self.model_size, device=device)
+        self.u_kt = torch.zeros(self.model_size, device=device)
+        self.v_kt = torch.zeros(self.model_size, device=device)
+
+    def reset(self):
+        self.u_kt.zero_()
+        self.v_kt.zero_()
+
+    def residual(self):
+        """the part of the gradient which has been accumulated but not sent yet"""
+        return self.v_kt
+
+    def residual_scale(self, lr):
+        """factor bringing the residual to the units of the update sent to the server"""
+        return 1.0
+
+    def get_rate(self, lr):
+        return self.rate
+
+    def compress(self, net, lr, rate=None):
+        """
+        :param net: model, its .grad are consumed
+        :param lr: learning rate
+        :param rate: compression rate, a float or one rate per layer, get_rate(lr) if None
+        :return: dense update as the server will apply it, message sent to the server
+        """
+        raise NotImplementedError()
+
+    def decompress(self, message):
+        """
+        :param message: payload received from a worker
+        :return: update tensor (dense or sparse) to subtract from the model
+        """
+        raise NotImplementedError()
+
+
+@register_compressor('gradient_sgd')
+class TopKCompressor(Compressor):
+    """top-k with the error kept in the momentum (SAMomentum), rate follows the lr schedule"""
+    layer_rates = True
+
+    def residual(self):
+        return self.u_kt
+
+    def get_rate(self, lr):
+        return self.rate * (lr / self.args.lr) if self.args is not None else self.rate
+
+    def compress(self, net, lr, rate=None):
+        rate = self.get_rate(lr) if rate is None else rate
+        payload = worker_gradient_executor(net, self.payload, self.u_kt, self.v_kt, rate=rate, lr=lr,
+                                           momentum=self.momentum, weight_decay=self.weight_decay,
+                                           executor=self.executor)
+        return payload, ravel_sparse_gradient(payload)
+
+    def decompress(self, message):
+        return unravel_sparse_gradient(message, self.model_size)
+
+
+@register_compressor('dgc')
+class DGCCompressor(TopKCompressor):
+    """Deep Gradient Compression"""
+
+    def residual(self):
+        return self.v_kt
+
+    def residual_scale(self, lr):
+        return lr
+
+    def get_rate(self, lr):
+        return self.rate
+
+    def compress(self, net, lr, rate=None):
+        rate = self.get_rate(lr) if rate is None else rate
+        payload = DGC(net, self.payload, self.u_kt, self.v_kt, rate=rate, lr=lr,
+                      momentum=self.momentum, weight_decay=self.weight_decay, executor=self.executor)
+        return payload, ravel_sparse_gradient(payload)
+
+
+@register_compressor('aji')
+class AjiCompressor(DGCCompressor):
+    """Gradient Dropping"""
+
+    def residual_scale(self, lr):
+        return 1.0
+
+    def compress(self, net, lr, rate=None):
+        rate = self.get_rate(lr) if rate is None else rate
+        payload = Aji(net, self.payload, self.u_kt, self.v_kt, rate=rate, lr=lr, weight_decay=self.weight_decay,
+                      executor=self.executor)
+        return payload, ravel_sparse_gradient(payload)
+
+
+@register_compressor('powersgd')
+class PowerSGDCompressor(Compressor):
+    """rank-r P/Q factors with warm-started Q"""
+    message_code = GSMessageCode.PowerSGDUpdate
+
+    def __init__(self, shape_list, momentum=0, weight_decay=0, rate=0.01, args=None, executor=None):
+        super(PowerSGDCompressor, self).__init__(shape_list, momentum=momentum, weight_decay=weight_decay,
+                                                 rate=rate, args=args, executor=executor)
+        self.powersgd_rank = args.powersgd_rank if args is not None else 4
+        self.q_memory = None
+
+    def init_state(self, net):
+        super(PowerSGDCompressor, self).init_state(net)
+        self.q_memory = powersgd_memory(self.shape_list, rank=self.powersgd_rank, device=self.u_kt.device)
+
+    def compress(self, net, lr, rate=None):
+        return PowerSGD(net, self.payload, self.u_kt, self.v_kt, self.q_memory, rank=self.powersgd_rank, lr=lr,
+                        momentum=self.momentum, weight_decay=self.weight_decay)
+
+    def decompress(self, message):
+        return unravel_powersgd_gradient(message.float(), self.shape_list, rank=self.powersgd_rank)
+
+
+@register_compressor('ef_signsgd')
+class EFSignCompressor(Compressor):
+    """1-bit signs with one scale per layer"""
+    message_code = GSMessageCode.SignGradientUpdate
+
+    def compress(self, net, lr, rate=None):
+        return EFSignSGD(net, self.payload, self.u_kt, self.v_kt, lr=lr, momentum=self.momentum,
+                         weight_decay=self.weight_decay)
+
+    def decompress(self, message):
+        return unravel_sign_gradient(message, self.size_list)
+
+
+@register_compressor('local_sgd')
+class LocalSGDCompressor(Compressor):
+    """local momentum SGD steps on the worker model, the model delta since the last push is sent as a top-k with
+    error feedback and replaced by the merged delta of the server"""
+
+    def init_state(self, net):
+        super(LocalSGDCompressor, self).init_state(net)
+        # model as the last reply left it, the local steps are measured from it
+        self.anchor = ravel_model_params(net).clone()
+
+    def local_step(self, net, lr):
+        """one step of the sgd mode applied to the worker model"""
+        momentum_step(net, self.u_kt, momentum=self.momentum, weight_decay=self.weight_decay)
+        update_model_params(net, self.u_kt, lr)
+
+    def compress(self, net, lr, rate=None):
+        rate = self.get_rate(lr) if rate is None else rate
+        self.payload.copy_(self.anchor).sub_(ravel_model_params(net)).add_(self.v_kt)
+        self.v_kt.copy_(self.payload)
+        server_gradient_filter(self.size_list, self.payload, rate=rate, executor=self.executor)
+        self.v_kt.sub_(self.payload)
+        # back to the anchor, the reply of the server brings the merged delta including this one
+        unravel_model_params(net, self.anchor)
+        return self.payload, ravel_sparse_gradient(self.payload)
+
+    def rebase(self, net):
+        """the replies are applied, the next local steps start from the current model"""
+        self.anchor.copy_(ravel_model_params(net))
+
+    def decompress(self, message):
+        return unravel_sparse_gradient(message, self.model_size)
@@ -0,0 +1,165 @@
+"""
+Choosing how dense the compressed gradients are
+"""
+import logging
+import math
+
+import torch
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class RateController(object):
+    """RateController
+
+    bandwidth-aware compression rate: after every step the measured communication time (send + wait for the
+    reply) is compared with the compute time of the step, and the rate is scaled so that communication stays
+    below bound * compute time.
+    """
+
+    def __init__(self, rate=0.01, min_rate=0.001, max_rate=0.25, bound=1.0, slack=0.5, max_factor=1.25,
+                 smoothing=0.8):
+        """
+        :param rate: initial compression rate
+        :param min_rate: lower limit of the rate
+        :param max_rate: upper limit of the rate
+        :param bound: target of communication time / compute time
+        :param slack: the rate is only raised when communication is below slack * bound * compute time
+        :param max_factor: largest change of the rate in one step
+        :param smoothing: weight of the history in the moving averages of the measured times
+        """
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.bound = bound
+        self.slack = slack
+        self.max_factor = max_factor
+        self.smoothing = smoothing
+        self.compute_time = None
+        self.comm_time = None
+        self.step = 0
+
+    def _average(self, average, value):
+        if average is None:
+            return value
+        return self.smoothing * average + (1 - self.smoothing) * value
+
+    def update(self, compute_time, comm_time):
+        """
+        :param compute_time: seconds spent in forward, backward and compression
+        :param comm_time: seconds spent sending the gradient and waiting for the reply
+        :return: rate for the next step
+        """
+        self.step += 1
+        self.compute_time = self._average(self.compute_time, compute_time)
+        self.comm_time = self._average(self.comm_time, comm_time)
+        target = self.bound * self.compute_time
+        if self.comm_time > target or self.comm_time < self.slack * target:
+            # communication time is roughly proportional to the number of values sent
+            factor = target / max(self.comm_time, 1e-6)
+            factor = min(max(factor, 1 / self.max_factor), self.max_factor)
+            self.rate = min(max(self.rate * factor, self.min_rate), self.max_rate)
+        _LOGGER.info("step %d compress rate %f compute %.4fs comm %.4fs", self.step, self.rate, compute_time,
+                     comm_time)
+        return self.rate
+
+
+class LayerDensityAllocator(object):
+    """LayerDensityAllocator
+
+    splits the budget of sent values given by a global rate across layers. A layer gets a share proportional to
+    the norm of what it has to send (new gradient and unsent residual), boosted when its residual keeps growing,
+    within [min_rate, max_rate] of its size.
+    """
+
+    def __init__(self, size_list, min_rate=0.001, max_rate=0.5, growth_weight=1.0):
+        """
+        :param size_list: numel of every layer
+        :param min_rate: lower limit of the rate of a layer
+        :param max_rate: upper limit of the rate of a layer
+        :param growth_weight: weight of the relative residual growth in the share of a layer
+        """
+        self.size_list = size_list
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.growth_weight = growth_weight
+        self.residual_norms = [0.0] * len(size_list)
+        self.growth = [0.0] * len(size_list)
+        self.rates = None
+        self.stats = {}
+
+    def _layer_norms(self, tensor):
+        norms = []
+        current_index = 0
+        for numel in self.size_list:
+            norms.append(tensor[current_index:current_index + numel].norm())
+            current_index += numel
+        return torch.stack(norms).tolist()
+
+    def allocate(self, rate, net, lr=1.0):
+        """
+        :param rate: global compression rate
+        :param net: model, after backward
+        :param lr: learning rate, brings the gradient to the units of the payload
+        :return: one rate per layer
+        """
+        gradient_norms = torch.stack([param.grad.data.norm() for param in net.parameters()]).mul_(lr).tolist()
+        weights = [math.sqrt(g ** 2 + r ** 2) * (1 + self.growth_weight * growth)
+                   for g, r, growth in zip(gradient_norms, self.residual_norms, self.growth)]
+        lower = [max(1.0, self.min_rate * numel) for numel in self.size_list]
+        upper = [max(lower_k, self.max_rate * numel) for lower_k, numel in zip(lower, self.size_list)]
+        counts = _water_fill(rate * sum(self.size_list), weights, lower, upper)
+        self.rates = [k / numel for k, numel in zip(counts, self.size_list)]
+        return self.rates
+
+    def observe(self, payload, residual, residual_scale=1.0):
+        """
+        Record what was sent and what is left after the compression of one step.
+        :param payload: dense update that was sent
+        :param residual: unsent part of the gradient
+        :param residual_scale: factor bringing the residual to the units of the payload (lr for DGC)
+        :return: statistics of the step
+        """
+        residual_norms = [norm * residual_scale for norm in self._layer_norms(residual)]
+        self.growth = [max(0.0, now / before - 1) if before > 0 else 0.0
+                       for now, before in zip(residual_norms, self.residual_norms)]
+        self.residual_norms = residual_norms
+        sent_energy = float(payload.norm()) ** 2
+        residual_energy = sum(norm ** 2 for norm in residual_norms)
+        # one float64 index and one float64 value per sent entry
+        sent_bytes = int(payload.ne(0).sum()) * 16
+        captured = sent_energy / (sent_energy + residual_energy) if sent_energy + residual_energy > 0 else 1.0
+        self.stats = {
+            'sent_bytes': sent_bytes,
+            'captured_energy': captured,
+            'captured_energy_per_mb': captured / max(sent_bytes, 1) * 2 ** 20,
+        }
+        _LOGGER.info("layer density: %d bytes, captured energy %f", sent_bytes, captured)
+        return self.stats
+
+
+def _water_fill(budget, weights, lower, upper):
+    """share budget proportionally to weights, every share within [lower, upper], leftovers are redistributed"""
+    counts = list(lower)
+    remaining = budget - sum(lower)
+    active = [i for i in range(len(weights)) if upper[i] > lower[i]]
+    if sum(weights[i] for i in active) <= 0:
+        weights = [u - l for u, l in zip(upper, lower)]
+    while remaining > 1e-6 and active:
+        total = sum(weights[i] for i in active)
+        if total <= 0:
+            break
+        spill = 0.0
+        still_active = []
+        for i in active:
+            share = remaining * weights[i] / total
+            room = upper[i] - counts[i]
+            if share >= room:
+                counts[i] = upper[i]
+                spill += share - room
+            else:
+                counts[i] += share
+                still_active.append(i)
+        remaining = spill
+        active = still_active
+    return counts
@@ -0,0 +1,424 @@
+"""
+What the server still owes every worker
+"""
+import numpy
+import torch
+
+DOWNLINKS = {}
+
+
+def register_downlink(name):
+    """register a Downlink subclass under the --downlink-storage name that selects it"""
+
+    def wrapper(cls):
+        cls.name = name
+        DOWNLINKS[name] = cls
+        return cls
+
+    return wrapper
+
+
+# numpy finds, selects and searches 1-d cpu tensors several times faster than torch
+
+
+def nonzero(tensor):
+    """flat positions of the non-zeros of a 1-d tensor"""
+    if tensor.is_cuda:
+        return tensor.nonzero().view(-1)
+    if tensor.dtype != torch.bool:
+        tensor = tensor.ne(0)
+    return torch.from_numpy(numpy.flatnonzero(tensor.numpy()))
+
+
+def masked(tensor, mask):
+    """entries of a 1-d tensor where the mask is set"""
+    if tensor.is_cuda:
+        return tensor[mask]
+    return torch.from_numpy(tensor.numpy()[mask.numpy()])
+
+
+def searchsorted(keys, queries):
+    """positions the queries take among the sorted keys"""
+    if keys.is_cuda and hasattr(torch, 'searchsorted'):
+        return torch.searchsorted(keys, queries)
+    # torch < 1.6 has no searchsorted
+    return torch.from_numpy(numpy.searchsorted(keys.cpu().numpy(), queries.cpu().numpy())).to(keys.device)
+
+
+def select_top(indices, values, layers, rate):
+    """
+    Top rate of every layer among the entries at sorted indices.
+    :param indices: sorted flat indices
+    :param values: values at indices
+    :param layers: (offset, numel) of the layers covering the indices
+    :param rate: compression rate of every layer
+    :return: positions of the selected entries, mask of the entries left (neither selected nor zero)
+    """
+    keep = values.ne(0)
+    ends = torch.tensor([offset + numel for offset, numel in layers], dtype=indices.dtype, device=indices.device)
+    bounds = [0] + searchsorted(indices, ends).tolist()
+    selected = []
+    for (offset, numel), begin, stop in zip(layers, bounds[:-1], bounds[1:]):
+        if stop == begin:
+            continue
+        k = int(numel * rate) if int(numel * rate) != 0 else 1
+        if stop - begin <= k:
+            selected.append(torch.arange(begin, stop, device=indices.device))
+        else:
+            selected.append(values[begin:stop].abs().topk(k)[1].add_(begin))
+    selected = torch.cat(selected) if selected else torch.zeros(0, dtype=torch.long, device=indices.device)
+    selected = selected[keep[selected]]
+    keep[selected] = 0
+    return selected, keep
+
+
+def sum_entries(indices, values, start, end):
+    """
+    Unique sorted indices and summed values of entries of the stripe [start, end), the sums that cancel out may be
+    dropped. Entries covering a good part of the stripe are added up on a dense scratch stripe, fewer are sorted:
+    both are cheaper than torch.unique.
+    :return: int32 indices, float values
+    """
+    if indices.numel() * 32 >= end - start:
+        scratch = torch.zeros(end - start, device=values.device).index_add_(0, indices.long() - start, values.float())
+        positions = nonzero(scratch)
+        return (positions + start).int(), scratch[positions]
+    indices, order = indices.long().sort()
+    values = values[order].float()
+    first = torch.ones(indices.numel(), dtype=torch.bool, device=indices.device)
+    first[1:] = indices[1:].ne(indices[:-1])
+    summed = torch.zeros(int(first.sum()), device=values.device).index_add_(0, first.cumsum(0).sub_(1), values)
+    return indices[first].int(), summed
+
+
+def select_top_dense(values, start, layers, rate):
+    """
+    Top rate of every layer of a dense stripe.
+    :param values: values of the stripe
+    :param start: flat index of the first value
+    :param layers: (offset, numel) of the layers of the stripe
+    :param rate: compression rate of every layer
+    :return: positions of the selected non-zero entries in the stripe
+    """
+    selected = []
+    for offset, numel in layers:
+        k = int(numel * rate) if int(numel * rate) != 0 else 1
+        layer = values[offset - start:offset - start + numel]
+        selected.append(layer.float().abs().topk(min(k, numel))[1].add_(offset - start))
+    selected = torch.cat(selected) if selected else torch.zeros(0, dtype=torch.long, device=values.device)
+    return selected[values[selected].ne(0)]
+
+
+def lookup(keys, queries):
+    """
+    Positions of the queries among the sorted keys.
+    :return: positions, mask of the queries found
+    """
+    keys = keys.long()
+    positions = searchsorted(keys, queries)
+    positions.clamp_(max=keys.numel() - 1)
+    return positions, keys[positions].eq(queries)
+
+
+@register_downlink('dense')
+class Downlink(object):
+    """Downlink
+
+    pending update of one worker: global model - model held by the worker. It only changes where the global
+    model changes, so next to the dense pending tensor the indices touched since they were last sent are kept per
+    stripe, and the reply is chosen among them: the work per message follows the number of non-zeros, not the
+    model size. All methods of a stripe are called under the lock of that stripe.
+    """
+    name = None
+
+    def __init__(self, numel, stripes, device=None, dtype=torch.float):
+        """
+        :param numel: size of the flat model
+        :param stripes: (start, end) of every lock stripe
+        :param device:
+        :param dtype: storage type of the pending values, torch.half halves the memory
+        """
+        self.numel = numel
+        self.stripes = stripes
+        self.device = device
+        self.dtype = dtype
+        self.pending = torch.zeros(numel, device=device, dtype=dtype)
+        self.touched = [[] for _ in stripes]
+        # stripes changed everywhere by push_dense, their touched indices are not kept
+        self.full = [False for _ in stripes]
+
+    def push(self, stripe, indices, values):
+        """the global model changed by values at indices (unique, sorted), all inside the stripe"""
+        if self.dtype == torch.float:
+            self.pending.index_add_(0, indices, values)
+        else:
+            self.pending[indices] = self.pending[indices].float().add_(values).to(self.dtype)
+        if not self.full[stripe]:
+            self.touched[stripe].append(indices)
+
+    def push_dense(self, stripe, values):
+        """the global model changed by values on the whole stripe"""
+        start, end = self.stripes[stripe]
+        self.pending[start:end].copy_(self.pending[start:end].float().add_(values))
+        self.touched[stripe] = []
+        self.full[stripe] = True
+
+    def reset(self, stripe):
+        """the worker received the stripe of the global model"""
+        start, end = self.stripes[stripe]
+        self.pending[start:end].zero_()
+        self.touched[stripe] = []
+        self.full[stripe] = False
+
+    def take_full(self, stripe, layers, rate):
+        """take of a full stripe, its non-zeros become its touched indices again once they take less memory"""
+        start, end = self.stripes[stripe]
+        pending = self.pending[start:end]
+        selected = select_top_dense(pending, start, layers, rate)
+        values = pending[selected].float()
+        pending[selected] = 0
+        # int64 index per entry against half the pending values of the stripe
+        if int(pending.ne(0).sum()) * 16 <= (end - start) * self.pending.element_size():
+            self.full[stripe] = False
+            self.touched[stripe] = [nonzero(pending) + start]
+        return selected + start, values
+
+    def gather(self, stripe, indices=None):
+        """pending values at indices of the stripe, the whole stripe if None"""
+        if indices is None:
+            start, end = self.stripes[stripe]
+            return self.pending[start:end].float()
+        return self.pending[indices].float()
+
+    def pop(self, stripe, indices):
+        """pending values at indices (unique) of the stripe, removed from the pending update"""
+        values = self.pending[indices].float()
+        self.pending[indices] = 0
+        return values
+
+    def candidates(self, stripe):
+        """sorted indices of the stripe where the pending update may be non-zero"""
+        touched = self.touched[stripe]
+        if not touched:
+            return None
+        if len(touched) == 1:
+            return touched[0]
+        start, end = self.stripes[stripe]
+        indices = torch.cat(touched)
+        indices = sum_entries(indices, torch.ones(indices.numel(), device=indices.device), start, end)[0].long()
+        self.touched[stripe] = [indices]
+        return indices
+
+    def take(self, stripe, layers, rate):
+        """
+        Top rate of every layer of the stripe, the selected entries are removed from the pending update.
+        :param stripe: stripe index
+        :param layers: (offset, numel) of the layers of the stripe
+        :param rate: compression rate of every layer
+        :return: indices, values
+        """
+        if self.full[stripe]:
+            return self.take_full(stripe, layers, rate)
+        indices = self.candidates(stripe)
+        if indices is None:
+            return torch.zeros(0, dtype=torch.long, device=self.device), torch.zeros(0, device=self.device)
+        values = self.pending[indices].float()
+        selected, keep = select_top(indices, values, layers, rate)
+        sent_indices = indices[selected]
+        self.pending[sent_indices] = 0
+        indices = indices[keep]
+        self.touched[stripe] = [indices] if indices.numel() else []
+        return sent_indices, values[selected]
+
+    def nbytes(self):
+        """server memory held for the worker"""
+        touched = sum(indices.numel() for pieces in self.touched for indices in pieces)
+        return self.pending.numel() * self.pending.element_size() + touched * 8
+
+
+@register_downlink('sparse')
+class SparseDownlink(Downlink):
+    """SparseDownlink
+
+    keeps only the non-zeros of the pending update, int32 indices and values per stripe. Pushes are appended and
+    merged when the stripe is read, so memory follows what is pending instead of the model size and an update
+    costs every worker one append per stripe. A stripe whose entries would take more than its dense storage is
+    kept dense until enough of it has been sent, so a stripe never takes more than a dense downlink.
+    """
+
+    def __init__(self, numel, stripes, device=None, dtype=torch.float):
+        self.numel = numel
+        self.stripes = stripes
+        self.device = device
+        self.dtype = dtype
+        # (indices, values) pushed to every stripe
+        self.pieces = [[] for _ in stripes]
+        # pending values of the stripes kept dense, None for the sparse ones
+        self.dense = [None for _ in stripes]
+        self.element_size = torch.zeros(0, dtype=dtype).element_size()
+
+    def sparse_limit(self, stripe):
+        """entries above which the stripe takes less memory dense, int32 index and value per entry"""
+        start, end = self.stripes[stripe]
+        return (end - start) * self.element_size // (4 + self.element_size)
+
+    def to_dense(self, stripe, indices, values):
+        start, end = self.stripes[stripe]
+        dense = torch.zeros(end - start, device=values.device, dtype=self.dtype)
+        dense[indices.long() - start] = values.to(self.dtype)
+        self.dense[stripe] = dense
+        self.pieces[stripe] = []
+
+    def to_sparse(self, stripe, count):
+        """back to sparse storage once less than half the limit is pending, count is the number of non-zeros"""
+        if count * 2 >= self.sparse_limit(stripe):
+            return
+        start = self.stripes[stripe][0]
+        dense = self.dense[stripe]
+        indices = nonzero(dense)
+        self.dense[stripe] = None
+        self.pieces[stripe] = [((indices + start).int(), dense[indices])] if indices.numel() else []
+
+    def push(self, stripe, indices, values):
+        # added up when the stripe is read, dense or not
+        self.pieces[stripe].append((indices.int(), values.to(self.dtype)))
+
+    def push_dense(self, stripe, values):
+        start, end = self.stripes[stripe]
+        indices, pending = self.merged(stripe)
+        if self.dense[stripe] is None:
+            if indices is None:
+                indices, pending = torch.zeros(0, dtype=torch.int, device=values.device), torch.zeros(0)
+            self.to_dense(stripe, indices, pending)
+        self.dense[stripe].copy_(self.dense[stripe].float().add_(values))
+
+    def reset(self, stripe):
+        self.pieces[stripe] = []
+        self.dense[stripe] = None
+
+    def merged(self, stripe):
+        """
+        sorted indices and summed values of the stripe, a stripe over the sparse limit becomes dense. The pushes to
+        a dense stripe are added to it in one pass, then None, None is returned.
+        """
+        pieces = self.pieces[stripe]
+        if not pieces:
+            return None, None
+        dense = self.dense[stripe]
+        if dense is not None:
+            start = self.stripes[stripe][0]
+            indices = torch.cat([piece[0] for piece in pieces]).long() - start
+            values = torch.cat([piece[1] for piece in pieces]).float()
+            if self.dtype == torch.float:
+                dense.index_add_(0, indices, values)
+            else:
+                dense.copy_(dense.float().index_add_(0, indices, values))
+            self.pieces[stripe] = []
+            return None, None
+        if len(pieces) == 1:
+            indices, values = pieces[0]
+        else:
+            start, end = self.stripes[stripe]
+            indices, values = sum_entries(torch.cat([piece[0] for piece in pieces]),
+                                          torch.cat([piece[1] for piece in pieces]), start, end)
+        if indices.numel() > self.sparse_limit(stripe):
+            self.to_dense(stripe, indices, values)
+            return None, None
+        self.pieces[stripe] = [(indices, values.to(self.dtype))]
+        return self.pieces[stripe][0]
+
+    def gather(self, stripe, indices=None):
+        merged_indices, merged_values = self.merged(stripe)
+        start, end = self.stripes[stripe]
+        dense = self.dense[stripe]
+        if dense is not None:
+            return dense.float() if indices is None else dense[indices - start].float()
+        if indices is None:
+            values = torch.zeros(end - start, device=self.device)
+            if merged_indices is not None:
+                values[merged_indices.long() - start] = merged_values.float()
+            return values
+        values = torch.zeros(indices.numel(), device=indices.device)
+        if merged_indices is None or indices.numel() == 0:
+            return values
+        positions, found = lookup(merged_indices, indices)
+        values[found] = merged_values[positions[found]].float()
+        return values
+
+    def pop(self, stripe, indices):
+        merged_indices, merged_values = self.merged(stripe)
+        dense = self.dense[stripe]
+        if dense is not None:
+            local = indices - self.stripes[stripe][0]
+            values = dense[local].float()
+            dense[local] = 0
+            return values
+        values = torch.zeros(indices.numel(), device=indices.device)
+        if merged_indices is None or indices.numel() == 0:
+            return values
+        positions, found = lookup(merged_indices, indices)
+        positions = positions[found]
+        values[found] = merged_values[positions].float()
+        # the pending entries not popped
+        keep = torch.ones(merged_indices.numel(), dtype=torch.bool, device=indices.device)
+        keep[positions] = 0
+        self.pieces[stripe] = [(masked(merged_indices, keep), masked(merged_values, keep))] if keep.any() else []
+        return values
+
+    def take(self, stripe, layers, rate):
+        indices, values = self.merged(stripe)
+        dense = self.dense[stripe]
+        if dense is not None:
+            start = self.stripes[stripe][0]
+            selected = select_top_dense(dense, start, layers, rate)
+            values = dense[selected].float()
+            dense[selected] = 0
+            self.to_sparse(stripe, int(dense.ne(0).sum()))
+            return selected + start, values
+        if indices is None:
+            return torch.zeros(0, dtype=torch.long, device=self.device), torch.zeros(0, device=self.device)
+        values = values.float()
+        selected, keep = select_top(indices, values, layers, rate)
+        sent = (indices[selected].long(), values[selected])
+        self.pieces[stripe] = [(masked(indices, keep), masked(values, keep).to(self.dtype))] if keep.any() else []
+        return sent
+
+    def nbytes(self):
+        return sum(indices.numel() * indices.element_size() + values.numel() * values.element_size()
+                   for pieces in self.pieces for indices, values in pieces) + \
+            sum(dense.numel() * dense.element_size() for dense in self.dense if dense is not None)
+
+
+class ModelBackup(object):
+    """ModelBackup
+
+    model of the last reply of a worker, W_bak of delay compensation when no downlink follows the worker. The
+    drift W_now - W_bak is read against the global model when an update of the worker arrives, instead of being
+    pushed to every worker on every update. Called under the lock of the stripe like a Downlink.
+    """
+
+    def __init__(self, global_model, stripes, backup):
+        self.global_model = global_model
+        self.stripes = stripes
+        self.backup = backup
+
+    def gather(self, stripe, indices=None):
+        """drift at indices of the stripe, the whole stripe if None"""
+        if indices is None:
+            start, end = self.stripes[stripe]
+            return self.global_model[start:end] - self.backup[start:end].float()
+        return self.global_model[indices] - self.backup[indices].float()
+
+    def take(self, stripe, out):
+        """write the change of the stripe since the backup into out in the type of the backup, the backup moves by it"""
+        start, end = self.stripes[stripe]
+        backup = self.backup[start:end]
+        base = backup.float()
+        change = self.global_model[start:end] - base
+        out.copy_(change)
+        # the worker adds the rounded change in fp32 and rounds the sum in the same way
+        change.copy_(out)
+        backup.copy_(base.add_(change))
+
+    def nbytes(self):
+        return self.backup.numel() * self.backup.element_size()
@@ -0,0 +1,78 @@
+"""
+Heartbeats of the workers, the servers drop the workers that stop beating
+
+The process group is fixed when it is created, so a worker can only leave and join again on its own rank: a
+dropped worker gets the current model when it sends again, a worker started with --join-delay stays out of the
+training until it asks for the model.
+"""
+import logging
+import threading
+import time
+
+from core.utils.messaging import QueueManager
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Heartbeat(threading.Thread):
+    """Heartbeat
+
+    counts up the entry of the worker in the heartbeats dict of the queue manager. A count rather than a time, the
+    clocks of the machines may differ.
+    """
+
+    def __init__(self, rank, interval):
+        self.rank = rank
+        self.interval = interval
+        self.running = True
+        super(Heartbeat, self).__init__(daemon=True)
+
+    def run(self):
+        count = 0
+        while self.running:
+            count += 1
+            QueueManager.heartbeats.update({self.rank: count})
+            time.sleep(self.interval)
+
+
+class HeartbeatMonitor(threading.Thread):
+    """HeartbeatMonitor
+
+    drops from the ServerState the members whose count did not change for timeout seconds, which frees their
+    downlink and takes them out of the bounded staleness wait
+    """
+
+    def __init__(self, state, timeout, interval=None):
+        """
+        :param state: ServerState of the workers
+        :param timeout: seconds without a heartbeat after which a worker is dropped
+        :param interval: seconds between two checks, timeout / 4 if None
+        """
+        self.state = state
+        self.timeout = timeout
+        self.interval = interval or timeout / 4.0
+        self.running = True
+        # worker -> (last count, local time it was seen)
+        self.seen = {}
+        super(HeartbeatMonitor, self).__init__(daemon=True)
+
+    def check(self, beats, now):
+        """drop the silent members, return them"""
+        dropped = []
+        for worker in list(self.state.members):
+            count = beats.get(worker)
+            last = self.seen.get(worker)
+            if last is None or last[0] != count:
+                self.seen[worker] = (count, now)
+            elif now - last[1] > self.timeout:
+                self.state.leave(worker)
+                del self.seen[worker]
+                dropped.append(worker)
+        for worker in dropped:
+            print('worker %d missed its heartbeats for %.0f s, dropped' % (worker, self.timeout))
+        return dropped
+
+    def run(self):
+        while self.running:
+            self.check(dict(QueueManager.heartbeats.copy()), time.time())
+            time.sleep(self.interval)
@@ -2,8 +2,11 @@ import logging
 import os
 import queue
 import socket
+import threading
 import time
+from collections import deque
 from enum import Enum
+from functools import partial
 from multiprocessing.managers import BaseManager
 from threading import Thread
 
@@ -11,6 +14,7 @@ import torch
 import torch.distributed as dist
 
 from core.utils.serialization import ravel_model_params
+from core.utils.sharding import all_server_ranks, worker_servers
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -47,6 +51,9 @@ class GSMessageCode(Enum):
     ModelRequest = 4
     ModelUpdate = 5
     SparseGradientUpdate = 6
+    PowerSGDUpdate = 7
+    SignGradientUpdate = 8
+    WorkerLeave = 9
 
 
 class ModelSize(Enum):
@@ -91,326 +98,41 @@ class MessageListener(Thread):
                          self.m_parameter[2:])
 
 
-a1 = queue.Queue()
-b1 = queue.Queue()
-a2 = queue.Queue()
-b2 = queue.Queue()
-a3 = queue.Queue()
-b3 = queue.Queue()
-a4 = queue.Queue()
-b4 = queue.Queue()
-a5 = queue.Queue()
-b5 = queue.Queue()
-a6 = queue.Queue()
-b6 = queue.Queue()
-a7 = queue.Queue()
-b7 = queue.Queue()
-a8 = queue.Queue()
-b8 = queue.Queue()
-a9 = queue.Queue()
-b9 = queue.Queue()
-a10 = queue.Queue()
-b10 = queue.Queue()
-a11 = queue.Queue()
-b11 = queue.Queue()
-a12 = queue.Queue()
-b12 = queue.Queue()
-a13 = queue.Queue()
-b13 = queue.Queue()
-a14 = queue.Queue()
-b14 = queue.Queue()
-a15 = queue.Queue()
-b15 = queue.Queue()
-a16 = queue.Queue()
-b16 = queue.Queue()
-a17 = queue.Queue()
-b17 = queue.Queue()
-a18 = queue.Queue()
-b18 = queue.Queue()
-a19 = queue.Queue()
-b19 = queue.Queue()
-a20 = queue.Queue()
-b20 = queue.Queue()
-a21 = queue.Queue()
-b21 = queue.Queue()
-a22 = queue.Queue()
-b22 = queue.Queue()
-a23 = queue.Queue()
-b23 = queue.Queue()
-a24 = queue.Queue()
-b24 = queue.Queue()
-a25 = queue.Queue()
-b25 = queue.Queue()
-a26 = queue.Queue()
-b26 = queue.Queue()
-a27 = queue.Queue()
-b27 = queue.Queue()
-a28 = queue.Queue()
-b28 = queue.Queue()
-a29 = queue.Queue()
-b29 = queue.Queue()
-a30 = queue.Queue()
-b30 = queue.Queue()
-a31 = queue.Queue()
-b31 = queue.Queue()
-a32 = queue.Queue()
-b32 = queue.Queue()
+# payload types sent apart from the float64 header, the size queue then carries 'numel:type'
+WIRE_TYPES = {'half': torch.half, 'bf16': torch.bfloat16, 'float': torch.float}
 
 
-def rta1():
-    return a1
+def parse_size(size):
+    """numel and payload type (None for a single float64 message) of a size queue entry"""
+    if isinstance(size, str) and ':' in size:
+        numel, wire_type = size.split(':')
+        return int(numel), WIRE_TYPES[wire_type]
+    return int(size), None
 
 
-def rtb1():
-    return b1
+# queues carrying the message sizes, created on demand in the manager process of rank 0
+_queues = {}
+# worker rank -> heartbeat count, see core.utils.membership
+_heartbeats = {}
 
 
-def rta2():
-    return a2
+def _get_queue(name):
+    if name not in _queues:
+        _queues[name] = queue.Queue()
+    return _queues[name]
 
 
-def rtb2():
-    return b2
+def _get_heartbeats():
+    return _heartbeats
 
 
-def rta3():
-    return a3
+def queue_name(src, dst):
+    return 'from%dto%d' % (src, dst)
 
 
-def rtb3():
-    return b3
-
-
-def rta4():
-    return a4
-
-
-def rtb4():
-    return b4
-
-
-def rta5():
-    return a5
-
-
-def rtb5():
-    return b5
-
-
-def rta6():
-    return a6
-
-
-def rtb6():
-    return b6
-
-
-def rta7():
-    return a7
-
-
-def rtb7():
-    return b7
-
-
-def rta8():
-    return a8
-
-
-def rtb8():
-    return b8
-
-
-def rta9():
-    return a9
-
-
-def rtb9():
-    return b9
-
-
-def rta10():
-    return a10
-
-
-def rtb10():
-    return b10
-
-
-def rta11():
-    return a11
-
-
-def rtb11():
-    return b11
-
-
-def rta12():
-    return a12
-
-
-def rtb12():
-    return b12
-
-
-def rta13():
-    return a13
-
-
-def rtb13():
-    return b13
-
-
-def rta14():
-    return a14
-
-
-def rtb14():
-    return b14
-
-
-def rta15():
-    return a15
-
-
-def rtb15():
-    return b15
-
-
-def rta16():
-    return a16
-
-
-def rtb16():
-    return b16
-
-
-def rta17():
-    return a17
-
-
-def rtb17():
-    return b17
-
-
-def rta18():
-    return a18
-
-
-def rtb18():
-    return b18
-
-
-def rta19():
-    return a19
-
-
-def rtb19():
-    return b19
-
-
-def rta20():
-    return a20
-
-
-def rtb20():
-    return b20
-
-
-def rta21():
-    return a21
-
-
-def rtb21():
-    return b21
-
-
-def rta22():
-    return a22
-
-
-def rtb22():
-    return b22
-
-
-def rta23():
-    return a23
-
-
-def rtb23():
-    return b23
-
-
-def rta24():
-    return a24
-
-
-def rtb24():
-    return b24
-
-
-def rta25():
-    return a25
-
-
-def rtb25():
-    return b25
-
-
-def rta26():
-    return a26
-
-
-def rtb26():
-    return b26
-
-
-def rta27():
-    return a27
-
-
-def rtb27():
-    return b27
-
-
-def rta28():
-    return a28
-
-
-def rtb28():
-    return b28
-
-
-def rta29():
-    return a29
-
-
-def rtb29():
-    return b29
-
-
-def rta30():
-    return a30
-
-
-def rtb30():
-    return b30
-
-
-def rta31():
-    return a31
-
-
-def rtb31():
-    return b31
-
-
-def rta32():
-    return a32
-
-
-def rtb32():
-    return b32
+def arrival_name(dst):
+    """queue announcing (source, size) of every message to dst, read by the MessageLoop of a server"""
+    return 'to%d' % dst
 
 
 class GradientMessageListener(Thread):
@@ -432,10 +154,13 @@ class GradientMessageListener(Thread):
         self.size_filename = None
         self.manager = None
         self.args = args
-        if dist.get_rank() == 0 and self.source == 1:
-            self.init_server_queue_manager()
-        elif dist.get_rank() > 0:
-            self.recv_queue, self.send_queue = self.init_worker_queue_manager()
+        if QueueManager.manager is None:
+            if dist.get_rank() == 0:
+                self.init_server_queue_manager()
+            else:
+                self.init_worker_queue_manager()
+        self.recv_queue = QueueManager.recv_queue_list[self.source]
+        self.send_queue = QueueManager.send_queue_list[self.source]
         super(GradientMessageListener, self).__init__()
 
     def receive(self, sender, message_code, gradient_version, lr, parameter):
@@ -456,18 +181,33 @@ class GradientMessageListener(Thread):
         while self.running:
             _LOGGER.info("Polling for sparse message...")
             # for size in tail(self.size_filename):
-            while True:
-                size = QueueManager.get_size(self.source)
+            while self.running:
+                size, wire_type = QueueManager.get_size(self.source)
+                if size is None:
+                    # nothing from the source for a while, it may have left
+                    continue
                 # if dist.get_rank() == 0:
                 # print('RECEIVING MESSAGE %dto%d.size:%d,' % (
                 #     self.source, dist.get_rank(), size))
+                if wire_type is not None:
+                    header = torch.zeros(4).double()
+                    payload = torch.zeros(size, dtype=wire_type)
+                    try:
+                        dist.recv(tensor=header, src=self.source)
+                        dist.recv(tensor=payload, src=self.source)
+                    except RuntimeError as e:
+                        # the source failed during the message
+                        _LOGGER.warning("receive from %d failed: %s", self.source, e)
+                        continue
+                    self.receive(int(header[0].item()), GSMessageCode(header[1].item()), int(header[2].item()),
+                                 float(header[3].item()), payload)
+                    continue
                 self.m_parameter = torch.zeros(size + 4).double()
                 try:
                     sender = dist.recv(tensor=self.m_parameter, src=self.source)
-                except Exception as e:
-                    # print('Exception :', e)
-                    raise e
-                    time.sleep(0.5)
+                except RuntimeError as e:
+                    # the source failed during the message
+                    _LOGGER.warning("receive from %d failed: %s", self.source, e)
                     continue
                 self.m_parameter = self.m_parameter
                 # if dist.get_rank() == 0:
@@ -479,88 +219,38 @@ class GradientMessageListener(Thread):
                              self.m_parameter[4:])
 
     def init_server_queue_manager(self):
-
-        QueueManager.register('from0to1', callable=rta1)
-        QueueManager.register('from1to0', callable=rtb1)
-        QueueManager.register('from0to2', callable=rta2)
-        QueueManager.register('from2to0', callable=rtb2)
-        QueueManager.register('from0to3', callable=rta3)
-        QueueManager.register('from3to0', callable=rtb3)
-        QueueManager.register('from0to4', callable=rta4)
-        QueueManager.register('from4to0', callable=rtb4)
-        QueueManager.register('from0to5', callable=rta5)
-        QueueManager.register('from5to0', callable=rtb5)
-        QueueManager.register('from0to6', callable=rta6)
-        QueueManager.register('from6to0', callable=rtb6)
-        QueueManager.register('from0to7', callable=rta7)
-        QueueManager.register('from7to0', callable=rtb7)
-        QueueManager.register('from0to8', callable=rta8)
-        QueueManager.register('from8to0', callable=rtb8)
-        QueueManager.register('from0to9', callable=rta9)
-        QueueManager.register('from9to0', callable=rtb9)
-        QueueManager.register('from0to10', callable=rta10)
-        QueueManager.register('from10to0', callable=rtb10)
-        QueueManager.register('from0to11', callable=rta11)
-        QueueManager.register('from11to0', callable=rtb11)
-        QueueManager.register('from0to12', callable=rta12)
-        QueueManager.register('from12to0', callable=rtb12)
-        QueueManager.register('from0to13', callable=rta13)
-        QueueManager.register('from13to0', callable=rtb13)
-        QueueManager.register('from0to14', callable=rta14)
-        QueueManager.register('from14to0', callable=rtb14)
-        QueueManager.register('from0to15', callable=rta15)
-        QueueManager.register('from15to0', callable=rtb15)
-        QueueManager.register('from0to16', callable=rta16)
-        QueueManager.register('from16to0', callable=rtb16)
-        QueueManager.register('from0to17', callable=rta17)
-        QueueManager.register('from17to0', callable=rtb17)
-        QueueManager.register('from0to18', callable=rta18)
-        QueueManager.register('from18to0', callable=rtb18)
-        QueueManager.register('from0to19', callable=rta19)
-        QueueManager.register('from19to0', callable=rtb19)
-        QueueManager.register('from0to20', callable=rta20)
-        QueueManager.register('from20to0', callable=rtb20)
-        QueueManager.register('from0to21', callable=rta21)
-        QueueManager.register('from21to0', callable=rtb21)
-        QueueManager.register('from0to22', callable=rta22)
-        QueueManager.register('from22to0', callable=rtb22)
-        QueueManager.register('from0to23', callable=rta23)
-        QueueManager.register('from23to0', callable=rtb23)
-        QueueManager.register('from0to24', callable=rta24)
-        QueueManager.register('from24to0', callable=rtb24)
-        QueueManager.register('from0to25', callable=rta25)
-        QueueManager.register('from25to0', callable=rtb25)
-        QueueManager.register('from0to26', callable=rta26)
-        QueueManager.register('from26to0', callable=rtb26)
-        QueueManager.register('from0to27', callable=rta27)
-        QueueManager.register('from27to0', callable=rtb27)
-        QueueManager.register('from0to28', callable=rta28)
-        QueueManager.register('from28to0', callable=rtb28)
-        QueueManager.register('from0to29', callable=rta29)
-        QueueManager.register('from29to0', callable=rtb29)
-        QueueManager.register('from0to30', callable=rta30)
-        QueueManager.register('from30to0', callable=rtb30)
-        QueueManager.register('from0to31', callable=rta31)
-        QueueManager.register('from31to0', callable=rtb31)
-        QueueManager.register('from0to32', callable=rta32)
-        QueueManager.register('from32to0', callable=rtb32)
+        QueueManager.register('heartbeats', callable=_get_heartbeats)
+        for server in all_server_ranks(self.args):
+            QueueManager.register(arrival_name(server), callable=partial(_get_queue, arrival_name(server)))
+            for worker in range(1, self.args.world_size):
+                for name in (queue_name(server, worker), queue_name(worker, server)):
+                    QueueManager.register(name, callable=partial(_get_queue, name))
 
         self.manager = QueueManager(address=('', 5000), authkey=b'abc')
-        QueueManager.send_queue_list.append(0)
-        QueueManager.recv_queue_list.append(0)
         QueueManager.manager = self.manager
         self.manager.start()
-        for i in range(1, dist.get_world_size()):
-            send_queue = eval('self.manager.from0to%d' % i)()
-            QueueManager.send_queue_list.append(send_queue)
-            recv_queue = eval('self.manager.from%dto0' % i)()
-            QueueManager.recv_queue_list.append(recv_queue)
-        pass
+        for i in range(1, self.args.world_size):
+            QueueManager.send_queue_list[i] = getattr(self.manager, queue_name(0, i))()
+            QueueManager.recv_queue_list[i] = getattr(self.manager, queue_name(i, 0))()
+        if self.args.server_loop == 'event':
+            QueueManager.arrival_queue = getattr(self.manager, arrival_name(0))()
+        QueueManager.heartbeats = self.manager.heartbeats()
 
     def init_worker_queue_manager(self):
-        # time.sleep(1)
-        QueueManager.register('from0to%d' % dist.get_rank())
-        QueueManager.register('from%dto0' % dist.get_rank())
+        """connect to the queues of rank 0, used by the workers and by the other server ranks"""
+        rank = dist.get_rank()
+        if rank in all_server_ranks(self.args):
+            peers = range(1, self.args.world_size)
+            arrivals = [rank]
+        else:
+            peers = worker_servers(self.args, rank)
+            arrivals = peers
+        for peer in peers:
+            QueueManager.register(queue_name(peer, rank))
+            QueueManager.register(queue_name(rank, peer))
+        for server in arrivals:
+            QueueManager.register(arrival_name(server))
+        QueueManager.register('heartbeats')
         time.sleep(10)
         # self.manager = QueueManager(address=(socket.gethostbyname('localhost'), 5000), authkey=b'abc')
         if socket.gethostname() == 'yan-pc' or socket.gethostname() == 'yrx-MS-7A93' or 'ubuntu' in socket.gethostname():
@@ -577,34 +267,136 @@ class GradientMessageListener(Thread):
             print(e)
             time.sleep(10)
             self.manager.connect()
-        send_queue = eval('self.manager.from%dto0' % dist.get_rank())()
-        QueueManager.send_queue_list.append(send_queue)
-        recv_queue = eval('self.manager.from0to%d' % dist.get_rank())()
-        QueueManager.recv_queue_list.append(recv_queue)
+        for peer in peers:
+            QueueManager.send_queue_list[peer] = getattr(self.manager, queue_name(rank, peer))()
+            QueueManager.recv_queue_list[peer] = getattr(self.manager, queue_name(peer, rank))()
+        if self.args.server_loop == 'event':
+            if rank in all_server_ranks(self.args):
+                QueueManager.arrival_queue = getattr(self.manager, arrival_name(rank))()
+            else:
+                # the servers learn the source of a message from their arrival queue
+                for server in arrivals:
+                    QueueManager.send_queue_list[server] = getattr(self.manager, arrival_name(server))()
+                    QueueManager.arrivals.add(server)
+        QueueManager.heartbeats = self.manager.heartbeats()
         QueueManager.manager = self.manager
-        return recv_queue, send_queue
+
+
+class SerialDispatcher(object):
+    """SerialDispatcher
+
+    runs the tasks of one source in submission order and the tasks of different sources in parallel on the
+    executor
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.running = set()
+
+    def submit(self, source, fn, *args):
+        with self.lock:
+            self.tasks.setdefault(source, deque()).append((fn, args))
+            if source in self.running:
+                return
+            self.running.add(source)
+        self.executor.submit(self._drain, source)
+
+    def _drain(self, source):
+        while True:
+            with self.lock:
+                if not self.tasks[source]:
+                    self.running.discard(source)
+                    return
+                fn, args = self.tasks[source].popleft()
+            try:
+                fn(*args)
+            except Exception:
+                _LOGGER.exception("message from %d failed", source)
+
+
+class MessageLoop(Thread):
+    """MessageLoop
+
+    one thread receiving the messages of all the sources of a server instead of a listener thread per source. The
+    sizes announced on the arrival queue start irecvs, every message is then waited for and handed to the receive
+    of the listener of its source on a small pool, in order per source. The gloo works only complete in wait, they
+    cannot be polled.
+    """
+
+    def __init__(self, listeners, executor):
+        """
+        :param listeners: source rank -> GradientMessageListener, whose receive handles the messages
+        :param executor: pool running the receive calls
+        """
+        self.listeners = listeners
+        self.dispatcher = SerialDispatcher(executor)
+        self.running = False
+        super(MessageLoop, self).__init__()
+
+    def post(self):
+        """start the receive of the next announced message"""
+        source, size = QueueManager.arrival_queue.get()
+        numel, wire_type = parse_size(size)
+        if wire_type is None:
+            buffers = [torch.zeros(numel + 4).double()]
+        else:
+            buffers = [torch.zeros(4).double(), torch.zeros(numel, dtype=wire_type)]
+        works = [dist.irecv(tensor=buffer, src=source) for buffer in buffers]
+        self.dispatcher.submit(source, self.complete, source, buffers, works)
+
+    def complete(self, source, buffers, works):
+        """wait for the message and pass it to the listener of its source"""
+        try:
+            for work in works:
+                work.wait()
+        except RuntimeError as e:
+            # the source failed during the message
+            _LOGGER.warning("receive from %d failed: %s", source, e)
+            return
+        header = buffers[0]
+        payload = header[4:] if len(buffers) == 1 else buffers[1]
+        self.listeners[source].receive(int(header[0].item()), GSMessageCode(header[1].item()),
+                                       int(header[2].item()), float(header[3].item()), payload)
+
+    def depth(self):
+        """messages being received or waiting for their turn on the pool"""
+        with self.dispatcher.lock:
+            return sum(len(tasks) for tasks in self.dispatcher.tasks.values()) + len(self.dispatcher.running)
+
+    def run(self):
+        _LOGGER.info("Started Running!")
+        self.running = True
+        while self.running:
+            self.post()
 
 
 class QueueManager(BaseManager):
     manager = None
-    send_queue_list = []
-    recv_queue_list = []
+    # peer rank -> queue
+    send_queue_list = {}
+    recv_queue_list = {}
+    # servers whose send queue is their arrival queue, see MessageLoop
+    arrivals = set()
+    arrival_queue = None
+    heartbeats = None
 
     @classmethod
     def get_manager(cls):
         return cls.manager
 
     @classmethod
-    def get_size(cls, opposite):
+    def get_size(cls, opposite, timeout=60):
+        """size of the next message of opposite, None, None if none came within timeout seconds"""
         recv_queue = cls.recv_queue_list[opposite]
         # exec('recv_queue = cls.manager.from%dto%d()' % (source, target))
-        res = None
         try:
-            res = recv_queue.get(timeout=4000)
+            res = recv_queue.get(timeout=timeout)
         except queue.Empty:
-            print('task queue is empty')
+            return None, None
         # print('RECV ', res, type(recv_queue), recv_queue)
-        return int(res)
+        return parse_size(res)
 
     @classmethod
     def put_size(cls, opposite, size):
@@ -612,18 +404,38 @@ class QueueManager(BaseManager):
         # exec('send_queue = cls.manager.from%dto%d()' % (source, target))
         send_queue = cls.send_queue_list[opposite]
         # print('SEND ', type(send_queue), size, send_queue)
-        send_queue.put(size)
+        if opposite in cls.arrivals:
+            send_queue.put((dist.get_rank(), size))
+        else:
+            send_queue.put(size)
+
+
+def message_bytes(payload):
+    """bytes send_message puts on the wire for the payload, header included"""
+    if payload.dtype in WIRE_TYPES.values():
+        return 4 * 8 + payload.numel() * payload.element_size()
+    return (payload.numel() + 4) * 8
 
 
-def send_message(message_code, payload, dst=0, gradient_version=None, lr=0.1):
+def send_message(message_code, payload, dst=0, gradient_version=None, lr=0.1, async_op=False):
     """Sends a message to a destination
     Concatenates both the message code and destination with the payload into a single tensor and then sends that as a tensor
+    With async_op the send is started and its work handle returned, the caller waits on it.
+    A half or float payload keeps its type on the wire, it is sent after a separate float64 header.
     """
     # _LOGGER.info("SENDING MESSAGE: {} RANK: {}".format(message_code, dist.get_rank()))
     m_parameter = torch.Tensor([dist.get_rank(), message_code.value, gradient_version, lr])
     # print(m_parameter.size(), payload.size())
     if payload.is_cuda:
         payload = payload.cpu()
+    for wire_type, dtype in WIRE_TYPES.items():
+        if payload.dtype == dtype:
+            QueueManager.put_size(dst, '%d:%s' % (payload.numel(), wire_type))
+            dist.send(tensor=m_parameter.double(), dst=dst)
+            if async_op:
+                return dist.isend(tensor=payload.contiguous(), dst=dst)
+            dist.send(tensor=payload.contiguous(), dst=dst)
+            return
     size = str(payload.numel())
     payload = torch.cat((m_parameter.double(), payload.double()))
     if dist.get_rank() == 0:
@@ -632,4 +444,6 @@ def send_message(message_code, payload, dst=0, gradient_version=None, lr=0.1):
     # with open('%dto%d.size' % (dist.get_rank(), dst), 'a') as f:
     #     f.write(size)
     QueueManager.put_size(dst, size)
+    if async_op:
+        return dist.isend(tensor=payload, dst=dst)
     dist.send(tensor=payload, dst=dst)
@@ -0,0 +1,122 @@
+"""
+Live metrics of a server, served in the Prometheus text format on a local HTTP port or Unix socket
+"""
+import logging
+import os
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+_LOGGER = logging.getLogger(__name__)
+
+# counter name -> help, kept per worker
+COUNTERS = {
+    'messages': 'messages received',
+    'bytes_in': 'payload bytes received',
+    'bytes_out': 'payload bytes sent',
+    'reply_seconds': 'time from the arrival of a message to the end of its reply',
+    'apply_seconds': 'time applying the updates to the model',
+    'filter_seconds': 'time choosing the sparse replies',
+}
+
+
+class ServerMetrics(object):
+    """ServerMetrics
+
+    counters per worker, updated by the GradientServer threads, and gauges read when the metrics are scraped
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        # counter -> worker -> value
+        self.counters = {name: {} for name in COUNTERS}
+        # worker -> staleness of its last update
+        self.staleness = {}
+        # gauge name -> (help, function returning a number or a dict of worker -> number)
+        self.gauges = {}
+
+    def add(self, worker, **values):
+        with self.lock:
+            for name, value in values.items():
+                counter = self.counters[name]
+                counter[worker] = counter.get(worker, 0) + value
+
+    def observe_staleness(self, worker, staleness):
+        with self.lock:
+            self.staleness[worker] = staleness
+
+    def gauge(self, name, help, fn):
+        self.gauges[name] = (help, fn)
+
+    def render(self, prefix='dgs'):
+        """metrics in the Prometheus text exposition format"""
+        lines = []
+
+        def metric(name, kind, help, values):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+            if isinstance(values, dict):
+                for worker, value in sorted(values.items()):
+                    lines.append('%s_%s{worker="%s"} %s' % (prefix, name, worker, float(value)))
+            else:
+                lines.append('%s_%s %s' % (prefix, name, float(values)))
+
+        with self.lock:
+            counters = {name: dict(values) for name, values in self.counters.items()}
+            staleness = dict(self.staleness)
+        metric('uptime_seconds', 'gauge', 'seconds since the server started', time.time() - self.start)
+        for name, help in COUNTERS.items():
+            metric(name + '_total', 'counter', help, counters[name])
+        metric('staleness', 'gauge', 'staleness of the last update of every worker', staleness)
+        for name, (help, fn) in sorted(self.gauges.items()):
+            try:
+                metric(name, 'gauge', help, fn())
+            except Exception as e:
+                _LOGGER.warning("metric %s failed: %s", name, e)
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    metrics = None
+
+    def do_GET(self):
+        body = self.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # no client address on a Unix socket
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        _LOGGER.debug(format, *args)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve_metrics(metrics, port=0, socket_path=''):
+    """
+    Serve the metrics on localhost:port or on a Unix socket from a daemon thread.
+    :return: the server
+    """
+    handler = type('Handler', (MetricsHandler,), {'metrics': metrics})
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, handler)
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('metrics on %s' % (socket_path or 'http://127.0.0.1:%d/metrics' % port))
+    return server
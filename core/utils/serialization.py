@@ -1,4 +1,6 @@
+import multiprocessing
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 
@@ -23,36 +25,102 @@ def ravel_model_params(model, grads=False, cuda=False):
     return m_parameter[1:]
 
 
-def unravel_model_params(model, parameter_update):
+def unravel_model_params(model, parameter_update, offset=0):
     """
     Assigns parameter_update params to model.parameters.
     This is done by iterating through model.parameters() and assigning the relevant params in parameter_update.
+    parameter_update may cover only the layers starting at flat index offset (a server shard).
     NOTE: this function manipulates model.parameters.
     """
     current_index = 0  # keep track of where to read from parameter_update
+    end = offset + parameter_update.numel()
     for parameter in model.parameters():
         numel = parameter.data.numel()
         size = parameter.data.size()
-        parameter.data.copy_(parameter_update[current_index:current_index + numel].view(size))
+        if offset <= current_index < end:
+            parameter.data.copy_(parameter_update[current_index - offset:current_index - offset + numel].view(size))
         current_index += numel
 
 
-def update_model_params(model, parameter_update, lr):
+def update_model_params(model, parameter_update, lr, offset=0):
     """
     Assigns parameter_update params to model.parameters.
     This is done by iterating through model.parameters() and adding the gradient in parameter_update.
+    parameter_update may cover only the layers starting at flat index offset (a server shard).
     NOTE: this function manipulates model.parameters.
     """
     current_index = 0  # keep track of where to read from parameter_update
+    end = offset + parameter_update.numel()
     for parameter in model.parameters():
         numel = parameter.data.numel()
         size = parameter.data.size()
         # print(parameter.data.device,parameter_update.device)
-        parameter.data.add_(-lr, parameter_update[current_index:current_index + numel].view(size))
+        if offset <= current_index < end:
+            parameter.data.add_(-lr, parameter_update[current_index - offset:current_index - offset + numel].view(size))
         current_index += numel
 
 
-def worker_gradient_executor(net, payload, u_kt, v_kt, rate=0.01, lr=0.1, momentum=None, weight_decay=0):
+def momentum_step(net, u_kt, momentum=0, weight_decay=0):
+    """
+    u_kt = momentum * u_kt + grad + weight_decay * param over the raveled model, the step of the sgd mode.
+    :return: u_kt
+    """
+    g = ravel_model_params(net, grads=True)
+    p = ravel_model_params(net, grads=False)
+    g.add_(weight_decay, p)
+    return u_kt.mul_(momentum).add_(g)
+
+
+def compression_executor(threads):
+    """
+    Thread pool for the per-layer compression kernels, torch ops release the GIL so independent layers run in
+    parallel. Intra-op threads are capped so that pool threads * intra-op threads does not exceed the cores.
+    :param threads: pool size, no pool if <= 1
+    """
+    if threads is None or threads <= 1:
+        return None
+    torch.set_num_threads(max(1, multiprocessing.cpu_count() // threads))
+    return ThreadPoolExecutor(max_workers=threads)
+
+
+def model_layers(size_list):
+    """(index, offset, numel) of every layer in the flat model"""
+    layers = []
+    current_index = 0
+    for index, numel in enumerate(size_list):
+        layers.append((index, current_index, numel))
+        current_index += numel
+    return layers
+
+
+def run_layers(layer_fn, layers, executor=None, bucket_size=2 ** 16):
+    """
+    Call layer_fn(index, offset, numel) for every layer. With an executor, consecutive small layers are grouped
+    into buckets of at least bucket_size elements and the buckets are run on the pool.
+    """
+    if executor is None:
+        for layer in layers:
+            layer_fn(*layer)
+        return
+    buckets = [[]]
+    bucket_numel = 0
+    for layer in layers:
+        if bucket_numel >= bucket_size:
+            buckets.append([])
+            bucket_numel = 0
+        buckets[-1].append(layer)
+        bucket_numel += layer[2]
+
+    def run_bucket(bucket):
+        for layer in bucket:
+            layer_fn(*layer)
+
+    # list() re-raises the exceptions of the workers
+    list(executor.map(run_bucket, buckets))
+
+
+def worker_gradient_executor(net, payload, u_kt, v_kt, rate=0.01, lr=0.1, momentum=None, weight_decay=0,
+                             executor=None):
     """
     :param momentum:
     :param lr:
@@ -60,19 +128,22 @@ def worker_gradient_executor(net, payload, u_kt, v_kt, rate=0.01, lr=0.1, moment
     :param payload:
     :param u_kt:
     :param net: model
-    :param rate: compression rate
+    :param rate: compression rate, a float or one rate per layer
+    :param executor: thread pool running the layers in parallel, see compression_executor
     :return: gradients which lager than threshold
     """
     # start = time.time()
-    current_index = 0
+    params = list(net.parameters())
     u_kt.mul_(momentum)
-    for param in net.parameters():
-        numel = param.data.numel()
+
+    def compress_layer(index, current_index, numel):
+        param = params[index]
+        layer_rate = rate[index] if isinstance(rate, (list, tuple)) else rate
         layer_u_kt = u_kt[current_index:current_index + numel]
         if weight_decay != 0:
             param.grad.data.add_(weight_decay, param.data)
         layer_u_kt.add_(param.grad.data.view(-1).mul(lr))
-        k = int(numel * rate) if int(numel * rate) != 0 else 1
+        k = int(numel * layer_rate) if int(numel * layer_rate) != 0 else 1
         k = numel - k
         abs_layer_u_kt = layer_u_kt.abs()
         threshold = torch.kthvalue(abs_layer_u_kt, k).values
@@ -81,12 +152,13 @@ def worker_gradient_executor(net, payload, u_kt, v_kt, rate=0.01, lr=0.1, moment
         payload[current_index:current_index + numel].copy_(layer_u_kt.mul(mask))
         layer_u_kt.add_(layer_u_kt.mul(1 - mask).mul(1 / momentum - 1))
         # print(layer_u_kt.sum())
-        current_index += numel
+
+    run_layers(compress_layer, model_layers([p.data.numel() for p in params]), executor)
     # end = time.time()
     return payload
 
 
-def DGC(net, payload, u_kt, v_kt, rate=0.01, lr=0.1, momentum=None, weight_decay=None):
+def DGC(net, payload, u_kt, v_kt, rate=0.01, lr=0.1, momentum=None, weight_decay=None, executor=None):
     """
     :param momentum:
     :param lr:
@@ -94,22 +166,23 @@ def DGC(net, payload, u_kt, v_kt, rate=0.01, lr=0.1, momentum=None, weight_decay
     :param payload:
     :param u_kt:
     :param net: model
-    :param rate: compression rate
+    :param rate: compression rate, a float or one rate per layer
+    :param executor: thread pool running the layers in parallel, see compression_executor
     :return: gradients which lager than threshold
     """
-    start = time.time()
-    current_index = 0
+    params = list(net.parameters())
     u_kt.mul_(momentum)
-    sum = 0
-    for param in net.parameters():
-        numel = param.data.numel()
+
+    def compress_layer(index, current_index, numel):
+        param = params[index]
+        layer_rate = rate[index] if isinstance(rate, (list, tuple)) else rate
         layer_u_kt = u_kt[current_index:current_index + numel]
         layer_v_kt = v_kt[current_index:current_index + numel]
         if weight_decay != 0:
             param.grad.data.add_(weight_decay, param.data)
         layer_u_kt.add_(param.grad.data.view(-1))
         layer_v_kt.add_(layer_u_kt)
-        k = int(numel * rate) if int(numel * rate) != 0 else 1
+        k = int(numel * layer_rate) if int(numel * layer_rate) != 0 else 1
         topn = [[1.0]]
         try:
             topn = torch.topk(abs(layer_v_kt), k)
@@ -122,11 +195,12 @@ def DGC(net, payload, u_kt, v_kt, rate=0.01, lr=0.1, momentum=None, weight_decay
         payload[current_index:current_index + numel].copy_(layer_v_kt.mul(mask).mul(lr))
         layer_v_kt.mul_(1 - mask)
         layer_u_kt.mul_(1 - mask)
-        current_index += numel
+
+    run_layers(compress_layer, model_layers([p.data.numel() for p in params]), executor)
     return payload
 
 
-def Aji(net, payload, u_kt, v_kt, rate=0.01, lr=0.1, momentum=None, weight_decay=0):
+def Aji(net, payload, u_kt, v_kt, rate=0.01, lr=0.1, momentum=None, weight_decay=0, executor=None):
     """
     :param momentum:
     :param lr:
@@ -134,21 +208,21 @@ def Aji(net, payload, u_kt, v_kt, rate=0.01, lr=0.1, momentum=None, weight_decay
     :param payload:
     :param u_kt:
     :param net: model
-    :param rate: compression rate
+    :param rate: compression rate, a float or one rate per layer
+    :param executor: thread pool running the layers in parallel, see compression_executor
     :return: gradients which lager than threshold
     """
-    start = time.time()
-    current_index = 0
+    params = list(net.parameters())
+
     # u_kt.mul_(momentum)
-    for param in net.parameters():
-        numel = param.data.numel()
-        # layer_u_kt = u_kt[current_index:current_index + numel]
+    def compress_layer(index, current_index, numel):
+        param = params[index]
+        layer_rate = rate[index] if isinstance(rate, (list, tuple)) else rate
         layer_v_kt = v_kt[current_index:current_index + numel]
-        # layer_u_kt.add_(param.grad.data.view(-1))
         if weight_decay != 0:
             param.grad.data.add_(weight_decay, param.data)
         layer_v_kt.add_(param.grad.data.view(-1).mul(lr))
-        k = int(numel * rate) if int(numel * rate) != 0 else 1
+        k = int(numel * layer_rate) if int(numel * layer_rate) != 0 else 1
         topn = [[1.0]]
         try:
             topn = torch.topk(abs(layer_v_kt), k)
@@ -159,25 +233,217 @@ def Aji(net, payload, u_kt, v_kt, rate=0.01, lr=0.1, momentum=None, weight_decay
         mask = (abs(layer_v_kt) > threshold).float()
         payload[current_index:current_index + numel].copy_(layer_v_kt.mul(mask))
         layer_v_kt.mul_(1 - mask)
-        # layer_u_kt.mul_(1 - mask)
-        current_index += numel
+
+    run_layers(compress_layer, model_layers([p.data.numel() for p in params]), executor)
     return payload
 
 
+def _numel(size):
+    numel = 1
+    for dim in size:
+        numel *= dim
+    return numel
 
-def server_gradient_filter(size_list, gradients, rate=0.01):
-    # print('gradients', gradients)
+
+def powersgd_shapes(shape_list, rank=4):
+    """
+    Matrix view used by PowerSGD for every layer.
+    A layer is reshaped to (size[0], numel / size[0]) and compressed only if its rank-r factors are smaller
+    than the layer itself, biases and BatchNorm parameters are sent as they are.
+    :param shape_list: list of parameter sizes
+    :param rank: rank of the P/Q factors
+    :return: list of (n, m) for compressed layers, None for layers sent dense
+    """
+    shapes = []
+    for size in shape_list:
+        numel = _numel(size)
+        if len(size) > 1:
+            n = size[0]
+            m = numel // n
+            if (n + m) * rank < numel:
+                shapes.append((n, m))
+                continue
+        shapes.append(None)
+    return shapes
+
+
+def powersgd_memory(shape_list, rank=4, device=None):
+    """
+    Initial Q factors of PowerSGD, they are warm-started from the previous step afterwards.
+    :param shape_list: list of parameter sizes
+    :param rank: rank of the P/Q factors
+    :param device: device of the model
+    :return: list of Q (m x rank) for compressed layers, None for layers sent dense
+    """
+    q_memory = []
+    for shape in powersgd_shapes(shape_list, rank):
+        if shape is None:
+            q_memory.append(None)
+        else:
+            q_memory.append(torch.randn(shape[1], rank, device=device))
+    return q_memory
+
+
+def _orthogonalize(matrix, eps=1e-8):
+    """Gram-Schmidt on the columns of matrix, in place."""
+    for i in range(matrix.size(1)):
+        col = matrix[:, i]
+        if i > 0:
+            rest = matrix[:, :i]
+            col.add_(-1, torch.mv(rest, torch.mv(rest.t(), col)))
+        col.div_(col.norm() + eps)
+    return matrix
+
+
+def PowerSGD(net, payload, u_kt, v_kt, q_memory, rank=4, lr=0.1, momentum=None, weight_decay=0):
+    """
+    :param momentum:
+    :param lr:
+    :param v_kt: compression error of each layer
+    :param payload: dense approximation of the update, same layout as the model
+    :param u_kt: momentum
+    :param q_memory: Q factors of the last step, see powersgd_memory
+    :param rank: rank of the P/Q factors
+    :param net: model
+    :return: payload and the flat P/Q factors to be sent
+    """
     current_index = 0
-    for size in size_list:
-        numel = size
-        temp = gradients[current_index:current_index + numel]
+    factors = []
+    u_kt.mul_(momentum)
+    for param, q in zip(net.parameters(), q_memory):
+        numel = param.data.numel()
+        layer_u_kt = u_kt[current_index:current_index + numel]
+        layer_v_kt = v_kt[current_index:current_index + numel]
+        layer_payload = payload[current_index:current_index + numel]
+        if weight_decay != 0:
+            param.grad.data.add_(weight_decay, param.data)
+        layer_u_kt.add_(param.grad.data.view(-1).mul(lr))
+        layer_v_kt.add_(layer_u_kt)
+        if q is None:
+            layer_payload.copy_(layer_v_kt)
+            factors.append(layer_payload)
+        else:
+            matrix = layer_v_kt.view(-1, q.size(0))
+            p = _orthogonalize(torch.mm(matrix, q))
+            q.copy_(torch.mm(matrix.t(), p))
+            layer_payload.copy_(torch.mm(p, q.t()).view(-1))
+            factors.append(p.view(-1))
+            factors.append(q.view(-1))
+        layer_v_kt.add_(-1, layer_payload)
+        current_index += numel
+    return payload, torch.cat(factors)
+
+
+def unravel_powersgd_gradient(factors, shape_list, rank=4):
+    """
+    Rebuild the dense update from the P/Q factors sent by PowerSGD.
+    :param factors: flat P/Q factors
+    :param shape_list: list of parameter sizes
+    :param rank: rank of the P/Q factors
+    :return: dense gradient update
+    """
+    shapes = powersgd_shapes(shape_list, rank)
+    size_list = [_numel(size) for size in shape_list]
+    dense_gradient = factors.new_zeros(sum(size_list))
+    current_index = 0
+    read_index = 0
+    for numel, shape in zip(size_list, shapes):
+        if shape is None:
+            dense_gradient[current_index:current_index + numel].copy_(factors[read_index:read_index + numel])
+            read_index += numel
+        else:
+            n, m = shape
+            p = factors[read_index:read_index + n * rank].view(n, rank)
+            read_index += n * rank
+            q = factors[read_index:read_index + m * rank].view(m, rank)
+            read_index += m * rank
+            dense_gradient[current_index:current_index + numel].copy_(torch.mm(p, q.t()).view(-1))
+        current_index += numel
+    return dense_gradient
+
+
+# sign bits packed into one double, every integer below 2 ** 53 is exact in float64
+SIGN_BITS = 52
+
+
+def _powers_of_two(device):
+    return torch.pow(2, torch.arange(SIGN_BITS, dtype=torch.float64, device=device))
+
+
+def pack_signs(signs):
+    """
+    Pack a flat 0/1 tensor into doubles, SIGN_BITS bits per element.
+    """
+    numel = signs.numel()
+    words = (numel + SIGN_BITS - 1) // SIGN_BITS
+    bits = torch.zeros(words * SIGN_BITS, dtype=torch.float64, device=signs.device)
+    bits[:numel].copy_(signs)
+    return torch.mv(bits.view(words, SIGN_BITS), _powers_of_two(signs.device))
+
+
+def unpack_signs(words, numel):
+    """
+    Inverse of pack_signs, returns numel 0/1 doubles.
+    """
+    bits = torch.fmod(torch.floor(words.double().view(-1, 1) / _powers_of_two(words.device)), 2)
+    return bits.view(-1)[:numel]
+
+
+def EFSignSGD(net, payload, u_kt, v_kt, lr=0.1, momentum=None, weight_decay=0):
+    """
+    :param momentum:
+    :param lr:
+    :param v_kt: compression error
+    :param payload: decoded update, same layout as the model
+    :param u_kt: momentum
+    :param net: model
+    :return: payload and the message holding one scale per layer followed by the packed signs
+    """
+    current_index = 0
+    scales = []
+    u_kt.mul_(momentum)
+    for param in net.parameters():
+        numel = param.data.numel()
+        layer_u_kt = u_kt[current_index:current_index + numel]
+        layer_v_kt = v_kt[current_index:current_index + numel]
+        if weight_decay != 0:
+            param.grad.data.add_(weight_decay, param.data)
+        layer_u_kt.add_(param.grad.data.view(-1).mul(lr))
+        layer_v_kt.add_(layer_u_kt)
+        scale = layer_v_kt.abs().mean()
+        payload[current_index:current_index + numel].copy_(layer_v_kt.ge(0).float().mul_(2).add_(-1).mul_(scale))
+        scales.append(scale)
         current_index += numel
+    v_kt.add_(-1, payload)
+    message = torch.cat((torch.stack(scales).double(), pack_signs(payload.ge(0))))
+    return payload, message
+
+
+def unravel_sign_gradient(sign_gradient, size_list):
+    """
+    :param sign_gradient: message built by EFSignSGD
+    :param size_list: numel of every layer
+    :return: dense gradient update
+    """
+    layer_num = len(size_list)
+    scales = sign_gradient[:layer_num].float()
+    signs = unpack_signs(sign_gradient[layer_num:], sum(size_list)).float().mul_(2).add_(-1)
+    return signs.mul_(torch.repeat_interleave(scales, torch.tensor(size_list, device=scales.device)))
+
+
+def server_gradient_filter(size_list, gradients, rate=0.01, executor=None):
+    # print('gradients', gradients)
+
+    def filter_layer(index, current_index, numel):
+        temp = gradients[current_index:current_index + numel]
         k = int(numel * rate) if int(numel * rate) != 0 else 1
         k = numel - k
         abs_temp = temp.abs()
         threshold = torch.kthvalue(abs_temp, k).values
         mask = abs_temp.gt(threshold)
         temp.mul_(mask)
+
+    run_layers(filter_layer, model_layers(size_list), executor)
     return gradients
 
 
@@ -188,15 +454,21 @@ def ravel_sparse_gradient(temp_param):
     return sparse_gradient
 
 
-def unravel_sparse_gradient(sparse_gradient):
+def ravel_sparse_values(indices, values):
+    """message of ravel_sparse_gradient built from the indices and values of the non-zeros"""
+    return torch.cat((indices.double().view(-1), values.double().view(-1)))
+
+
+def unravel_sparse_gradient(sparse_gradient, model_size=None):
     # len is 2472266 11173962 2400w
     split = int(len(sparse_gradient) / 2)
     i = sparse_gradient[:split]
     v = sparse_gradient[split:]
-    size = torch.Size([constant.MODEL_SIZE])
+    size = torch.Size([model_size or constant.MODEL_SIZE])
     # print('3',v.sum())
     try:
-        dense_gradient = torch.sparse_coo_tensor(i.reshape(1, -1).long(), v.float(), size, device=torch.device('cuda'))
+        dense_gradient = torch.sparse_coo_tensor(i.reshape(1, -1).long(), v.float(), size,
+                                                 device=sparse_gradient.device)
     except Exception as e:
         print(i, v)
         print('sum indice', sum(i))
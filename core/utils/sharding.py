@@ -0,0 +1,99 @@
+"""
+Splitting the flat model across several server ranks
+
+Rank 0 and the workers 1 .. world_size - 1 keep their ranks, the first process of every other shard takes a rank
+after the workers, then come the server_procs - 1 additional processes of every shard, so the process group holds
+world_size + num_servers * server_procs - 1 processes. The processes of a shard share its model and split its
+workers.
+"""
+import torch
+
+
+def server_ranks(args):
+    """rank of the first process of every shard"""
+    return [0] + list(range(args.world_size, args.world_size + args.num_servers - 1))
+
+
+def server_process_ranks(args):
+    """ranks of the processes of every shard, the first one of each is in server_ranks"""
+    first = args.world_size + args.num_servers - 1
+    extra = args.server_procs - 1
+    return [[leader] + list(range(first + shard * extra, first + (shard + 1) * extra))
+            for shard, leader in enumerate(server_ranks(args))]
+
+
+def all_server_ranks(args):
+    return [rank for ranks in server_process_ranks(args) for rank in ranks]
+
+
+def worker_servers(args, worker):
+    """rank of the process serving the worker in every shard"""
+    return [ranks[(worker - 1) % len(ranks)] for ranks in server_process_ranks(args)]
+
+
+def served_workers(args, rank):
+    """workers served by a server process"""
+    for ranks in server_process_ranks(args):
+        if rank in ranks:
+            return [worker for worker in range(1, args.world_size) if (worker - 1) % len(ranks) == ranks.index(rank)]
+    return []
+
+
+def process_group_size(args):
+    return args.world_size + args.num_servers * args.server_procs - 1
+
+
+def shard_ranges(size_list, num_servers):
+    """
+    Contiguous (start, end) ranges of the flat model, one per server. The boundaries are layer boundaries so every
+    server filters whole layers, they are chosen as close as possible to an even split.
+    :param size_list: numel of every layer
+    :param num_servers:
+    """
+    if len(size_list) < num_servers:
+        raise ValueError('%d layers can not be split across %d servers' % (len(size_list), num_servers))
+    offsets = [0]
+    for size in size_list:
+        offsets.append(offsets[-1] + size)
+    total = offsets[-1]
+    bounds = [0]
+    for shard in range(1, num_servers):
+        target = total * shard / num_servers
+        # leave at least one layer to each of the remaining shards
+        last = offsets[len(offsets) - 1 - (num_servers - shard)]
+        candidates = [offset for offset in offsets if bounds[-1] < offset <= last]
+        bounds.append(min(candidates, key=lambda offset: abs(offset - target)))
+    bounds.append(total)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def shard_layers(size_list, start, end):
+    """indices of the layers inside [start, end)"""
+    layers = []
+    current_index = 0
+    for index, numel in enumerate(size_list):
+        if start <= current_index < end:
+            layers.append(index)
+        current_index += numel
+    return layers
+
+
+def split_sparse_gradient(sparse_gradient, ranges):
+    """
+    Split a message of ravel_sparse_gradient into one message per shard, indices relative to the shard start.
+    The indices of ravel_sparse_gradient are sorted.
+    """
+    split = int(len(sparse_gradient) / 2)
+    indices = sparse_gradient[:split]
+    values = sparse_gradient[split:]
+    pieces = []
+    begin = 0
+    for start, end in ranges:
+        stop = int(indices.lt(end).sum())
+        pieces.append(torch.cat((indices[begin:stop] - start, values[begin:stop])))
+        begin = stop
+    return pieces
+
+
+def split_dense(tensor, ranges):
+    return [tensor[start:end] for start, end in ranges]
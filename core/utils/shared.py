@@ -0,0 +1,192 @@
+"""
+Server state shared by the processes of one shard through memory-mapped files
+
+The first process of the shard creates the files before joining the process group, the others open them after,
+so they always find them.
+"""
+import errno
+import fcntl
+import os
+import threading
+import time
+
+import torch
+
+STORAGES = {torch.float: torch.FloatStorage, torch.int: torch.IntStorage, torch.long: torch.LongStorage,
+            torch.double: torch.DoubleStorage}
+
+
+def shared_tensor(path, numel, dtype=torch.float, create=False):
+    """flat tensor mapped on a file, the writes are seen by every process mapping it"""
+    if create:
+        with open(path, 'wb') as f:
+            f.truncate(numel * torch.zeros(0, dtype=dtype).element_size())
+    return torch.tensor([], dtype=dtype).set_(STORAGES[dtype].from_file(path, True, numel))
+
+
+class StripeLock(object):
+    """StripeLock
+
+    lock of one stripe between the threads of a process (threading lock) and between processes (fcntl lock on
+    byte index of a lock file, fcntl locks do not exclude threads of the same process). The kernel sees the locks
+    of a process as held by all its threads, so two processes waiting on each other's stripes from different
+    threads look like a deadlock to it: the lock is then tried again.
+    """
+
+    def __init__(self, fd, index):
+        self.fd = fd
+        self.index = index
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        self.lock.acquire()
+        while True:
+            try:
+                fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, self.index)
+                return
+            except OSError as e:
+                if e.errno != errno.EDEADLK:
+                    self.lock.release()
+                    raise
+                time.sleep(0.0001)
+
+    def release(self):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, self.index)
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class UpdateRing(object):
+    """UpdateRing
+
+    the changes applied to every stripe of the shared model, one ring of (index, value) entries per stripe in a
+    shared file. A process appends under the stripe lock and reads what the other processes appended, to keep the
+    downlinks of its workers. A reader more than capacity entries behind has lost changes.
+    """
+
+    def __init__(self, path, stripes, capacity, create=False):
+        self.stripes = stripes
+        self.capacity = capacity
+        count = len(stripes)
+        self.indices = shared_tensor(path + '.indices', count * capacity, torch.int, create)
+        self.values = shared_tensor(path + '.values', count * capacity, torch.float, create)
+        # number of entries ever written to every stripe
+        self.heads = shared_tensor(path + '.heads', count, torch.long, create)
+        # entries read by this process
+        self.tails = self.heads.clone()
+
+    def append(self, stripe, indices, values):
+        head = int(self.heads[stripe])
+        count = indices.numel()
+        if count <= self.capacity:
+            positions = torch.arange(head, head + count).fmod_(self.capacity).add_(stripe * self.capacity)
+            self.indices[positions] = indices.int().cpu()
+            self.values[positions] = values.float().cpu()
+        # a change larger than the ring makes every reader lose it
+        self.heads[stripe] = head + count
+
+    def read(self, stripe):
+        """
+        Entries of the stripe appended since the last read of this process.
+        :return: indices, values, or None, None if some of them have been overwritten
+        """
+        head = int(self.heads[stripe])
+        tail = int(self.tails[stripe])
+        self.tails[stripe] = head
+        if head - tail > self.capacity:
+            return None, None
+        positions = torch.arange(tail, head).fmod_(self.capacity).add_(stripe * self.capacity)
+        return self.indices[positions].long(), self.values[positions]
+
+
+class SharedClock(object):
+    """SharedClock
+
+    version of the updates, lr of worker 1 and step of every worker, shared by the processes of a shard so that the
+    staleness, the bound of --max-staleness and the lr schedule cover the workers of all of them. The step of a
+    worker out of the training is -1.
+    """
+
+    def __init__(self, path, worker_num, lock, create=False):
+        """
+        :param path: file of the values
+        :param worker_num: world size, workers are 1 .. worker_num - 1
+        :param lock: StripeLock of the clock
+        :param create: first process of the shard
+        """
+        self.lock = lock
+        # version, lr, then the step of every rank
+        self.values = shared_tensor(path, 2 + worker_num, torch.double, create)
+        if create:
+            self.values[1] = 0.001
+            self.values[2] = -1
+
+    def version(self):
+        return int(self.values[0])
+
+    def set_version(self, version):
+        self.values[0] = version
+
+    def lr(self):
+        return float(self.values[1])
+
+    def set_lr(self, lr):
+        self.values[1] = lr
+
+    def tick(self, worker, step):
+        """an update of the worker for its step has been applied, return the new version"""
+        with self.lock:
+            version = int(self.values[0]) + 1
+            self.values[0] = version
+            self.values[2 + worker] = step
+        return version
+
+    def step(self, worker):
+        return int(self.values[2 + worker])
+
+    def set_step(self, worker, step):
+        self.values[2 + worker] = step
+
+    def floor(self):
+        """step of the slowest worker in the training"""
+        steps = self.values[2:]
+        steps = steps[steps.ge(0)]
+        return int(steps.min()) if steps.numel() else 0
+
+
+class SharedServer(object):
+    """SharedServer
+
+    files of the shard shared by its server processes: model, lock file, update ring and clock
+    """
+
+    def __init__(self, path, global_model, stripes, worker_num, capacity=2 ** 18, create=False):
+        """
+        :param path: directory of the files
+        :param global_model: model of the shard, copied to the shared file by the creating process
+        :param stripes: (start, end) of the lock stripes
+        :param worker_num: world size, workers are 1 .. worker_num - 1
+        :param capacity: entries of the ring of every stripe
+        :param create: first process of the shard
+        """
+        if create and not os.path.exists(path):
+            os.makedirs(path)
+        self.model = shared_tensor(os.path.join(path, 'model'), global_model.numel(), torch.float, create)
+        if create:
+            self.model.copy_(global_model)
+        lock_path = os.path.join(path, 'locks')
+        if create:
+            with open(lock_path, 'wb') as f:
+                f.truncate(len(stripes) + 1)
+        self.lock_file = open(lock_path, 'r+b')
+        self.locks = [StripeLock(self.lock_file.fileno(), index) for index in range(len(stripes))]
+        self.ring = UpdateRing(os.path.join(path, 'ring'), stripes, capacity, create)
+        # the byte after the stripe locks locks the clock
+        self.clock = SharedClock(os.path.join(path, 'clock'), worker_num,
+                                 StripeLock(self.lock_file.fileno(), len(stripes)), create)
@@ -0,0 +1,102 @@
+"""
+Asynchronous snapshots of the server model
+
+Two memory-mapped model files are written in turn by a background thread, the meta file names the last complete
+one, so a crash while writing leaves the previous snapshot intact. A restart maps the snapshot copy-on-write
+instead of reading it.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+import torch
+
+from core.utils.shared import shared_tensor
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class ModelSnapshot(object):
+    """ModelSnapshot
+
+    the writer copies the model one stripe at a time under the lock of that stripe into the buffer not named by
+    the meta file, the update threads only wait for the copy of the stripe they write. A new segment of the update
+    log of every stripe starts with its copy, the log after it completes that stripe, and the segments before it
+    are deleted once the snapshot is complete.
+    """
+
+    def __init__(self, path, numel):
+        """
+        :param path: directory of the files
+        :param numel: size of the flat model
+        """
+        self.path = path
+        self.numel = numel
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.meta_path = os.path.join(path, 'meta.json')
+        self.buffers = [None, None]
+        self.busy = threading.Event()
+        self.written = 0
+        self.seconds = 0.0
+
+    def buffer(self, index):
+        if self.buffers[index] is None:
+            path = os.path.join(self.path, 'model%d' % index)
+            self.buffers[index] = shared_tensor(path, self.numel, torch.float, not os.path.exists(path))
+        return self.buffers[index]
+
+    def meta(self):
+        """meta data of the last complete snapshot, None if there is none"""
+        if not os.path.exists(self.meta_path):
+            return None
+        with open(self.meta_path) as f:
+            return json.load(f)
+
+    def request(self, state):
+        """
+        Start writing a snapshot of the ServerState in the background.
+        :return: False if the previous snapshot is still being written
+        """
+        if self.busy.is_set():
+            return False
+        self.busy.set()
+        threading.Thread(target=self.write, args=(state,), daemon=True).start()
+        return True
+
+    def write(self, state):
+        try:
+            start = time.time()
+            meta = self.meta()
+            index = 1 - meta['buffer'] if meta is not None else 0
+            target = self.buffer(index)
+            positions = []
+            for stripe, (lock, (begin, end)) in enumerate(zip(state.locks, state.stripes)):
+                with lock:
+                    target[begin:end].copy_(state.global_model[begin:end])
+                    positions.append(state.update_log.rotate(stripe) if state.update_log is not None else None)
+            meta = dict(state.counters(), buffer=index, positions=positions, time=time.time())
+            with open(self.meta_path + '.tmp', 'w') as f:
+                json.dump(meta, f)
+            os.replace(self.meta_path + '.tmp', self.meta_path)
+            if state.update_log is not None:
+                for stripe, position in enumerate(positions):
+                    state.update_log.truncate(stripe, position)
+            self.written += 1
+            self.seconds += time.time() - start
+            _LOGGER.info("snapshot %d written to %s in %.3f s", self.written, self.path, time.time() - start)
+        finally:
+            self.busy.clear()
+
+    def load(self):
+        """
+        The last snapshot mapped copy-on-write: pages are read when touched, writes stay in this process.
+        :return: model, meta
+        """
+        meta = self.meta()
+        if meta is None:
+            raise Exception('no snapshot in %s' % self.path)
+        storage = torch.FloatStorage.from_file(os.path.join(self.path, 'model%d' % meta['buffer']), False, self.numel)
+        return torch.tensor([], dtype=torch.float).set_(storage), meta
@@ -0,0 +1,158 @@
+"""
+Staleness of the updates received by the server
+"""
+import csv
+import logging
+import math
+import threading
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+# factor of an update as a function of its staleness
+STALENESS_SCALINGS = {
+    'none': lambda staleness: 1.0,
+    'inverse': lambda staleness: 1.0 / (1 + staleness),
+    'sqrt': lambda staleness: 1.0 / math.sqrt(1 + staleness),
+}
+
+
+class StalenessTracker(object):
+    """StalenessTracker
+
+    staleness of an update: number of updates applied to the model between the reply the worker computed it on
+    and its arrival at the server. Scales the updates by their staleness, holds the workers running more than bound
+    steps ahead of the slowest one and keeps the staleness histogram.
+    """
+
+    def __init__(self, worker_num, scaling='none', bound=0, workers=None, max_hold=60.0):
+        """
+        :param worker_num: world size, workers are 1 .. worker_num - 1
+        :param scaling: none, inverse (1 / (1 + staleness)) or sqrt (1 / sqrt(1 + staleness))
+        :param bound: largest lead in steps of a worker over the slowest one, 0 for no bound
+        :param max_hold: seconds after which a held worker goes on, a dead worker does not stop the others, 0 for
+            no limit
+        :param workers: workers sending to this server process, all of them if None
+        """
+        if scaling not in STALENESS_SCALINGS:
+            raise Exception('no staleness scaling %s, choose from: %s' % (scaling, ', '.join(STALENESS_SCALINGS)))
+        self.scaling = scaling
+        self.bound = bound
+        self.max_hold = max_hold
+        workers = list(workers) if workers is not None else list(range(1, worker_num))
+        # number of updates applied, in the SharedClock of the shard once shared
+        self._version = 0
+        self.clock = None
+        # version each worker got with its last reply
+        self.seen = {worker: 0 for worker in workers}
+        # last step of each worker
+        self.steps = {worker: 0 for worker in workers}
+        self.held = {worker: 0.0 for worker in workers}
+        self.histogram = {}
+        self.progress = threading.Condition()
+
+    def share(self, clock):
+        """count the version and the steps in the SharedClock of the processes of the shard"""
+        self.clock = clock
+
+    @property
+    def version(self):
+        return self.clock.version() if self.clock is not None else self._version
+
+    @version.setter
+    def version(self, version):
+        if self.clock is not None:
+            self.clock.set_version(version)
+        else:
+            self._version = version
+
+    def get(self, worker):
+        """staleness of the update arriving now from the worker"""
+        return self.version - self.seen.get(worker, self.version)
+
+    def scale(self, staleness):
+        return STALENESS_SCALINGS[self.scaling](staleness)
+
+    def record(self, worker, step, staleness):
+        """the update of the worker for its step has been applied, its reply includes it"""
+        with self.progress:
+            if self.clock is not None:
+                version = self.clock.tick(worker, step)
+            else:
+                self._version += 1
+                version = self._version
+            self.seen[worker] = version
+            self.steps[worker] = step
+            self.histogram[staleness] = self.histogram.get(staleness, 0) + 1
+            self.progress.notify_all()
+
+    def join(self, worker):
+        """the worker gets the model now and counts from the step of the slowest worker"""
+        with self.progress:
+            self.seen[worker] = self.version
+            self.steps[worker] = self.floor()
+            if self.clock is not None:
+                self.clock.set_step(worker, self.steps[worker])
+            self.held.setdefault(worker, 0.0)
+            self.progress.notify_all()
+
+    def leave(self, worker):
+        """the worker no longer holds the others back"""
+        with self.progress:
+            self.seen.pop(worker, None)
+            self.steps.pop(worker, None)
+            if self.clock is not None:
+                self.clock.set_step(worker, -1)
+            self.progress.notify_all()
+
+    def floor(self):
+        """step of the slowest worker"""
+        if self.clock is not None:
+            return self.clock.floor()
+        with self.progress:
+            return min(self.steps.values()) if self.steps else 0
+
+    def lead(self, worker):
+        """steps the worker is ahead of the slowest worker"""
+        step = self.clock.step(worker) if self.clock is not None else self.steps[worker]
+        return step - self.floor()
+
+    def hold(self, worker):
+        """
+        Block while the worker is more than bound steps ahead of the slowest worker.
+        :return: seconds held
+        """
+        if not self.bound:
+            return 0.0
+        start = time.time()
+        with self.progress:
+            while worker in self.steps and self.lead(worker) > self.bound:
+                if self.max_hold and time.time() - start > self.max_hold:
+                    _LOGGER.warning("worker %d held for %.0f s at step %d by the step %d of the slowest worker, "
+                                    "going on", worker, self.max_hold, self.steps[worker], self.floor())
+                    break
+                self.progress.wait(1.0)
+        held = time.time() - start
+        self.held[worker] += held
+        return held
+
+    def report(self):
+        with self.progress:
+            histogram = dict(self.histogram)
+        count = sum(histogram.values())
+        return {
+            'updates': count,
+            'mean_staleness': sum(s * n for s, n in histogram.items()) / max(count, 1),
+            'max_staleness': max(histogram) if histogram else 0,
+            'held_seconds': sum(self.held.values()),
+        }
+
+    def export(self, path):
+        """write the histogram as staleness,count rows"""
+        with self.progress:
+            histogram = sorted(self.histogram.items())
+        with open(path, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(['staleness', 'count'])
+            writer.writerows(histogram)
+        _LOGGER.info("staleness histogram written to %s", path)
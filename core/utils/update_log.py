@@ -0,0 +1,181 @@
+"""
+Append-only log of the sparse changes applied to the server model
+
+Every stripe of the model has its own log, a sequence of segments under one directory. A segment is memory-mapped
+files: the flat int32 indices and float values of its changes, one (version, worker, start, count) row per change,
+and a head with the number of rows and entries written. The head is written last, so a change is in the log once
+it is counted. The files grow by doubling. A snapshot starts a new segment of every stripe and the segments before
+it are deleted once the snapshot is complete, so the log only holds the changes since the last snapshot.
+"""
+import os
+import shutil
+import threading
+
+import torch
+
+from core.utils.shared import shared_tensor
+
+
+def map_file(path, dtype, numel):
+    """flat tensor mapped on the file, the file is extended to hold at least numel elements"""
+    size = numel * torch.zeros(0, dtype=dtype).element_size()
+    if not os.path.exists(path) or os.path.getsize(path) < size:
+        with open(path, 'ab') as f:
+            f.truncate(size)
+    return shared_tensor(path, os.path.getsize(path) // torch.zeros(0, dtype=dtype).element_size(), dtype)
+
+
+class LogSegment(object):
+    """LogSegment
+
+    the changes of one stripe from position base on, base is the number of rows of the stripe before it.
+    """
+
+    def __init__(self, path, base, capacity):
+        """
+        :param path: directory of the files, created if missing
+        :param base: position of the first row
+        :param capacity: entries mapped at first, the segment grows past it
+        """
+        self.path = path
+        self.base = base
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.head = map_file(os.path.join(path, 'head'), torch.long, 2)
+        rows, entries = self.head.tolist()
+        self.rows = map_file(os.path.join(path, 'rows'), torch.long, 4 * max(capacity // 256, rows))
+        self.indices = map_file(os.path.join(path, 'indices'), torch.int, max(capacity, entries))
+        self.values = map_file(os.path.join(path, 'values'), torch.float, max(capacity, entries))
+
+    def grow(self, name, numel):
+        tensor = getattr(self, name)
+        if numel > tensor.numel():
+            setattr(self, name, map_file(os.path.join(self.path, name), tensor.dtype, max(numel, 2 * tensor.numel())))
+
+    def append(self, version, worker, indices, values):
+        count = indices.numel()
+        rows, entries = self.head.tolist()
+        self.grow('rows', 4 * (rows + 1))
+        self.grow('indices', entries + count)
+        self.grow('values', entries + count)
+        self.indices[entries:entries + count] = indices.int().cpu()
+        self.values[entries:entries + count] = values.float().cpu()
+        self.rows[4 * rows:4 * rows + 4] = torch.tensor([version, worker, entries, count])
+        self.head[1] = entries + count
+        self.head[0] = rows + 1
+
+    def end(self):
+        """position after the last row"""
+        return self.base + int(self.head[0])
+
+    def entries(self, start):
+        """indices, values of the rows from position start on"""
+        rows, entries = self.head.tolist()
+        start = max(start - self.base, 0)
+        if start >= rows:
+            return self.indices[:0], self.values[:0]
+        first = int(self.rows[4 * start + 2])
+        return self.indices[first:entries], self.values[first:entries]
+
+
+class UpdateLog(object):
+    """UpdateLog
+
+    every change applied to a stripe of the model under its stripe lock is appended as one row tagged with the
+    version of the update and its worker. The position of a stripe is its number of rows, the stripe at a position
+    plus the changes after it is the stripe at any later position. The stripes have their own locks, the appends
+    of a stripe are already ordered by its stripe lock.
+    """
+
+    def __init__(self, path, capacity=2 ** 20, create=False):
+        """
+        :param path: directory of the files
+        :param capacity: entries mapped at first by every segment, a segment grows past it
+        :param create: start an empty log, else continue the one at path
+        """
+        self.path = path
+        self.capacity = capacity
+        if create and os.path.exists(path):
+            shutil.rmtree(path)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        # guards locks and segments
+        self.lock = threading.Lock()
+        self.locks = {}
+        # stripe -> segments ordered by base
+        self.segments = {}
+        for name in os.listdir(path):
+            if name.startswith('stripe'):
+                stripe = int(name[len('stripe'):])
+                bases = sorted(int(segment[len('segment'):]) for segment in os.listdir(os.path.join(path, name)))
+                self.segments[stripe] = [LogSegment(self.segment_path(stripe, base), base, capacity)
+                                         for base in bases]
+
+    def segment_path(self, stripe, base):
+        return os.path.join(self.path, 'stripe%d' % stripe, 'segment%d' % base)
+
+    def stripe(self, stripe):
+        """lock and segments of a stripe, the first segment is created on first use"""
+        with self.lock:
+            if stripe not in self.locks:
+                self.locks[stripe] = threading.Lock()
+                if not self.segments.get(stripe):
+                    self.segments[stripe] = [LogSegment(self.segment_path(stripe, 0), 0, self.capacity)]
+            return self.locks[stripe], self.segments[stripe]
+
+    def append(self, stripe, version, worker, indices, values):
+        """log a change of the stripe"""
+        lock, segments = self.stripe(stripe)
+        with lock:
+            segments[-1].append(version, worker, indices, values)
+
+    def position(self, stripe):
+        lock, segments = self.stripe(stripe)
+        with lock:
+            return segments[-1].end()
+
+    def rotate(self, stripe):
+        """
+        Start a new segment of the stripe, called with the stripe of the model locked.
+        :return: position of the stripe, where the new segment starts
+        """
+        lock, segments = self.stripe(stripe)
+        with lock:
+            end = segments[-1].end()
+            if end > segments[-1].base:
+                segments.append(LogSegment(self.segment_path(stripe, end), end, self.capacity))
+            return end
+
+    def truncate(self, stripe, position):
+        """delete the segments of the stripe ending at or before position, a snapshot holds their changes"""
+        lock, segments = self.stripe(stripe)
+        with lock:
+            while len(segments) > 1 and segments[1].base <= position:
+                shutil.rmtree(segments.pop(0).path)
+
+    def since(self, stripe, start):
+        """
+        Sum of the changes of the stripe logged from position start on.
+        :return: unique sorted indices, values, None, None if the changes after start were truncated
+        """
+        lock, segments = self.stripe(stripe)
+        with lock:
+            if start < segments[0].base:
+                return None, None
+            parts = [segment.entries(start) for segment in segments if segment.end() > start]
+        if not parts:
+            return torch.zeros(0, dtype=torch.long), torch.zeros(0)
+        indices = torch.cat([indices for indices, _ in parts]).long()
+        values = torch.cat([values for _, values in parts])
+        if indices.numel() == 0:
+            return indices, values
+        indices, inverse = torch.unique(indices, sorted=True, return_inverse=True)
+        return indices, torch.zeros(indices.numel()).index_add_(0, inverse, values)
+
+    def replay(self, model, stripe, start):
+        """add the changes of the stripe logged since position start to the flat model"""
+        indices, values = self.since(stripe, start)
+        if indices is None:
+            raise Exception('the log of stripe %d starts after position %d' % (stripe, start))
+        model.index_add_(0, indices.to(model.device), values.to(model.device))
+        return self.position(stripe)
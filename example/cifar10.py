@@ -12,6 +12,7 @@ from core.optim import GradientSGD
 from core.utils import constant
 from core.utils.GradualWarmupScheduler import GradualWarmupScheduler
 from core.utils.serialization import ravel_model_params
+from core.utils.sharding import all_server_ranks
 from example.main import init_server
 
 import torchvision
@@ -132,6 +133,7 @@ def cifar10(args, optimizer, net):
                 'training_loss': loss.item(),
                 'training_accuracy': accuracy,
             }
+            log_obj.update(optimizer.compression_stats())
             if i % 80 == 0:
                 print("Timestamp: {timestamp} | "
                       "Iteration: {iteration:6} | "
@@ -239,11 +241,91 @@ if __name__ == "__main__":
     parser.add_argument('--rank', type=int, default=0, metavar='N',
                         help='rank of current process (0 is server, 1+ is training node)')
     parser.add_argument('--world-size', type=int, default=3, metavar='N', help='size of the world')
+    parser.add_argument('--num-servers', type=int, default=1,
+                        help='number of server ranks sharing the model, extra servers take the ranks after the workers')
+    parser.add_argument('--server-loop', type=str, default='threads',
+                        help='threads: one receiving thread per worker, event: one loop for all workers')
+    parser.add_argument('--server-pool', type=int, default=4,
+                        help='threads handling the messages received by the event loop')
+    parser.add_argument('--server-stripes', type=int, default=16,
+                        help='lock stripes of the server model, 1 serializes all updates')
+    parser.add_argument('--downlink-storage', type=str, default='sparse',
+                        help='dense or sparse storage of the pending replies of every worker on the server')
+    parser.add_argument('--downlink-half', action='store_true', default=False,
+                        help='keep the pending replies on the server in fp16')
+    parser.add_argument('--server-memory-budget', type=float, default=0,
+                        help='MB of pending replies per server, a worker above its share gets a catch-up')
+    parser.add_argument('--server-procs', type=int, default=1,
+                        help='processes per shard sharing its memory-mapped model, each serving a part of the workers')
+    parser.add_argument('--shared-dir', type=str, default='',
+                        help='directory of the files shared by the processes of a shard, the temp directory if empty')
+    parser.add_argument('--ring-capacity', type=int, default=2 ** 18,
+                        help='entries per stripe of the update ring shared by the processes of a shard')
+    parser.add_argument('--coalesce-window', type=float, default=0,
+                        help='ms a sparse update waits on the server for others to be applied with, 0 for none')
+    parser.add_argument('--coalesce-max', type=int, default=8,
+                        help='largest number of sparse updates applied together')
+    parser.add_argument('--shared-window', type=int, default=0,
+                        help='versions the top-k of the recent global change is reused for all replies, 0 for none')
+    parser.add_argument('--personal-rate', type=float, default=0,
+                        help='fraction of a shared reply chosen for the worker itself, 0 skips its own top-k')
+    parser.add_argument('--update-log', type=str, default='',
+                        help='directory of the log of the sparse updates applied by the servers, empty for none')
+    parser.add_argument('--snapshot-dir', type=str, default='',
+                        help='directory of the background snapshots of the server model, empty for none')
+    parser.add_argument('--snapshot-interval', type=int, default=500,
+                        help='steps of the first worker between two snapshots of the server model')
+    parser.add_argument('--recover', action='store_true', default=False,
+                        help='restart the servers from the last snapshot and the update log')
+    parser.add_argument('--heartbeat-timeout', type=float, default=0,
+                        help='seconds without a heartbeat after which the servers drop a worker, 0 for none')
+    parser.add_argument('--join-delay', type=float, default=0,
+                        help='seconds this worker stays out of the training before asking for the model')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='serve the server metrics on localhost at this port plus the server rank, 0 for none')
+    parser.add_argument('--metrics-socket', type=str, default='',
+                        help='serve the server metrics on this Unix socket, suffixed with the server rank')
+    parser.add_argument('--sync-interval', type=int, default=150,
+                        help='steps between two catch-ups of a worker with everything pending, 0 for none')
+    parser.add_argument('--staleness-scaling', type=str, default='none',
+                        help='scale updates by their staleness on the server: none, inverse or sqrt')
+    parser.add_argument('--max-staleness', type=int, default=0,
+                        help='hold workers more than this many steps ahead of the slowest one, 0 for no bound')
+    parser.add_argument('--max-hold', type=float, default=60,
+                        help='seconds a worker is held by --max-staleness at most, 0 for no limit')
+    parser.add_argument('--staleness-log', type=str, default='',
+                        help='csv the server writes its staleness histogram to at every catch-up of worker 1')
+    parser.add_argument('--dense-wire', type=str, default='half', choices=['half', 'bf16', 'float'],
+                        help='asgd: type of the dense updates and replies on the wire, the server adds up in fp32. '
+                             'half and bf16 reply with the change against a backup of the worker model in that type, '
+                             'float with the whole model')
+    parser.add_argument('--bucket-mb', type=float, default=4,
+                        help='asgd: size of the buckets a dense update is sent in, 0 for one message')
+    parser.add_argument('--dc-lambda', type=float, default=0,
+                        help='lambda of delay compensated ASGD on the server, 0 turns it off')
     # parser.add_argument('--server', action='store_true', default=False, help='server node?')
     parser.add_argument('--dataset', type=str, default='cifar10', help='which dataset to train on')
     parser.add_argument('--master', type=str, default='localhost', help='ip address of the master (server) node')
     parser.add_argument('--port', type=str, default='29500', help='port on master node to communicate with')
-    parser.add_argument('--mode', type=str, default='gradient_sgd', help='gradient_sgd, dgc, Aji or asgd')
+    parser.add_argument('--mode', type=str, default='gradient_sgd',
+                        help='gradient_sgd, dgc, Aji, powersgd, ef_signsgd, local_sgd or asgd')
+    parser.add_argument('--powersgd-rank', type=int, default=4, help='rank of the P/Q factors in powersgd mode')
+    parser.add_argument('--adaptive-rate', action='store_true', default=False,
+                        help='adapt the compression rate to the measured compute and communication time')
+    parser.add_argument('--rate-schedule', action='store_true', default=False,
+                        help='without --adaptive-rate, follow the per epoch compression rate schedule of the script')
+    parser.add_argument('--min-rate', type=float, default=0.001, help='lower limit of the adaptive compression rate')
+    parser.add_argument('--max-rate', type=float, default=0.25, help='upper limit of the adaptive compression rate')
+    parser.add_argument('--overlap-bound', type=float, default=1.0,
+                        help='adaptive rate keeps communication time below this multiple of compute time')
+    parser.add_argument('--layer-density', action='store_true', default=False,
+                        help='split the compression budget across layers by gradient norm and residual growth')
+    parser.add_argument('--outstanding', type=int, default=1,
+                        help='steps a worker may run ahead of the replies of the servers, 1 waits for every reply')
+    parser.add_argument('--local-steps', type=int, default=8,
+                        help='local_sgd: local steps between two pushes of the model delta')
+    parser.add_argument('--compress-threads', type=int, default=1,
+                        help='threads compressing independent layers in parallel on CPU')
     parser.add_argument('--model', type=str, default='ResNet18', help='AlexNet, ResNet18, ResNet50')
     parser.add_argument('--network-interface', type=str, default='enp3s0',
                         help='By default, Gloo backends will try to find the right network interface to use. '
@@ -270,7 +352,7 @@ if __name__ == "__main__":
         print('MODEL:%s, momentum:%f' % (args.model, args.momentum))
         assert net is not None
         constant.MODEL_SIZE = ravel_model_params(net).numel()
-        if args.rank == 0 and not args.no_distributed:
+        if args.rank in all_server_ranks(args) and not args.no_distributed:
             if args.cuda is False:
                 print('server init in cpu')
             init_server(args, net)
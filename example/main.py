@@ -1,36 +1,151 @@
+import atexit
 import os
+import shutil
 import sys
+import tempfile
 
 WORKPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 print(WORKPATH)
 sys.path.append(WORKPATH)
 
-from core.utils.serialization import ravel_model_params
+from concurrent.futures import ThreadPoolExecutor
+
+from core.utils.messaging import GSMessageCode, MessageLoop, QueueManager, WIRE_TYPES
+from core.utils.metrics import serve_metrics
+from core.utils.membership import HeartbeatMonitor
+from core.utils.serialization import ravel_model_params, compression_executor
+from core.utils.sharding import process_group_size, server_process_ranks, served_workers, shard_ranges, \
+    shard_layers
 
 from core.utils import constant
 import torch.distributed as dist
-from core.server import GradientServer
+from core.server import GradientServer, ServerState
+from core.utils.compressor import COMPRESSORS
+from core.utils.snapshot import ModelSnapshot
+from core.utils.staleness import StalenessTracker
+from core.utils.update_log import UpdateLog
+
+
+def serve_server_metrics(args, state, queue_depth):
+    """metrics endpoint of this server rank, on the port or socket of the arguments offset by the rank"""
+    metrics = state.metrics
+    metrics.gauge('queue_depth', 'messages announced and not handled yet', queue_depth)
+    metrics.gauge('members', 'workers taking part in the training', lambda: len(state.members))
+    metrics.gauge('model_bytes', 'bytes of the server model', lambda: state.memory_report()['model_bytes'])
+    metrics.gauge('downlink_bytes', 'bytes pending for every worker',
+                  lambda: {worker: downlink.nbytes() for worker, downlink in state.downlinks.items()})
+    metrics.gauge('held_seconds', 'seconds every worker was held by --max-staleness',
+                  lambda: dict(state.staleness.held))
+    if state.coalescer is not None:
+        metrics.gauge('coalesced_batch', 'mean number of updates applied together',
+                      lambda: state.coalescer.report()['mean_batch'])
+    serve_metrics(metrics, port=args.metrics_port + args.rank if args.metrics_port else 0,
+                  socket_path='%s.%d' % (args.metrics_socket, args.rank) if args.metrics_socket else '')
 
 
 def init_server(args, net):
     print('init server')
-    dist.init_process_group('gloo', init_method='file://%s/sharedfile' % WORKPATH, group_name='mygroup',
-                            world_size=args.world_size, rank=args.rank)
+    # the processes serving one shard share its model, the first one creates the shared files before joining the
+    # process group, the others open them after
+    shards = server_process_ranks(args)
+    shard = [args.rank in ranks for ranks in shards].index(True)
+    leader = args.rank == shards[shard][0]
+    shared_path = None
+    if args.server_procs > 1:
+        # the dense change of a stripe would overflow the update ring
+        if args.mode not in COMPRESSORS or \
+                COMPRESSORS[args.mode].message_code != GSMessageCode.SparseGradientUpdate:
+            raise Exception('--server-procs needs a sparse mode, not %s' % args.mode)
+        # one directory per run and shard, removed with the first process
+        shared_path = os.path.join(args.shared_dir or tempfile.gettempdir(), 'dgs_%s_shard%d' % (args.port, shard))
+        if leader:
+            atexit.register(shutil.rmtree, shared_path, True)
+    if not leader:
+        dist.init_process_group('gloo', init_method='file://%s/sharedfile' % WORKPATH, group_name='mygroup',
+                                world_size=process_group_size(args), rank=args.rank)
 
-    if args.cuda:
+    if args.cuda and shared_path is None:
         model = net.cuda()
     else:
         model = net
     size_list = [i.data.numel() for i in net.parameters()]
-    threads_num = dist.get_world_size() - 1
+    shape_list = [i.data.size() for i in net.parameters()]
+    # this server only holds its shard of the flat model
+    start, end = shard_ranges(size_list, args.num_servers)[shard]
+    layers = shard_layers(size_list, start, end)
+    size_list = [size_list[i] for i in layers]
+    shape_list = [shape_list[i] for i in layers]
+    workers = served_workers(args, args.rank)
+    print('server rank %d holds layers %d-%d, [%d, %d), serves workers %s' % (args.rank, layers[0], layers[-1],
+                                                                             start, end, workers))
     threads = []
-    global_model = ravel_model_params(model)
+    global_model = ravel_model_params(model)[start:end].clone()
     constant.MODEL_SIZE = global_model.numel()
-    synced_model = global_model.clone()
-    for i in range(1, threads_num + 1):
-        th = GradientServer(model=model, rank=i, worker_num=args.world_size, global_model=global_model,
-                            synced_model=synced_model, size_list=size_list, args=args)
+    # replies are sparse for the compressed modes. asgd needs no downlink: with --dense-wire float it replies with the
+    # whole model in fp32 and delay compensation keeps the model of the last reply of every worker. With half or bf16
+    # it replies with the change of the model against a backup of the worker model in that type
+    downlink = None
+    if args.mode in COMPRESSORS:
+        downlink = args.downlink_storage
+    reply_dtype = None
+    if args.mode == 'asgd' and args.dense_wire != 'float':
+        reply_dtype = WIRE_TYPES[args.dense_wire]
+    update_log = None
+    if args.update_log:
+        # a dense update would log the whole model
+        if args.mode not in COMPRESSORS or \
+                COMPRESSORS[args.mode].message_code != GSMessageCode.SparseGradientUpdate:
+            raise Exception('the update log needs a sparse mode, not %s' % args.mode)
+        update_log = UpdateLog(os.path.join(args.update_log, 'shard%d' % shard), create=not args.recover)
+    if args.recover and not args.snapshot_dir:
+        raise Exception('--recover needs the --snapshot-dir of the run')
+    snapshots = None
+    if args.snapshot_dir and leader:
+        snapshots = ModelSnapshot(os.path.join(args.snapshot_dir, 'shard%d' % shard), global_model.numel())
+    state = ServerState(global_model, size_list, args.world_size, stripes=args.server_stripes, downlink=downlink,
+                        half=args.downlink_half, memory_budget=int(args.server_memory_budget * 2 ** 20),
+                        staleness=StalenessTracker(args.world_size, scaling=args.staleness_scaling,
+                                                   bound=args.max_staleness, workers=workers,
+                                                   max_hold=args.max_hold),
+                        sync_interval=args.sync_interval, workers=workers, shared_path=shared_path,
+                        leader=leader, ring_capacity=args.ring_capacity,
+                        coalesce_window=args.coalesce_window / 1000.0, coalesce_max=args.coalesce_max,
+                        shared_window=args.shared_window, personal_rate=args.personal_rate, update_log=update_log,
+                        snapshots=snapshots, backups=bool(args.dc_lambda) and downlink is None,
+                        reply_dtype=reply_dtype)
+    if args.recover and snapshots is not None:
+        print('server rank %d recovered the model, log position %s' % (args.rank, state.recover()))
+    elif snapshots is not None:
+        # the update log is replayed from this one
+        state.save_snapshot()
+    if leader:
+        dist.init_process_group('gloo', init_method='file://%s/sharedfile' % WORKPATH, group_name='mygroup',
+                                world_size=process_group_size(args), rank=args.rank)
+    # one pool shared by the threads of all workers
+    executor = compression_executor(args.compress_threads)
+    for i in workers:
+        th = GradientServer(model=model, rank=i, worker_num=args.world_size, state=state, size_list=size_list,
+                            shape_list=shape_list, executor=executor, args=args)
         threads.append(th)
-        th.start()
-    for t in threads:
-        t.join()
+        if args.server_loop == 'threads':
+            th.start()
+    if args.heartbeat_timeout:
+        HeartbeatMonitor(state, args.heartbeat_timeout).start()
+    if args.server_loop == 'event':
+        # one receiving thread for all workers, the messages are handled on a small pool. A worker held by
+        # --max-staleness occupies a pool thread, the pool must not run out while the slowest worker catches up
+        pool = args.server_pool if not args.max_staleness else max(args.server_pool, len(workers))
+        if args.coalesce_window:
+            # the updates of a batch wait on pool threads
+            pool = max(pool, min(args.coalesce_max, len(workers)))
+        loop = MessageLoop({th.source: th for th in threads}, ThreadPoolExecutor(pool))
+        if args.metrics_port or args.metrics_socket:
+            serve_server_metrics(args, state, loop.depth)
+        loop.start()
+        loop.join()
+    else:
+        if args.metrics_port or args.metrics_socket:
+            serve_server_metrics(args, state, lambda: {worker: QueueManager.recv_queue_list[worker].qsize()
+                                                       for worker in workers})
+        for t in threads:
+            t.join()